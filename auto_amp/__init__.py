@@ -0,0 +1 @@
+default_app_config = "auto_amp.apps.AutoAmpConfig"
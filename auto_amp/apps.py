@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class AutoAmpConfig(AppConfig):
     name = "auto_amp"
+
+    def ready(self):
+        from .pipeline import load_pipeline
+        from .storage import load_static_image_sizes
+
+        # Misconfigured stages fail at startup instead of on the first AMP page.
+        load_pipeline()
+        # Static image dimensions are looked up on every AMP page.
+        load_static_image_sizes()
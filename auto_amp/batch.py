@@ -0,0 +1,155 @@
+import os
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+import django
+from django.conf import settings
+
+from . import remote, utils
+
+
+# Documents sent at once to each worker process.
+DEFAULT_CHUNK_SIZE = 16
+
+AmpResult = namedtuple("AmpResult", ["index", "path", "content", "error"])
+
+
+def add_amp_tags_many(
+    documents,
+    workers=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    max_pending=None,
+    ordered=True,
+    charset=None,
+    encoding=None,
+):
+    """
+    Adds basic AMP tags to many HTML documents, given as an iterable of
+    '(content, path)' pairs, on a pool of 'workers' processes, one per core by
+    default. Yields an 'AmpResult' of the index, path and AMP content of every
+    document, or the error transforming it, in the order of the documents or as
+    they are completed.
+
+    Documents are read from the iterable and sent to the workers by chunks of
+    'chunk_size', with up to 'max_pending' chunks, twice the workers by default,
+    being transformed or waiting to be yielded, so memory stays bounded whatever
+    the number of documents. The stylesheets and image dimensions of the first
+    document, most likely shared by the others, are fetched beforehand and shipped
+    to every worker once.
+    """
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or workers * 2
+    chunks = _chunks(enumerate(documents), chunk_size)
+
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return
+    _warm_caches(first_chunk[:1], charset)
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(os.environ.get("DJANGO_SETTINGS_MODULE"), _cache_snapshot()),
+    ) as executor:
+        pending = deque()
+
+        def submit(chunk):
+            pending.append(executor.submit(_transform_chunk, chunk, charset, encoding))
+
+        submit(first_chunk)
+        for chunk in islice(chunks, max_pending - 1):
+            submit(chunk)
+
+        try:
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+
+                for future in done:
+                    # A chunk is read only once another one leaves the pool.
+                    chunk = next(chunks, None)
+                    if chunk is not None:
+                        submit(chunk)
+                    yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _chunks(iterable, chunk_size):
+    while True:
+        chunk = list(islice(iterable, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _warm_caches(documents, charset):
+    """
+    Fetches the stylesheets and image dimensions of indexed documents into the
+    in-process caches. Documents failing to be transformed are left to the workers
+    to report.
+    """
+    for _, (content, _) in documents:
+        try:
+            parsed_html = utils.parse_html(content, charset)
+            tags = utils.collect_tags(parsed_html)
+            hrefs = [stylesheet["href"] for stylesheet in tags["stylesheets"]]
+            remote.fetch_remote_stylesheets(hrefs)
+            for href in hrefs:
+                if remote.remote_stylesheet_url(href) is None:
+                    utils._fetch_file_content(href)
+            utils._get_images_info(utils.unsized_image_sources(tags))
+            parsed_html.decompose()
+        except Exception:
+            continue
+
+
+def _cache_snapshot():
+    return {
+        "stylesheets": utils.stylesheet_cache.items(),
+        "remote_stylesheets": remote.remote_stylesheet_cache.items(),
+        "images": utils.image_info_cache.local.items(),
+    }
+
+
+def _init_worker(settings_module, cache_snapshot):
+    """
+    Sets Django up on spawned worker processes, and fills their caches with the
+    ones of the parent process.
+
+    Forked worker processes inherit the thread pools of the parent process without
+    their threads, and its open connections, so they get their own.
+    """
+    if not settings.configured:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+        django.setup()
+
+    utils._reset_worker_pools()
+
+    for cache, name in (
+        (utils.stylesheet_cache, "stylesheets"),
+        (remote.remote_stylesheet_cache, "remote_stylesheets"),
+        (utils.image_info_cache.local, "images"),
+    ):
+        for key, value, size in cache_snapshot[name]:
+            cache.set(key, value, size)
+
+
+def _transform_chunk(chunk, charset, encoding):
+    results = []
+    for index, (content, path) in chunk:
+        try:
+            amp_content = utils.add_amp_tags(
+                content, path, charset=charset, encoding=encoding
+            )
+        except Exception as error:
+            results.append(AmpResult(index, path, None, error))
+        else:
+            results.append(AmpResult(index, path, amp_content, None))
+    return results
@@ -0,0 +1,313 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+from django.core.cache import caches
+
+from .conf import get_setting
+from .pipeline import pipeline_fingerprint
+
+
+class LRUCache:
+    """
+    Thread-safe, in-process cache bounded by the total size of its values, which
+    evicts the least recently used entries first. Hits and misses are counted so the
+    cache efficiency can be checked with 'stats()'.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, is_valid=None):
+        """
+        Returns the value cached for a key, marking it as the most recently used.
+        Entries for which 'is_valid(value)' is false are dropped and count as misses.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if is_valid is not None and not is_valid(value):
+                self._pop(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        """
+        Caches a value taking the given size, evicting the least recently used
+        entries until it fits. Values bigger than the whole cache aren't stored.
+        """
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                return
+
+            self._entries[key] = value, size
+            self._size += size
+            while self._size > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        """
+        Removes the entry of a key, if it is cached.
+        """
+        with self._lock:
+            self._pop(key)
+
+    def items(self):
+        """
+        Returns the key, value and size of every entry, from the least to the most
+        recently used, to be set on another cache.
+        """
+        with self._lock:
+            return [(key, value, size) for key, (value, size) in self._entries.items()]
+
+    def clear(self):
+        """
+        Removes all entries and resets the hit and miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns the hit and miss counters, the number of entries and their total
+        size.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size": self._size,
+            }
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+
+class SingleFlightCache:
+    """
+    Two-tier cache with an in-process 'LRUCache' in front of a Django cache.
+
+    Concurrent lookups of a missing key compute its value only once: threads wait on
+    the future of the lookup in flight for the key, and other processes wait on a
+    lock entry kept in the Django cache, polling for the value until it is set or
+    the lock expires. Values are computed out of any lock shared between keys.
+    """
+
+    def __init__(
+        self,
+        key_prefix,
+        max_entries,
+        timeout,
+        negative_timeout,
+        cache_alias="default",
+        lock_timeout=10,
+        poll_interval=0.05,
+    ):
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.cache_alias = cache_alias
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.local = LRUCache(max_entries)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def get_or_set(self, key, compute, is_negative=lambda value: not value):
+        """
+        Returns the value cached for a key, calling 'compute(key)' to set it when
+        missing. Values for which 'is_negative(value)' is true are kept for
+        'negative_timeout' seconds instead of 'timeout'.
+        """
+        cached = self.local.get(key, is_valid=_is_fresh)
+        if cached is not None:
+            return cached.value
+
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                # The value may have been set by the lookup which was in flight.
+                cached = self.local.get(key, is_valid=_is_fresh)
+                if cached is not None:
+                    return cached.value
+                self._in_flight[key] = in_flight = Future()
+        if future is not None:
+            return future.result()
+
+        try:
+            value = self._get_or_set_shared(key, compute, is_negative)
+            timeout = self.negative_timeout if is_negative(value) else self.timeout
+            self.local.set(key, _ExpiringValue(value, time.monotonic() + timeout), 1)
+        except BaseException as error:
+            in_flight.set_exception(error)
+            raise
+        else:
+            in_flight.set_result(value)
+            return value
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def delete(self, key):
+        """
+        Removes a key from both the in-process and the shared cache.
+        """
+        self.local.delete(key)
+        caches[self.cache_alias].delete(self._shared_key(key))
+
+    def clear(self):
+        """
+        Removes all entries from the in-process cache.
+        """
+        self.local.clear()
+
+    def _shared_key(self, key):
+        return f"{self.key_prefix}:{hashlib.sha1(key.encode()).hexdigest()}"
+
+    def _get_or_set_shared(self, key, compute, is_negative):
+        shared_cache = caches[self.cache_alias]
+        cache_key = self._shared_key(key)
+        lock_key = f"{cache_key}:lock"
+
+        value = shared_cache.get(cache_key)
+        if value is not None:
+            return value
+
+        deadline = time.monotonic() + self.lock_timeout
+        locked = shared_cache.add(lock_key, 1, self.lock_timeout)
+        while not locked and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            value = shared_cache.get(cache_key)
+            if value is not None:
+                return value
+
+            locked = shared_cache.add(lock_key, 1, self.lock_timeout)
+
+        # The value is computed anyway when the lock holder takes too long.
+        try:
+            value = compute(key)
+            timeout = self.negative_timeout if is_negative(value) else self.timeout
+            shared_cache.set(cache_key, value, timeout)
+        finally:
+            if locked:
+                shared_cache.delete(lock_key)
+
+        return value
+
+
+_ExpiringValue = namedtuple("_ExpiringValue", ["value", "expires_at"])
+
+
+def _is_fresh(expiring_value):
+    return expiring_value.expires_at > time.monotonic()
+
+
+def _amp_output_cache_key(canonical_path):
+    # Imported here, as the transform imports this module.
+    from .utils import AMP_TRANSFORM_VERSION
+
+    path_digest = hashlib.blake2b(canonical_path.encode(), digest_size=16).hexdigest()
+    return (
+        f"auto_amp:amp_output:{AMP_TRANSFORM_VERSION}:{pipeline_fingerprint()}:"
+        f"{path_digest}"
+    )
+
+
+def _is_amp_output_cacheable(canonical_path, canonical_content):
+    """
+    Checks whether the AMP output of a canonical page can be cached, according to
+    the output cache settings.
+    """
+    include_prefixes = get_setting("OUTPUT_CACHE_INCLUDE")
+    exclude_prefixes = get_setting("OUTPUT_CACHE_EXCLUDE")
+
+    return (
+        get_setting("OUTPUT_CACHE_ALIAS") is not None
+        and len(canonical_content) <= get_setting("OUTPUT_CACHE_MAX_SIZE")
+        and (
+            include_prefixes is None
+            or canonical_path.startswith(tuple(include_prefixes))
+        )
+        and not canonical_path.startswith(tuple(exclude_prefixes))
+    )
+
+
+def get_amp_output(canonical_path, canonical_content):
+    """
+    Returns the AMP output cached for a canonical page, as long as it was generated
+    from the same canonical content and stylesheets by the same transform, or None.
+    """
+    from .utils import stylesheets_version
+
+    if not _is_amp_output_cacheable(canonical_path, canonical_content):
+        return None
+
+    output_cache = caches[get_setting("OUTPUT_CACHE_ALIAS")]
+    cached = output_cache.get(_amp_output_cache_key(canonical_path))
+    if cached is None:
+        return None
+
+    content_digest, hrefs, version, amp_content = cached
+    if content_digest != hashlib.blake2b(canonical_content).digest():
+        return None
+    if stylesheets_version(hrefs) != version:
+        return None
+
+    return amp_content
+
+
+def set_amp_output(canonical_path, canonical_content, amp_content, fragments=None):
+    """
+    Caches the AMP output of a canonical page along with a digest of its content,
+    and the version of the stylesheets inlined into it, including the ones of the
+    AMP 'fragments' it holds by token.
+    """
+    from .utils import page_stylesheets, stylesheets_version
+
+    if not _is_amp_output_cacheable(canonical_path, canonical_content):
+        return
+
+    hrefs = page_stylesheets(canonical_content, fragments)
+
+    output_cache = caches[get_setting("OUTPUT_CACHE_ALIAS")]
+    output_cache.set(
+        _amp_output_cache_key(canonical_path),
+        (
+            hashlib.blake2b(canonical_content).digest(),
+            tuple(hrefs),
+            stylesheets_version(hrefs),
+            amp_content,
+        ),
+        get_setting("OUTPUT_CACHE_TIMEOUT"),
+    )
+
+
+def invalidate_amp_output(canonical_path):
+    """
+    Removes the AMP output cached for a canonical page.
+    """
+    output_cache_alias = get_setting("OUTPUT_CACHE_ALIAS")
+    if output_cache_alias is not None:
+        caches[output_cache_alias].delete(_amp_output_cache_key(canonical_path))
@@ -0,0 +1,301 @@
+import logging
+import re
+from html.parser import HTMLParser
+
+from django.template.base import tag_re
+
+from . import utils
+from .css import markup_features
+from .fragments import splice_amp_fragments
+from .streaming import _format_starttag
+from .timing import NULL_TIMER
+
+
+logger = logging.getLogger(__name__)
+
+# Left by compiled templates where the AMP head is completed for every page.
+AMP_HEAD_MARKER = "<!--amp-head-->"
+
+# Stands for a template variable, tag or comment while a template is compiled, as
+# it can't be told apart from the markup around it.
+TEMPLATE_TOKEN_PLACEHOLDER = "amptemplatetoken{}x"
+
+TEMPLATE_TOKEN_PLACEHOLDER_PATTERN = re.compile(r"amptemplatetoken(\d+)x")
+
+TAG_ATTRIBUTES = r"""(?:[^>"']|"[^"]*"|'[^']*')*"""
+
+HTML_TAG = re.compile(rf"<html\b{TAG_ATTRIBUTES}>", re.IGNORECASE)
+
+HEAD_START_TAG = re.compile(rf"<head\b{TAG_ATTRIBUTES}>", re.IGNORECASE)
+
+HEAD_END_TAG = re.compile(r"</head\s*>", re.IGNORECASE)
+
+META_TAG = re.compile(rf"<meta\b{TAG_ATTRIBUTES}>", re.IGNORECASE)
+
+LINK_TAG = re.compile(rf"<link\b{TAG_ATTRIBUTES}>", re.IGNORECASE)
+
+IMG_TAG = re.compile(rf"<img\b{TAG_ATTRIBUTES}>", re.IGNORECASE)
+
+SCRIPT_ELEMENT = re.compile(
+    rf"<script\b{TAG_ATTRIBUTES}>.*?</script\s*>", re.DOTALL | re.IGNORECASE
+)
+
+AMP_HEAD_START = _format_starttag("meta", [("charset", utils.AMP_CHARSET)]) + (
+    _format_starttag(
+        "meta", [("name", "viewport"), ("content", utils.AMP_VIEWPORT_CONTENT)]
+    )
+)
+
+AMP_HEAD_END = (
+    AMP_HEAD_MARKER
+    + _format_starttag("script", [("async", ""), ("src", utils.AMP_JS_URL)])
+    + "</script>"
+    + _format_starttag("style", [("amp-boilerplate", "")])
+    + utils.AMP_CSS_BOILERPLATE
+    + "</style><noscript>"
+    + _format_starttag("style", [("amp-boilerplate", "")])
+    + utils.AMP_NOSCRIPT_CSS_BOILERPLATE
+    + "</style></noscript>"
+)
+
+
+class _StartTagParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.attrs = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.attrs is None:
+            self.attrs = attrs
+
+    handle_startendtag = handle_starttag
+
+
+def _start_tag_attrs(markup):
+    """
+    Returns the attributes of the first start tag of some markup by name.
+    """
+    parser = _StartTagParser()
+    parser.feed(markup)
+    parser.close()
+    return dict(parser.attrs or ())
+
+
+def compile_amp_template(source):
+    """
+    Compiles the source of a Django template into the source of its AMP twin, once
+    for all renders: scripts are removed, images replaced with sized 'amp-img' tags,
+    and the 'html' and 'head' tags get their AMP attributes, metas, script and CSS
+    boilerplate. The canonical link and the merged stylesheets are left to
+    'finish_amp_page', where 'AMP_HEAD_MARKER' is.
+
+    Template variables, tags and comments are kept as they are, and the markup they
+    make up is left untouched: scripts holding them are kept, and images whose
+    source or attributes are only known once rendered are left to be replaced by
+    'finish_amp_page', as are the ones whose dimensions are unknown, so they are
+    measured again. Sources which can't be compiled are returned unchanged.
+    """
+    if TEMPLATE_TOKEN_PLACEHOLDER_PATTERN.search(source):
+        return source
+
+    tokens = []
+
+    def mask(match):
+        tokens.append(match.group(0))
+        return TEMPLATE_TOKEN_PLACEHOLDER.format(len(tokens) - 1)
+
+    markup = _compile_markup(tag_re.sub(mask, source))
+
+    restored = []
+
+    def unmask(match):
+        restored.append(int(match.group(1)))
+        return tokens[restored[-1]]
+
+    compiled = TEMPLATE_TOKEN_PLACEHOLDER_PATTERN.sub(unmask, markup)
+    if restored != list(range(len(tokens))):
+        logger.warning("AMP template couldn't be compiled, its tokens were changed.")
+        return source
+    return compiled
+
+
+def _has_template_token(markup):
+    return TEMPLATE_TOKEN_PLACEHOLDER_PATTERN.search(markup) is not None
+
+
+def _is_compiled_img(img_attrs):
+    """
+    Checks whether an image is known before rendering: its attributes are all there
+    and its source is known too, unless its size is.
+    """
+    if any(_has_template_token(name) for name in img_attrs):
+        return False
+    src = img_attrs.get("src") or ""
+    return not _has_template_token(src) or utils._has_fixed_size(img_attrs)
+
+
+def _compile_markup(markup):
+    markup = _remove_scripts(markup, keep=_has_template_token)
+    markup = _replace_imgs(markup, _is_compiled_img, keep_unknown=True)
+
+    head_start = HEAD_START_TAG.search(markup)
+    head_end = HEAD_END_TAG.search(markup, head_start.end()) if head_start else None
+    if head_end is None:
+        return markup
+
+    def remove_meta(match):
+        meta = match.group(0)
+        meta_attrs = _start_tag_attrs(meta)
+        if not _has_template_token(meta) and (
+            "charset" in meta_attrs
+            or (meta_attrs.get("http-equiv") or "").lower() == "content-type"
+            or meta_attrs.get("name") == "viewport"
+        ):
+            return ""
+        return meta
+
+    html_tag = HTML_TAG.search(markup, 0, head_start.start())
+    if html_tag is None:
+        html_start = ""
+    elif {"amp", "⚡"} & _start_tag_attrs(html_tag.group(0)).keys():
+        html_start = html_tag.group(0)
+    else:
+        html_start = f"{html_tag.group(0)[:5]} amp{html_tag.group(0)[5:]}"
+    before_html = markup[: html_tag.start()] if html_tag else ""
+    after_html = markup[html_tag.end() if html_tag else 0 : head_start.start()]
+
+    return "".join(
+        (
+            before_html,
+            html_start,
+            after_html,
+            head_start.group(0),
+            AMP_HEAD_START,
+            META_TAG.sub(remove_meta, markup[head_start.end() : head_end.start()]),
+            AMP_HEAD_END,
+            markup[head_end.start() :],
+        )
+    )
+
+
+def _remove_scripts(markup, keep=None):
+    """
+    Removes the scripts which aren't of the allowed types nor the AMP JS, unless
+    'keep(script)' is true.
+    """
+
+    def remove_script(match):
+        script = match.group(0)
+        script_attrs = _start_tag_attrs(script)
+        if (
+            utils.JAVASCRIPT_ALLOWED_TYPES.search(script_attrs.get("type") or "")
+            or script_attrs.get("src") == utils.AMP_JS_URL
+            or (keep is not None and keep(script))
+        ):
+            return script
+        return ""
+
+    return SCRIPT_ELEMENT.sub(remove_script, markup)
+
+
+def _replace_imgs(markup, replaceable=None, keep_unknown=False):
+    """
+    Replaces the 'img' tags with 'amp-img' ones, probing the unsized images
+    concurrently, unless 'replaceable(attrs)' is false, or their dimensions are
+    unknown and 'keep_unknown' is given.
+    """
+    imgs = []
+    for match in IMG_TAG.finditer(markup):
+        img_attrs = _start_tag_attrs(match.group(0))
+        if replaceable is None or replaceable(img_attrs):
+            img_attrs["layout"] = img_attrs.get("layout", "responsive")
+            imgs.append((match, img_attrs))
+    if not imgs:
+        return markup
+
+    unsized_srcs = [
+        img_attrs["src"]
+        for _, img_attrs in imgs
+        if img_attrs.get("src") and not utils._has_fixed_size(img_attrs)
+    ]
+    images_info = utils._get_images_info(unsized_srcs) if unsized_srcs else {}
+
+    parts = []
+    position = 0
+    for match, img_attrs in imgs:
+        if img_attrs.get("src") and not utils._has_fixed_size(img_attrs):
+            size = images_info.get(img_attrs["src"])
+            if keep_unknown and not utils._is_known_size(size):
+                continue
+            utils._set_image_size(img_attrs, size)
+        parts.append(markup[position : match.start()])
+        parts.append(_format_starttag("amp-img", img_attrs.items()))
+        parts.append("</amp-img>")
+        position = match.end()
+    parts.append(markup[position:])
+    return "".join(parts)
+
+
+def is_compiled_amp_page(content, fragments=None):
+    """
+    Checks whether a page, as text or bytes, was rendered from compiled templates,
+    as recorded on the 'fragments' collected while it was rendered, and holds the
+    place of the AMP head.
+    """
+    if not getattr(fragments, "compiled", False):
+        return False
+    if isinstance(content, bytes):
+        return AMP_HEAD_MARKER.encode() in content
+    return AMP_HEAD_MARKER in content
+
+
+def finish_amp_page(
+    content, path, timer=NULL_TIMER, charset=None, encoding=None, fragments=None
+):
+    """
+    Completes an AMP page rendered from compiled templates, without parsing it: the
+    scripts and images only known once rendered are removed and replaced, and the
+    canonical link and the merged stylesheets, pruned to the page features, are
+    inserted where 'AMP_HEAD_MARKER' is. The 'fragments' whose placeholders the page
+    holds, by token, are spliced and their stylesheets merged.
+
+    Pages given as bytes are decoded from 'charset' when given, or from UTF-8. The
+    AMP page is returned as text, or as bytes encoded to 'encoding' when given.
+    """
+    if isinstance(content, bytes):
+        content = content.decode(charset or utils.AMP_CHARSET, errors="replace")
+    content = splice_amp_fragments(content, fragments)
+
+    with timer.stage("scripts"):
+        content = _remove_scripts(content)
+    with timer.stage("images"):
+        content = _replace_imgs(content)
+
+    with timer.stage("stylesheets"):
+        hrefs = []
+
+        def remove_stylesheet(match):
+            link_attrs = _start_tag_attrs(match.group(0))
+            if "stylesheet" not in (link_attrs.get("rel") or "").lower().split():
+                return match.group(0)
+            if link_attrs.get("href"):
+                hrefs.append(link_attrs["href"])
+            return ""
+
+        content = LINK_TAG.sub(remove_stylesheet, content)
+        for fragment in (fragments or {}).values():
+            hrefs.extend(href for href in fragment.stylesheets if href not in hrefs)
+        css_content = hrefs and utils.merge_stylesheets(hrefs)
+
+    head = _format_starttag("link", [("rel", "canonical"), ("href", path)])
+    if css_content:
+        with timer.stage("css"):
+            css_content = utils._prune_css(css_content, markup_features(content))
+        head += (
+            f'{_format_starttag("style", [("amp-custom", "")])}{css_content}</style>'
+        )
+    content = content.replace(AMP_HEAD_MARKER, head, 1)
+
+    if encoding is None:
+        return content
+    return content.encode(encoding)
@@ -0,0 +1,89 @@
+from django.conf import settings
+
+
+DEFAULTS = {
+    # BeautifulSoup tree builder used to parse documents. When unset, the fastest
+    # installed one is used.
+    "PARSER": None,
+    # Stages applied to every page, as callables or their dotted paths. A stage gets
+    # the parsed document, and its 'path' and collected 'tags' when it accepts them.
+    "PIPELINE": [
+        "auto_amp.utils.insert_html_amp",
+        "auto_amp.utils.insert_canonical_link",
+        "auto_amp.utils.exclude_javascript",
+        "auto_amp.utils.insert_amp_js",
+        "auto_amp.utils.insert_charset_meta",
+        "auto_amp.utils.insert_viewport_meta",
+        "auto_amp.utils.replace_external_stylesheets",
+        "auto_amp.utils.insert_amp_css_boilerplate",
+        "auto_amp.utils.replace_amp_img",
+        "auto_amp.utils.prune_amp_css",
+    ],
+    # Maximum size, in bytes, of the stylesheet contents kept in memory to be inlined.
+    "STYLESHEET_CACHE_SIZE": 4 * 1024 * 1024,
+    # Maximum size, in bytes, of the AMP custom CSS. AMP rejects pages above 75 KB.
+    "CSS_MAX_SIZE": 75000,
+    # Maximum size, in bytes, of the parsed and pruned stylesheets kept in memory.
+    "CSS_CACHE_SIZE": 4 * 1024 * 1024,
+    # Hosts whose stylesheets are fetched to be inlined, as in 'ALLOWED_HOSTS'. Other
+    # remote stylesheets are dropped.
+    "REMOTE_STYLESHEET_HOSTS": [],
+    # Django cache alias shared by all processes to keep remote stylesheets, such as
+    # a file based cache, and seconds to keep them to be revalidated once stale.
+    "REMOTE_STYLESHEET_CACHE_ALIAS": "default",
+    "REMOTE_STYLESHEET_CACHE_TIMEOUT": 7 * 24 * 60 * 60,
+    # Threads fetching remote stylesheets of all pages, also the idle connections
+    # kept by host, and seconds to wait for a single request and for all the remote
+    # stylesheets of a page.
+    "REMOTE_STYLESHEET_WORKERS": 8,
+    "REMOTE_STYLESHEET_TIMEOUT": 3,
+    "REMOTE_STYLESHEET_BUDGET": 5,
+    # Django cache alias shared by all processes to keep image dimensions.
+    "IMAGE_CACHE_ALIAS": "default",
+    # Maximum number of image dimensions also kept in memory by each process.
+    "IMAGE_CACHE_SIZE": 10000,
+    # Seconds to keep the dimensions of images, or the failure to get them.
+    "IMAGE_CACHE_TIMEOUT": 24 * 60 * 60,
+    "IMAGE_CACHE_NEGATIVE_TIMEOUT": 5 * 60,
+    # Threads probing images of all pages, and seconds to wait for a single image
+    # and for all the images of a page.
+    "IMAGE_PROBE_WORKERS": 8,
+    "IMAGE_PROBE_TIMEOUT": 3,
+    "IMAGE_PROBE_BUDGET": 5,
+    # Attributes set on images whose dimensions are unknown or weren't found within
+    # the page budget, such as {"layout": "fill"}.
+    "IMAGE_FALLBACK_ATTRS": {"width": "0", "height": "0"},
+    # Django cache alias to keep the AMP output of canonical pages, which is disabled
+    # when None, and seconds to keep it.
+    "OUTPUT_CACHE_ALIAS": None,
+    "OUTPUT_CACHE_TIMEOUT": 24 * 60 * 60,
+    # Maximum size, in bytes, of the canonical pages whose AMP output is cached.
+    "OUTPUT_CACHE_MAX_SIZE": 1024 * 1024,
+    # Canonical path prefixes whose AMP output is cached, all of them when None, and
+    # the ones never cached.
+    "OUTPUT_CACHE_INCLUDE": None,
+    "OUTPUT_CACHE_EXCLUDE": [],
+    # Django cache alias to keep the AMP fragments of the 'amp_cache' template tag,
+    # and seconds to keep them.
+    "FRAGMENT_CACHE_ALIAS": "default",
+    "FRAGMENT_CACHE_TIMEOUT": 60 * 60,
+    # How 'AutoAmpMiddleware' recognizes AMP requests: by a path prefix, stripped to
+    # get the canonical path, by a query parameter or by a media type on the 'Accept'
+    # header. Each of them is disabled when None.
+    "PATH_PREFIX": "/amp",
+    "QUERY_PARAM": None,
+    "ACCEPT_TYPE": None,
+    # Time the stages of AMP requests and send the 'amp_page_timed' signal, and also
+    # set the timings on the 'Server-Timing' response header.
+    "TIMING": False,
+    "SERVER_TIMING": False,
+    # Threads parsing and serializing pages for 'async_canonical_to_amp'.
+    "ASYNC_TRANSFORM_WORKERS": 4,
+}
+
+
+def get_setting(name):
+    """
+    Returns the value of the 'AUTO_AMP_<name>' setting or its default value.
+    """
+    return getattr(settings, f"AUTO_AMP_{name}", DEFAULTS[name])
@@ -0,0 +1,358 @@
+import re
+from collections import namedtuple
+from html import unescape
+from urllib.parse import urljoin, urlsplit
+
+
+CSS_COMMENT_OR_STRING = re.compile(
+    r"""/\*.*?(?:\*/|$)|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'""", re.DOTALL
+)
+
+CSS_DELIMITER_OR_STRING = re.compile(r""""(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[{};]""")
+
+# At-rules holding rules whose selectors are pruned on their own.
+CSS_GROUPING_AT_RULES = {
+    "@media",
+    "@supports",
+    "@document",
+    "@-moz-document",
+    "@layer",
+    "@container",
+}
+
+CSS_IDENTIFIER = r"(?:[\w-]|\\[^0-9a-fA-F\s])+"
+
+CSS_HEX_ESCAPE = re.compile(r"\\[0-9a-fA-F]")
+
+CSS_ATTRIBUTE_SELECTOR = re.compile(
+    r"""\[\s*(?:[\w-]*\|)?([\w-]+)(?:"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[^\]])*\]"""
+)
+
+CSS_FUNCTIONAL_PSEUDO_CLASS = re.compile(r"(?<!\\)::?[\w-]+\([^()]*\)")
+
+CSS_PSEUDO = re.compile(r"(?<!\\)::?[\w-]+")
+
+CSS_ID_OR_CLASS = re.compile(rf"([#.])({CSS_IDENTIFIER})")
+
+CSS_TYPE_SELECTOR = re.compile(r"(?:^|[\s>+~])([a-zA-Z][\w-]*)(?![\w|-])")
+
+CSS_STRING_SPLIT = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')""")
+
+CSS_SELECTOR_PUNCTUATION = re.compile(r" ?([,>+~]) ?")
+
+CSS_PRELUDE_PUNCTUATION = re.compile(r" ?([,:]) ?")
+
+CSS_DECLARATION_PUNCTUATION = re.compile(r" ?([{};:,]) ?")
+
+CSS_STRING = r"""(?:"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')"""
+
+CSS_REFERENCE = re.compile(
+    rf"""/\*.*?(?:\*/|$)|{CSS_STRING}"""
+    r"""|@charset\s*"[^"]*"\s*;"""
+    rf"""|@import\s*(?:url\(\s*(?P<import_url>{CSS_STRING}|[^)\s]*)\s*\)"""
+    rf"""|(?P<import_string>{CSS_STRING}))(?P<media>[^;{{}}]*);?"""
+    rf"""|url\(\s*(?P<url>{CSS_STRING}|[^)\s]*)\s*\)""",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# Comments, and contents of elements which aren't markup, kept by their start tag.
+HTML_RAW_TEXT = re.compile(
+    r"""<!--.*?-->|(<(script|style)\b(?:[^>"']|"[^"]*"|'[^']*')*>).*?</\2\s*>""",
+    re.DOTALL | re.IGNORECASE,
+)
+
+HTML_START_TAG = re.compile(r"""<([a-zA-Z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+
+HTML_ATTRIBUTE = re.compile(
+    r"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?"""
+)
+
+# Elements the AMP runtime renders inside AMP components.
+AMP_RUNTIME_CHILDREN = {"amp-img": {"img"}}
+
+StyleRule = namedtuple("StyleRule", ["selectors", "declarations"])
+
+GroupingRule = namedtuple("GroupingRule", ["prelude", "rules"])
+
+RawRule = namedtuple("RawRule", ["text"])
+
+
+def parse_stylesheet(css):
+    """
+    Splits a stylesheet into style rules, with the features each of their selectors
+    requires from a document, grouping at-rules holding other rules, and any other
+    at-rules kept as they are.
+    """
+    rules = []
+    for prelude, block in _split_rules(CSS_COMMENT_OR_STRING.sub(_strip_comment, css)):
+        if block is None:
+            rules.append(RawRule(f"{prelude};"))
+        elif prelude.startswith("@"):
+            at_keyword = prelude.split(None, 1)[0].lower()
+            if at_keyword in CSS_GROUPING_AT_RULES:
+                rules.append(GroupingRule(prelude, parse_stylesheet(block)))
+            else:
+                rules.append(RawRule(f"{prelude}{{{block}}}"))
+        elif prelude:
+            selectors = [
+                (selector, selector_features(selector))
+                for selector in _split_selectors(prelude)
+            ]
+            rules.append(StyleRule(selectors, block.strip()))
+    return rules
+
+
+def _strip_comment(match):
+    return "" if match.group().startswith("/*") else match.group()
+
+
+def _split_rules(css):
+    """
+    Returns the (prelude, block) pairs of the top level rules of a stylesheet, with
+    a None block for statements such as '@import'.
+    """
+    rules = []
+    depth = 0
+    start = 0
+    block_start = 0
+    for match in CSS_DELIMITER_OR_STRING.finditer(css):
+        delimiter = match.group()
+        if delimiter == "{":
+            if depth == 0:
+                block_start = match.start()
+            depth += 1
+        elif delimiter == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                rules.append(
+                    (
+                        css[start:block_start].strip(),
+                        css[block_start + 1 : match.start()],
+                    )
+                )
+                start = match.end()
+        elif delimiter == ";" and depth == 0:
+            statement = css[start : match.start()].strip()
+            if statement:
+                rules.append((statement, None))
+            start = match.end()
+
+    # Unterminated blocks are closed at the end of the stylesheet.
+    if depth > 0:
+        rules.append((css[start:block_start].strip(), css[block_start + 1 :]))
+    return rules
+
+
+def _split_selectors(selector_list):
+    """
+    Splits a selector list on the commas which aren't nested in parentheses,
+    brackets or strings.
+    """
+    selectors = []
+    depth = 0
+    start = 0
+    quote = None
+    escaped = False
+    for position, char in enumerate(selector_list):
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif quote:
+            quote = None if char == quote else quote
+        elif char in "\"'":
+            quote = char
+        elif char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            selectors.append(selector_list[start:position].strip())
+            start = position + 1
+    selectors.append(selector_list[start:].strip())
+    return [selector for selector in selectors if selector]
+
+
+def selector_features(selector):
+    """
+    Returns the type names, '#ids', '.classes' and '[attributes' a selector needs
+    to find in a document to match any of its elements.
+
+    Pseudo-classes are left out, as they depend on the user interaction or are
+    negations, so the features are a necessary but not sufficient condition.
+    """
+    if CSS_HEX_ESCAPE.search(selector):
+        # Not worth unescaping, selectors with hex escapes are always kept.
+        return frozenset()
+
+    features = set()
+
+    for attribute in CSS_ATTRIBUTE_SELECTOR.findall(selector):
+        features.add(f"[{attribute.lower()}")
+    selector = CSS_ATTRIBUTE_SELECTOR.sub(" ", selector)
+
+    stripped = None
+    while stripped != selector:
+        stripped, selector = selector, CSS_FUNCTIONAL_PSEUDO_CLASS.sub("", selector)
+    selector = CSS_PSEUDO.sub("", selector)
+
+    for prefix, name in CSS_ID_OR_CLASS.findall(selector):
+        features.add(prefix + name.replace("\\", ""))
+    selector = CSS_ID_OR_CLASS.sub("", selector)
+
+    for type_name in CSS_TYPE_SELECTOR.findall(selector):
+        features.add(type_name.lower())
+
+    return frozenset(features)
+
+
+def document_features(parsed_html):
+    """
+    Returns the type names, '#ids', '.classes' and '[attributes' found in a
+    document, as matched by 'selector_features'.
+    """
+    features = set()
+    for tag in parsed_html.find_all(True):
+        features.add(tag.name)
+        features.update(AMP_RUNTIME_CHILDREN.get(tag.name, ()))
+        for name, value in tag.attrs.items():
+            features.add(f"[{name}")
+            if name == "class":
+                class_names = value.split() if isinstance(value, str) else value
+                features.update(f".{class_name}" for class_name in class_names)
+            elif name == "id":
+                features.add(f"#{value}")
+    return frozenset(features)
+
+
+def markup_features(markup):
+    """
+    Returns the features of a document given as text, as 'document_features' does
+    for a parsed one, scanning its start tags without building its tree.
+    """
+    features = set()
+    for name, attributes in HTML_START_TAG.findall(HTML_RAW_TEXT.sub(r"\1", markup)):
+        name = name.lower()
+        features.add(name)
+        features.update(AMP_RUNTIME_CHILDREN.get(name, ()))
+        for attribute in HTML_ATTRIBUTE.findall(attributes):
+            attribute_name = attribute[0].lower()
+            features.add(f"[{attribute_name}")
+            if attribute_name in ("class", "id"):
+                value = unescape("".join(attribute[1:]))
+                if attribute_name == "class":
+                    features.update(f".{class_name}" for class_name in value.split())
+                else:
+                    features.add(f"#{value}")
+    return frozenset(features)
+
+
+def serialize_rules(rules, features=None):
+    """
+    Returns the CSS of every top level rule, leaving out the selectors and rules
+    which need features missing from the given document features.
+    """
+    serialized_rules = []
+    for rule in rules:
+        if isinstance(rule, StyleRule):
+            selectors = [
+                selector
+                for selector, selector_features in rule.selectors
+                if features is None or selector_features <= features
+            ]
+            if selectors:
+                serialized_rules.append(f"{','.join(selectors)}{{{rule.declarations}}}")
+        elif isinstance(rule, GroupingRule):
+            nested_rules = "".join(serialize_rules(rule.rules, features))
+            if nested_rules:
+                serialized_rules.append(f"{rule.prelude}{{{nested_rules}}}")
+        else:
+            serialized_rules.append(rule.text)
+    return serialized_rules
+
+
+def minify_css(css):
+    """
+    Removes the comments and the whitespace of a stylesheet which doesn't change
+    its meaning, leaving strings untouched.
+    """
+    return "".join(_minify_rules(parse_stylesheet(css)))
+
+
+def _minify_rules(rules):
+    for rule in rules:
+        if isinstance(rule, StyleRule):
+            selectors = ",".join(
+                _collapse_whitespace(selector, CSS_SELECTOR_PUNCTUATION)
+                for selector, _ in rule.selectors
+            )
+            declarations = _collapse_whitespace(
+                rule.declarations, CSS_DECLARATION_PUNCTUATION
+            ).rstrip(";")
+            yield f"{selectors}{{{declarations}}}"
+        elif isinstance(rule, GroupingRule):
+            prelude = _collapse_whitespace(rule.prelude, CSS_PRELUDE_PUNCTUATION)
+            yield f"{prelude}{{{''.join(_minify_rules(rule.rules))}}}"
+        else:
+            text = _collapse_whitespace(rule.text, CSS_DECLARATION_PUNCTUATION)
+            yield text.replace(";}", "}")
+
+
+def resolve_references(css, base_url, resolve_import):
+    """
+    Rewrites the relative 'url()' references of a stylesheet to absolute URLs
+    against its 'base_url', replaces its '@import' rules by the CSS returned by
+    'resolve_import(url, media)', and drops its '@charset' rule.
+    """
+
+    def replace_reference(match):
+        if match.group("url") is not None:
+            quote, url = _unquote_url(match.group("url"))
+            if not url or url.startswith(("#", "data:")) or urlsplit(url).scheme:
+                return match.group()
+            return f"url({quote}{urljoin(base_url, url)}{quote})"
+
+        import_url = match.group("import_url") or match.group("import_string")
+        if import_url is not None:
+            _, url = _unquote_url(import_url)
+            return resolve_import(urljoin(base_url, url), match.group("media").strip())
+
+        if match.group().startswith("@"):
+            return ""
+        return match.group()
+
+    return CSS_REFERENCE.sub(replace_reference, css)
+
+
+def import_urls(css, base_url):
+    """
+    Returns the absolute URLs of the stylesheets imported by a stylesheet.
+    """
+    urls = []
+
+    def collect_import(url, media):
+        urls.append(url)
+        return ""
+
+    resolve_references(css, base_url, collect_import)
+    return urls
+
+
+def _unquote_url(url):
+    if url[:1] in ("'", '"'):
+        return url[0], url[1:-1]
+    return "", url
+
+
+def _collapse_whitespace(css, punctuation):
+    """
+    Collapses the whitespace of a piece of CSS out of its strings, removing it
+    around the given punctuation.
+    """
+    collapsed = []
+    for token in CSS_STRING_SPLIT.split(css):
+        if token.startswith(("'", '"')):
+            collapsed.append(token)
+        else:
+            collapsed.append(punctuation.sub(r"\1", re.sub(r"\s+", " ", token)))
+    return "".join(collapsed).strip()
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+import django
+from django import db
+from django.conf import settings
+from django.test import Client
+from django.urls import get_resolver
+from django.utils.module_loading import import_string
+
+from . import utils
+from .conf import DEFAULTS, get_setting
+from .images import _strip_url_prefix
+from .pipeline import pipeline_fingerprint
+from .storage import find_static_file
+
+
+MANIFEST_NAME = "amp-manifest.json"
+
+# Pages sent at once to each worker process, at most.
+MAX_CHUNK_SIZE = 100
+
+_worker_client = None
+
+
+def urlpattern_paths(urlconf=None):
+    """
+    Returns the paths of all URL patterns without parameters, leaving out
+    namespaced ones such as the admin site.
+    """
+    resolver = get_resolver(urlconf)
+    paths = set()
+    for key, entries in resolver.reverse_dict.lists():
+        for possibilities, _, _, _ in entries:
+            for path_format, params in possibilities:
+                if not params:
+                    paths.add(f"/{path_format % {}}")
+    return sorted(paths)
+
+
+def sitemap_paths(sitemaps):
+    """
+    Returns the paths of all locations of a dict of sitemaps, as given to the
+    'django.contrib.sitemaps' views, or of its dotted import path.
+    """
+    if isinstance(sitemaps, str):
+        sitemaps = import_string(sitemaps)
+
+    paths = set()
+    for sitemap in sitemaps.values():
+        if callable(sitemap):
+            sitemap = sitemap()
+        for item in sitemap.items():
+            paths.add(urlsplit(sitemap.location(item)).path or "/")
+    return sorted(paths)
+
+
+def export_pages(paths, output_dir, host="localhost", workers=None, full=False):
+    """
+    Renders the canonical pages of the given paths, and writes their AMP version to
+    'output_dir' as '<path>/index.html', using a process per core by default.
+
+    A manifest keeps the canonical content digest of every page, the versions of the
+    static stylesheets and images it depends on, and of the transform, stages and
+    settings it was exported by. Pages whose canonical content, dependencies and
+    transform are the same are not transformed again, unless 'full' is given.
+    Returns the status of every path: 'exported', 'unchanged', 'skipped' for non-HTML
+    or unsuccessful responses, or 'failed: <error>'.
+
+    The pages of the previous export which aren't given anymore are deleted, with
+    the 'removed' status, as are the ones now skipped. Pages failing to be exported
+    are kept as they were.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    previous_manifest = _read_manifest(manifest_path)
+    manifest = {} if full else previous_manifest
+
+    version = _transform_version()
+    tasks = [(path, output_dir, manifest.get(path), version) for path in paths]
+    workers = workers or os.cpu_count()
+    chunk_size = max(1, min(MAX_CHUNK_SIZE, len(tasks) // (workers * 4)))
+
+    # Forked workers must not share the database connections.
+    db.connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(os.environ.get("DJANGO_SETTINGS_MODULE"), host),
+    ) as executor:
+        results = list(executor.map(_export_page, tasks, chunksize=chunk_size))
+
+    statuses = {}
+    new_manifest = {}
+    for path, status, entry in results:
+        statuses[path] = status
+        if entry is not None:
+            new_manifest[path] = entry
+        elif status.startswith("failed") and path in previous_manifest:
+            new_manifest[path] = previous_manifest[path]
+
+    # Paths such as '/page' and '/page/' share the same file.
+    output_paths = {_output_path(output_dir, path) for path in new_manifest}
+    for path in previous_manifest.keys() - new_manifest.keys():
+        statuses.setdefault(path, "removed")
+        try:
+            output_path = _output_path(output_dir, path)
+        except ValueError:
+            continue
+        if output_path not in output_paths:
+            _remove_file(output_path, output_dir)
+
+    _write_file(manifest_path, json.dumps(new_manifest, sort_keys=True).encode())
+    return statuses
+
+
+def _transform_version():
+    """
+    Returns the version of the AMP transform, of the 'AUTO_AMP_PIPELINE' stages and
+    of the other AMP settings pages are exported by.
+    """
+    amp_settings = sorted(
+        (name, get_setting(name)) for name in DEFAULTS if name != "PIPELINE"
+    )
+    settings_digest = hashlib.blake2b(repr(amp_settings).encode(), digest_size=8)
+    return (
+        f"{utils.AMP_TRANSFORM_VERSION}:{pipeline_fingerprint()}:"
+        f"{settings_digest.hexdigest()}"
+    )
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _init_worker(settings_module, host):
+    """
+    Sets Django up on spawned worker processes, and the client rendering pages.
+
+    Forked worker processes inherit the thread pools of the parent process without
+    their threads, and its open connections, so they get their own.
+    """
+    global _worker_client
+
+    if not settings.configured:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+        django.setup()
+
+    db.connections.close_all()
+    utils._reset_worker_pools()
+    _worker_client = Client(HTTP_HOST=host)
+
+
+def _export_page(task):
+    """
+    Renders a canonical page and writes its AMP version, unless the manifest entry
+    of the page shows it is already up to date. Returns the page path, its status
+    and its new manifest entry.
+    """
+    path, output_dir, entry, version = task
+    try:
+        output_path = _output_path(output_dir, path)
+        response = _worker_client.get(path)
+        if response.status_code != 200 or not response.get(
+            "Content-Type", ""
+        ).startswith("text/html"):
+            return path, "skipped", None
+
+        content = (
+            b"".join(response.streaming_content)
+            if response.streaming
+            else response.content
+        )
+        digest = hashlib.blake2b(content).hexdigest()
+
+        changed_dependencies = _changed_dependencies(entry)
+        if (
+            entry is not None
+            and entry["digest"] == digest
+            and entry.get("version") == version
+            and not changed_dependencies
+            and os.path.exists(output_path)
+        ):
+            return path, "unchanged", entry
+
+        # Changed images are measured again instead of reusing their cached size.
+        for uri in changed_dependencies:
+            utils.image_info_cache.delete(uri)
+
+        parsed_amp = utils.parse_html(content, response.charset)
+        tags = utils.collect_tags(parsed_amp)
+        dependencies = _static_dependencies(tags)
+        amp_content = utils.apply_amp_tags(
+            parsed_amp, path, tags, content=content, encoding=utils.AMP_CHARSET
+        )
+
+        _write_file(output_path, amp_content)
+        entry = {"digest": digest, "dependencies": dependencies, "version": version}
+        return path, "exported", entry
+    except Exception as error:
+        return path, f"failed: {error!r}", None
+
+
+def _output_path(output_dir, path):
+    """
+    Returns the file an AMP page is written to, refusing paths escaping
+    'output_dir'.
+    """
+    output_dir = os.path.abspath(output_dir)
+    output_path = os.path.normpath(
+        os.path.join(output_dir, unquote(path).strip("/"), "index.html")
+    )
+    if not output_path.startswith(f"{output_dir}{os.sep}"):
+        raise ValueError(f"Path {path!r} is outside of the output directory")
+    return output_path
+
+
+def _static_dependencies(tags):
+    """
+    Returns the versions of the local static stylesheets, with the ones they
+    import, and unsized images of a page, by their URI.
+    """
+    uris = [
+        uri
+        for stylesheet in tags["stylesheets"]
+        for uri in utils.stylesheet_dependencies(stylesheet["href"])
+    ]
+    uris.extend(utils.unsized_image_sources(tags))
+    return {
+        uri: _static_file_version(uri)
+        for uri in uris
+        if _strip_url_prefix(uri, settings.STATIC_URL) is not None
+    }
+
+
+def _static_file_version(uri):
+    """
+    Returns the version of the static file a URI points to as stored in the
+    manifest, or None when it doesn't exist.
+    """
+    static_path = _strip_url_prefix(uri, settings.STATIC_URL)
+    filesystem_path = find_static_file(static_path)
+    if filesystem_path is None:
+        return None
+
+    version = utils._static_file_version(static_path, filesystem_path)
+    return list(version) if isinstance(version, tuple) else version
+
+
+def _changed_dependencies(entry):
+    if entry is None:
+        return []
+    return [
+        uri
+        for uri, version in entry["dependencies"].items()
+        if _static_file_version(uri) != version
+    ]
+
+
+def _write_file(path, content):
+    """
+    Writes a file atomically, so the server never reads it half written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.tmp{os.getpid()}"
+    with open(temporary_path, "wb") as output_file:
+        output_file.write(content)
+    os.replace(temporary_path, path)
+
+
+def _remove_file(path, output_dir):
+    """
+    Removes a file, and the directories left empty up to 'output_dir'.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+
+    output_dir = os.path.abspath(output_dir)
+    directory = os.path.dirname(path)
+    while directory != output_dir:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
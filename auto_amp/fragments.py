@@ -0,0 +1,159 @@
+import hashlib
+import re
+from collections import namedtuple
+from contextvars import ContextVar
+
+from bs4 import BeautifulSoup
+from django.core.cache import caches
+
+from .conf import get_setting
+from .css import document_features
+from .pipeline import get_pipeline, pipeline_fingerprint
+from .utils import (
+    AMP_CHARSET,
+    AMP_TRANSFORM_VERSION,
+    collect_tags,
+    recording_image_fallbacks,
+    serialize_html,
+)
+
+
+AMP_FRAGMENT_PLACEHOLDER = "<!--amp-fragment:{}-->"
+
+AMP_FRAGMENT_PLACEHOLDER_PATTERN = re.compile(r"<!--amp-fragment:([0-9a-f]{32})-->")
+
+AMP_FRAGMENT_PLACEHOLDER_BYTES_PATTERN = re.compile(
+    AMP_FRAGMENT_PLACEHOLDER_PATTERN.pattern.encode()
+)
+
+AmpFragment = namedtuple("AmpFragment", ["token", "content", "stylesheets", "features"])
+
+_collected_fragments = ContextVar("auto_amp_fragments", default=None)
+
+
+class CollectedFragments(dict):
+    """
+    AMP fragments collected while an AMP page is rendered, by token, and whether the
+    page was rendered from templates compiled by 'auto_amp.loaders.Loader'.
+    """
+
+    compiled = False
+
+
+def collect_amp_fragments():
+    """
+    Makes the 'amp_cache' template tag render placeholders of AMP fragments in the
+    current context, and returns the dict the rendered fragments are collected in
+    by token.
+    """
+    fragments = CollectedFragments()
+    _collected_fragments.set(fragments)
+    return fragments
+
+
+def stop_collecting_amp_fragments():
+    """
+    Makes the 'amp_cache' template tag render its content as is again.
+    """
+    _collected_fragments.set(None)
+
+
+def rendering_amp_page():
+    """
+    Returns whether an AMP page is being rendered in the current context.
+    """
+    return _collected_fragments.get() is not None
+
+
+def mark_compiled_amp_page():
+    """
+    Records that the AMP page rendered in the current context is rendered from
+    compiled templates.
+    """
+    fragments = _collected_fragments.get()
+    if fragments is not None:
+        fragments.compiled = True
+
+
+def render_amp_fragment(key, render):
+    """
+    Returns the placeholder of the AMP fragment cached under 'key' while fragments
+    are collected, transforming the content given by 'render()' and keeping it in
+    the 'AUTO_AMP_FRAGMENT_CACHE_ALIAS' Django cache when it isn't there yet, unless
+    its images got the fallback attributes. Entries are kept by transform version
+    and stages too. Otherwise, returns the rendered content.
+    """
+    fragments = _collected_fragments.get()
+    if fragments is None:
+        return render()
+
+    cache = caches[get_setting("FRAGMENT_CACHE_ALIAS")]
+    cache_key = (
+        f"auto_amp:fragment:{AMP_TRANSFORM_VERSION}:{pipeline_fingerprint()}:{key}"
+    )
+    fragment = cache.get(cache_key)
+    if fragment is None:
+        with recording_image_fallbacks() as image_fallbacks:
+            fragment = transform_amp_fragment(render())
+        if not image_fallbacks:
+            cache.set(cache_key, fragment, get_setting("FRAGMENT_CACHE_TIMEOUT"))
+
+    fragments[fragment.token] = fragment
+    return AMP_FRAGMENT_PLACEHOLDER.format(fragment.token)
+
+
+def transform_amp_fragment(content):
+    """
+    Applies the fragment stages of 'AUTO_AMP_PIPELINE' to an HTML fragment, and
+    returns it as an 'AmpFragment'. Its stylesheets are removed and kept to be
+    merged into the style of the documents, along with its features.
+
+    Fragments are parsed by 'html.parser', which doesn't wrap them in a document,
+    and stages get no 'path'.
+    """
+    parsed_amp = BeautifulSoup(content, "html.parser")
+    tags = collect_tags(parsed_amp)
+
+    stylesheets = []
+    for stylesheet in tags["stylesheets"]:
+        stylesheets.append(stylesheet["href"])
+        stylesheet.extract()
+
+    stage_arguments = {"path": None, "tags": tags}
+    for stage in get_pipeline():
+        if stage.fragment:
+            parsed_amp = stage.func(
+                parsed_amp, **{name: stage_arguments[name] for name in stage.arguments}
+            )
+
+    features = document_features(parsed_amp)
+    amp_content = serialize_html(parsed_amp)
+    # Stylesheets are part of the token, as placeholders are part of the canonical
+    # content the AMP output is cached by.
+    token = hashlib.blake2b(amp_content.encode(AMP_CHARSET), digest_size=16)
+    for href in stylesheets:
+        token.update(f"\n{href}".encode(AMP_CHARSET))
+    return AmpFragment(token.hexdigest(), amp_content, tuple(stylesheets), features)
+
+
+def splice_amp_fragments(amp_content, fragments, encoding=AMP_CHARSET):
+    """
+    Replaces the placeholders of an AMP document, as text or bytes encoded to
+    'encoding', with the content of the given fragments by token.
+    """
+    if not fragments:
+        return amp_content
+
+    if isinstance(amp_content, bytes):
+        contents = {
+            token.encode(): fragment.content.encode(encoding, "xmlcharrefreplace")
+            for token, fragment in fragments.items()
+        }
+        pattern = AMP_FRAGMENT_PLACEHOLDER_BYTES_PATTERN
+    else:
+        contents = {token: fragment.content for token, fragment in fragments.items()}
+        pattern = AMP_FRAGMENT_PLACEHOLDER_PATTERN
+    # Placeholders of unknown fragments are left as they are.
+    return pattern.sub(
+        lambda match: contents.get(match.group(1), match.group(0)), amp_content
+    )
@@ -0,0 +1,188 @@
+import re
+import struct
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+
+
+# Bytes read to find the root 'svg' tag of SVG images.
+SVG_HEADER_SIZE = 4096
+
+# Start of frame markers, all of 0xC0-0xCF but DHT, JPG and DAC.
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Markers without a length nor payload: TEM, RST0-7, SOI and EOI.
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xDA)}
+
+SVG_TAG = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
+
+SVG_LENGTH_ATTRIBUTE = r"""(?<![\w-]){}\s*=\s*["']\s*(\d+(?:\.\d+)?)\s*(?:px)?\s*["']"""
+
+SVG_WIDTH_ATTRIBUTE = re.compile(SVG_LENGTH_ATTRIBUTE.format("width"))
+
+SVG_HEIGHT_ATTRIBUTE = re.compile(SVG_LENGTH_ATTRIBUTE.format("height"))
+
+SVG_VIEWBOX_ATTRIBUTE = re.compile(
+    r"""(?<![\w-])viewBox\s*=\s*["']\s*"""
+    r"""[-\d.]+[\s,]+[-\d.]+[\s,]+(\d+(?:\.\d+)?)[\s,]+(\d+(?:\.\d+)?)\s*["']""",
+    re.IGNORECASE,
+)
+
+
+class _HeaderReader:
+    """
+    Reads a file sequentially, starting with the bytes already read from it.
+    """
+
+    def __init__(self, image_file, head=b""):
+        self.image_file = image_file
+        self.buffer = head
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.image_file.read(size - len(self.buffer))
+            if not data:
+                raise EOFError
+
+            self.buffer += data
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def read_image_size(image_file):
+    """
+    Reads the dimensions of a PNG, GIF, JPEG, WebP or SVG image reading as little as
+    possible of its content. Returns None for other formats or invalid images.
+    """
+    head = image_file.read(32)
+
+    try:
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+
+        if head.startswith(b"\xff\xd8"):
+            return _read_jpeg_size(_HeaderReader(image_file, head[2:]))
+
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return _read_webp_size(head)
+    except (struct.error, EOFError):
+        return None
+
+    return _read_svg_size(head + image_file.read(SVG_HEADER_SIZE))
+
+
+def _read_jpeg_size(reader):
+    """
+    Scans the JPEG segments until the start of frame one, which holds the image
+    dimensions.
+    """
+    while True:
+        if reader.read(1) != b"\xff":
+            continue
+
+        marker = reader.read(1)[0]
+        while marker == 0xFF:
+            marker = reader.read(1)[0]
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+
+        (length,) = struct.unpack(">H", reader.read(2))
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">xHH", reader.read(5))
+            return width, height
+
+        reader.read(length - 2)
+
+
+def _read_webp_size(head):
+    """
+    Reads the dimensions of lossy, lossless and extended WebP images.
+    """
+    chunk = head[12:16]
+
+    if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+
+    if chunk == b"VP8L" and head[20] == 0x2F:
+        (bits,) = struct.unpack("<I", head[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+
+    if chunk == b"VP8X":
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+        return width, height
+
+    return None
+
+
+def _read_svg_size(head):
+    """
+    Reads the dimensions of a SVG image from the root tag 'width' and 'height'
+    attributes, falling back to its 'viewBox'.
+    """
+    svg_tag = SVG_TAG.search(head)
+    if svg_tag is None:
+        return None
+
+    svg_tag = svg_tag.group().decode("utf-8", errors="ignore")
+    width = SVG_WIDTH_ATTRIBUTE.search(svg_tag)
+    height = SVG_HEIGHT_ATTRIBUTE.search(svg_tag)
+    if width and height:
+        return round(float(width.group(1))), round(float(height.group(1)))
+
+    viewbox = SVG_VIEWBOX_ATTRIBUTE.search(svg_tag)
+    if viewbox:
+        return round(float(viewbox.group(1))), round(float(viewbox.group(2)))
+
+    return None
+
+
+def _strip_url_prefix(uri, prefix):
+    """
+    Returns the storage path of a URI under a prefix, or None when it isn't under it.
+    """
+    if not prefix or not uri.startswith(prefix):
+        return None
+
+    path = uri[len(prefix) :].split("?", 1)[0].split("#", 1)[0]
+    return unquote(path)
+
+
+def open_local_image(uri):
+    """
+    Opens the static or media file a URI points to, or returns None when it doesn't
+    point to one, including paths out of the storage locations.
+    """
+    try:
+        return _open_storage_file(uri)
+    except SuspiciousFileOperation:
+        return None
+
+
+def _open_storage_file(uri):
+    # The static files index is kept by the storage module, which imports this one.
+    from .storage import find_static_file
+
+    static_path = _strip_url_prefix(uri, settings.STATIC_URL)
+    if static_path is not None:
+        filesystem_path = find_static_file(static_path)
+        if filesystem_path:
+            return open(filesystem_path, "rb")
+        if staticfiles_storage.exists(static_path):
+            return staticfiles_storage.open(static_path)
+        return None
+
+    media_path = _strip_url_prefix(uri, settings.MEDIA_URL)
+    if media_path is not None and default_storage.exists(media_path):
+        return default_storage.open(media_path)
+
+    return None
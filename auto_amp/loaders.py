@@ -0,0 +1,47 @@
+from django.template.loaders import cached
+
+from .compiler import AMP_HEAD_MARKER, compile_amp_template
+from .fragments import mark_compiled_amp_page, rendering_amp_page
+from .pipeline import is_default_pipeline
+
+
+class Loader(cached.Loader):
+    """
+    Cached template loader which also compiles the AMP twin of every template, once,
+    and loads it instead of the template while AMP pages are rendered. It wraps the
+    given loaders as Django's cached loader does:
+
+        "loaders": [
+            (
+                "auto_amp.loaders.Loader",
+                [
+                    "django.template.loaders.filesystem.Loader",
+                    "django.template.loaders.app_directories.Loader",
+                ],
+            ),
+        ]
+
+    Templates are only compiled for the default 'AUTO_AMP_PIPELINE' stages. With
+    other stages, AMP pages are rendered from the templates and fully transformed.
+    """
+
+    def get_template(self, template_name, skip=None):
+        template = super().get_template(template_name, skip)
+        if self._compiles_templates() and AMP_HEAD_MARKER in template.source:
+            mark_compiled_amp_page()
+        return template
+
+    def get_contents(self, origin):
+        contents = super().get_contents(origin)
+        if self._compiles_templates():
+            return compile_amp_template(contents)
+        return contents
+
+    def cache_key(self, template_name, skip=None):
+        key = super().cache_key(template_name, skip)
+        if self._compiles_templates():
+            return f"amp:{key}"
+        return key
+
+    def _compiles_templates(self):
+        return rendering_amp_page() and is_default_pipeline()
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...export import export_pages, sitemap_paths, urlpattern_paths
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the AMP version of canonical pages to a directory, transforming only "
+        "the pages changed since the last export and removing the ones left out."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_dir", help="Directory to write the AMP pages to.")
+        parser.add_argument(
+            "--path",
+            action="append",
+            dest="paths",
+            help="Canonical path to export, instead of all URL patterns paths.",
+        )
+        parser.add_argument(
+            "--sitemaps",
+            help="Dotted path to a dict of sitemaps whose locations are exported.",
+        )
+        parser.add_argument(
+            "--workers", type=int, help="Worker processes, one per core by default."
+        )
+        parser.add_argument(
+            "--host", help="Host of the rendering requests, from ALLOWED_HOSTS."
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Transforms all pages, ignoring the previous export manifest.",
+        )
+
+    def handle(self, *args, **options):
+        paths = options["paths"] or []
+        if options["sitemaps"]:
+            paths.extend(sitemap_paths(options["sitemaps"]))
+        if not paths:
+            paths = urlpattern_paths()
+        if not paths:
+            raise CommandError("No pages to export.")
+
+        statuses = export_pages(
+            sorted(set(paths)),
+            options["output_dir"],
+            host=options["host"] or _default_host(),
+            workers=options["workers"],
+            full=options["full"],
+        )
+
+        counts = {
+            "exported": 0,
+            "unchanged": 0,
+            "skipped": 0,
+            "removed": 0,
+            "failed": 0,
+        }
+        for path, status in statuses.items():
+            if status.startswith("failed"):
+                self.stderr.write(f"{path}: {status}")
+                counts["failed"] += 1
+            else:
+                counts[status] += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Exported {exported} pages, {unchanged} unchanged, "
+                "{skipped} skipped, {removed} removed, {failed} failed.".format(
+                    **counts
+                )
+            )
+        )
+
+
+def _default_host():
+    for host in settings.ALLOWED_HOSTS:
+        if host != "*":
+            return host.lstrip(".")
+    return "localhost"
@@ -0,0 +1,121 @@
+import time
+
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from .conf import get_setting
+from .fragments import (
+    collect_amp_fragments,
+    splice_amp_fragments,
+    stop_collecting_amp_fragments,
+)
+from .timing import get_timer, report_timings
+from .views import add_amp_tags_cached, set_amp_charset
+
+
+def get_canonical_path(request):
+    """
+    Returns the canonical path of an AMP request, or None when the request isn't for
+    an AMP page. AMP requests are recognized by the 'AUTO_AMP_PATH_PREFIX' path
+    prefix, the 'AUTO_AMP_QUERY_PARAM' query parameter or the 'AUTO_AMP_ACCEPT_TYPE'
+    media type accepted by the 'Accept' header.
+    """
+    path_prefix = get_setting("PATH_PREFIX")
+    if path_prefix and (
+        request.path_info == path_prefix
+        or request.path_info.startswith(f"{path_prefix}/")
+    ):
+        return request.path_info[len(path_prefix) :] or "/"
+
+    query_param = get_setting("QUERY_PARAM")
+    if query_param and query_param in request.GET:
+        return request.path_info
+
+    accept_type = get_setting("ACCEPT_TYPE")
+    if accept_type and _accepts(request.META.get("HTTP_ACCEPT", ""), accept_type):
+        return request.path_info
+
+    return None
+
+
+def _accepts(accept_header, media_type):
+    """
+    Checks whether an 'Accept' header lists a media type, as itself and not through
+    a wildcard, with a non-zero quality.
+    """
+    for media_range in accept_header.split(","):
+        range_type, *params = media_range.split(";")
+        if range_type.strip().lower() != media_type.lower():
+            continue
+
+        quality = 1
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        return quality > 0
+    return False
+
+
+class AutoAmpMiddleware(MiddlewareMixin):
+    """
+    Serves AMP pages by transforming the responses of their canonical views in place,
+    instead of resolving and calling them again from the 'canonical_to_amp' view.
+
+    AMP requests are routed to the canonical view through their canonical path, and
+    only successful, non-streaming HTML responses are transformed. Caching and
+    compression middlewares placed before this one handle the AMP output.
+    """
+
+    def process_request(self, request):
+        request.amp_canonical_path = get_canonical_path(request)
+        if request.amp_canonical_path is not None:
+            request.path_info = request.amp_canonical_path
+            request.amp_timer = get_timer()
+            request.amp_started_at = time.perf_counter()
+            request.amp_fragments = collect_amp_fragments()
+
+    def process_response(self, request, response):
+        if get_setting("ACCEPT_TYPE"):
+            patch_vary_headers(response, ["Accept"])
+
+        canonical_path = getattr(request, "amp_canonical_path", None)
+        if canonical_path is None:
+            return response
+
+        stop_collecting_amp_fragments()
+        if response.streaming:
+            return response
+
+        if response.status_code != 200 or not response.get(
+            "Content-Type", ""
+        ).startswith("text/html"):
+            # Responses left as they are, such as error pages, may hold fragments too.
+            if request.amp_fragments:
+                response.content = splice_amp_fragments(
+                    response.content, request.amp_fragments, response.charset
+                )
+                self._update_content_length(response)
+            return response
+
+        timer = request.amp_timer
+        timer.add("canonical", time.perf_counter() - request.amp_started_at)
+        response.content = add_amp_tags_cached(
+            response.content,
+            canonical_path,
+            timer,
+            response.charset,
+            request.amp_fragments,
+        )
+        set_amp_charset(response)
+        self._update_content_length(response)
+
+        report_timings(timer, request, canonical_path, response)
+        return response
+
+    def _update_content_length(self, response):
+        if response.has_header("Content-Length"):
+            response["Content-Length"] = str(len(response.content))
@@ -0,0 +1,134 @@
+import hashlib
+import inspect
+import re
+from collections import namedtuple
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .conf import DEFAULTS, get_setting
+
+
+# Stage arguments given by name when the stage function accepts them.
+STAGE_ARGUMENTS = ("path", "tags")
+
+Stage = namedtuple("Stage", ["name", "func", "arguments", "precondition", "fragment"])
+
+_pipeline = None
+
+_default_stage_funcs = None
+
+
+def amp_stage(name=None, requires=None, fragment=False):
+    """
+    Declares an AMP stage: the name it is timed under, defaulting to the function
+    name, and a 'requires(content)' precondition on the raw document, which skips
+    the stage without walking the tree when false. Stages working on a document
+    fragment alone, without its 'html' or 'head' tags, are declared 'fragment' to
+    also be applied to the fragments of the 'amp_cache' template tag.
+    """
+
+    def decorator(func):
+        func.amp_stage_name = name or func.__name__
+        func.amp_stage_requires = requires
+        func.amp_stage_fragment = fragment
+        return func
+
+    return decorator
+
+
+def contains(*markers):
+    """
+    Returns a precondition which is true when the raw document, bytes or text,
+    contains any of the markers, ignoring case.
+    """
+    pattern = "|".join(re.escape(marker) for marker in markers)
+    text_pattern = re.compile(pattern, re.IGNORECASE)
+    bytes_pattern = re.compile(pattern.encode(), re.IGNORECASE)
+
+    def precondition(content):
+        if isinstance(content, bytes):
+            return bytes_pattern.search(content) is not None
+        return text_pattern.search(content) is not None
+
+    return precondition
+
+
+def load_pipeline():
+    """
+    Resolves and validates the stages listed on 'AUTO_AMP_PIPELINE', as callables
+    or their dotted paths, and keeps them to be run on every page.
+    """
+    global _pipeline
+
+    stages = []
+    for stage in get_setting("PIPELINE"):
+        func = stage
+        if isinstance(stage, str):
+            try:
+                func = import_string(stage)
+            except ImportError as error:
+                raise ImproperlyConfigured(
+                    f"AUTO_AMP_PIPELINE stage '{stage}' could not be imported: {error}"
+                )
+
+        if not callable(func):
+            raise ImproperlyConfigured(
+                f"AUTO_AMP_PIPELINE stage '{stage}' is not callable."
+            )
+
+        parameters = inspect.signature(func).parameters
+        stages.append(
+            Stage(
+                getattr(func, "amp_stage_name", func.__name__),
+                func,
+                tuple(name for name in STAGE_ARGUMENTS if name in parameters),
+                getattr(func, "amp_stage_requires", None),
+                getattr(func, "amp_stage_fragment", False),
+            )
+        )
+
+    _pipeline = stages
+    return _pipeline
+
+
+def get_pipeline():
+    """
+    Returns the resolved AMP stages, resolving them if not done at startup.
+    """
+    if _pipeline is None:
+        return load_pipeline()
+    return _pipeline
+
+
+def is_default_pipeline():
+    """
+    Returns whether the resolved AMP stages are the default ones.
+    """
+    global _default_stage_funcs
+
+    if _default_stage_funcs is None:
+        _default_stage_funcs = [import_string(path) for path in DEFAULTS["PIPELINE"]]
+    return [stage.func for stage in get_pipeline()] == _default_stage_funcs
+
+
+def pipeline_fingerprint():
+    """
+    Returns a digest of the resolved AMP stages, which changes whenever stages are
+    added, removed, reordered or replaced.
+    """
+    stages = "\n".join(
+        f"{stage.name}:{stage.func.__module__}.{stage.func.__qualname__}"
+        for stage in get_pipeline()
+    )
+    return hashlib.blake2b(stages.encode(), digest_size=8).hexdigest()
+
+
+@receiver(setting_changed)
+def reset_pipeline(setting, **kwargs):
+    global _pipeline
+
+    if setting == "AUTO_AMP_PIPELINE":
+        _pipeline = None
@@ -0,0 +1,321 @@
+import hashlib
+import http.client
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlsplit
+
+from django.core.cache import caches
+from django.http.request import validate_host
+from django.utils.http import parse_http_date_safe
+
+from .cache import LRUCache
+from .conf import get_setting
+
+
+logger = logging.getLogger(__name__)
+
+# Largest remote stylesheet inlined, in bytes.
+REMOTE_STYLESHEET_MAX_SIZE = 1024 * 1024
+
+# Redirects followed to fetch a remote stylesheet, at most.
+MAX_REDIRECTS = 3
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+REQUEST_HEADERS = {
+    "Accept": "text/css,*/*;q=0.1",
+    "Accept-Encoding": "identity",
+    "User-Agent": "django-auto-amp",
+}
+
+RemoteStylesheet = namedtuple(
+    "RemoteStylesheet", ["content", "etag", "last_modified", "expires_at"]
+)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP connections. Up to 'max_idle' idle
+    connections are kept by scheme, host and port, so requests to a same host reuse
+    them instead of opening a connection each.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def request(self, url, headers, timeout, max_size):
+        """
+        Sends a GET request and returns the response status, headers and body. Bodies
+        bigger than 'max_size' bytes raise ValueError.
+        """
+        split_url = urlsplit(url)
+        key = split_url.scheme, split_url.hostname, split_url.port
+        target = split_url.path or "/"
+        if split_url.query:
+            target = f"{target}?{split_url.query}"
+
+        connection = self._acquire(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = _new_connection(key, timeout)
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(
+                    "GET", target, headers={**REQUEST_HEADERS, **headers}
+                )
+                response = connection.getresponse()
+                body = _read_body(response, max_size)
+            except (http.client.RemoteDisconnected, ConnectionResetError):
+                connection.close()
+                # Idle connections may have been closed by the server meanwhile.
+                if not reused:
+                    raise
+                connection, reused = None, False
+                continue
+            except BaseException:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+            return response.status, response.headers, body
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _acquire(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            return connections.pop() if connections else None
+
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+def _new_connection(key, timeout):
+    scheme, host, port = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+def _read_body(response, max_size):
+    content_length = response.getheader("Content-Length")
+    if content_length is not None and int(content_length) > max_size:
+        raise ValueError(f"Response of {content_length} bytes is too big")
+
+    body = response.read(max_size + 1)
+    if len(body) > max_size:
+        raise ValueError(f"Response is bigger than {max_size} bytes")
+    return body
+
+
+connection_pool = ConnectionPool(get_setting("REMOTE_STYLESHEET_WORKERS"))
+
+remote_stylesheet_cache = LRUCache(get_setting("STYLESHEET_CACHE_SIZE"))
+
+_fetch_executor = None
+
+_fetch_executor_lock = threading.Lock()
+
+
+def remote_stylesheet_url(href):
+    """
+    Returns the absolute URL of a stylesheet href when it points to a host of
+    'AUTO_AMP_REMOTE_STYLESHEET_HOSTS', or None.
+    """
+    url = urljoin("https:", href) if href.startswith("//") else href
+    split_url = urlsplit(url)
+    if split_url.scheme not in ("http", "https") or not split_url.hostname:
+        return None
+    if not validate_host(split_url.hostname, get_setting("REMOTE_STYLESHEET_HOSTS")):
+        return None
+    return url
+
+
+def fetch_remote_stylesheet(href):
+    """
+    Returns the content of a remote stylesheet, or None when it isn't allowed or
+    couldn't be fetched.
+
+    Stylesheets are kept in 'remote_stylesheet_cache' and in the
+    'AUTO_AMP_REMOTE_STYLESHEET_CACHE_ALIAS' Django cache, honouring their
+    'Cache-Control' or 'Expires' headers. Once stale, they are revalidated with
+    their 'ETag' or 'Last-Modified' headers, and kept when fetching them fails.
+    """
+    url = remote_stylesheet_url(href)
+    if url is None:
+        return None
+
+    shared_cache = caches[get_setting("REMOTE_STYLESHEET_CACHE_ALIAS")]
+    cache_key = f"auto_amp:remote_stylesheet:{hashlib.sha1(url.encode()).hexdigest()}"
+
+    cached = remote_stylesheet_cache.get(url)
+    if cached is None or cached.expires_at <= time.time():
+        cached = shared_cache.get(cache_key, cached)
+    if cached is not None and cached.expires_at > time.time():
+        remote_stylesheet_cache.set(url, cached, len(cached.content))
+        return cached.content
+
+    try:
+        stylesheet, cacheable = _request_stylesheet(url, cached)
+    except (OSError, http.client.HTTPException, ValueError) as error:
+        logger.warning("Remote stylesheet %s couldn't be fetched: %r", url, error)
+        return cached and cached.content
+
+    if stylesheet is None:
+        return cached and cached.content
+
+    if cacheable:
+        remote_stylesheet_cache.set(url, stylesheet, len(stylesheet.content))
+        shared_cache.set(
+            cache_key, stylesheet, get_setting("REMOTE_STYLESHEET_CACHE_TIMEOUT")
+        )
+    return stylesheet.content
+
+
+def _request_stylesheet(url, cached):
+    """
+    Requests a remote stylesheet, conditionally when a cached version is given,
+    following redirects to allowed hosts, unless from HTTPS to HTTP. Returns the
+    fetched or revalidated stylesheet, None on unsuccessful responses, and whether
+    it can be cached.
+    """
+    headers = {}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached is not None and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    for _ in range(MAX_REDIRECTS + 1):
+        status, response_headers, body = connection_pool.request(
+            url,
+            headers,
+            get_setting("REMOTE_STYLESHEET_TIMEOUT"),
+            REMOTE_STYLESHEET_MAX_SIZE,
+        )
+        location = response_headers.get("Location")
+        if status not in REDIRECT_STATUSES or location is None:
+            break
+
+        redirect_url = remote_stylesheet_url(urljoin(url, location))
+        # Stylesheets fetched over HTTPS aren't downgraded to HTTP.
+        if redirect_url is None or (
+            urlsplit(url).scheme == "https" and urlsplit(redirect_url).scheme != "https"
+        ):
+            return None, False
+        url = redirect_url
+    else:
+        return None, False
+
+    lifetime = _freshness_lifetime(response_headers)
+    expires_at = time.time() + (lifetime or 0)
+    if status == 304 and cached is not None:
+        stylesheet = cached._replace(
+            etag=response_headers.get("ETag", cached.etag),
+            last_modified=response_headers.get("Last-Modified", cached.last_modified),
+            expires_at=expires_at,
+        )
+    elif status == 200:
+        try:
+            content = body.decode(
+                response_headers.get_content_charset() or "utf-8", errors="replace"
+            )
+        except LookupError:
+            # Unknown charsets.
+            content = body.decode("utf-8", errors="replace")
+        stylesheet = RemoteStylesheet(
+            content,
+            response_headers.get("ETag"),
+            response_headers.get("Last-Modified"),
+            expires_at,
+        )
+    else:
+        return None, False
+
+    return stylesheet, lifetime is not None
+
+
+def _freshness_lifetime(headers):
+    """
+    Returns the seconds a response stays fresh in a shared cache, from its
+    'Cache-Control' or 'Expires' headers, or None when it must not be stored.
+    """
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return int(directives[name])
+
+    expires = parse_http_date_safe(headers.get("Expires", ""))
+    if expires is not None:
+        date = parse_http_date_safe(headers.get("Date", "")) or time.time()
+        return max(0, expires - date)
+
+    return 0
+
+
+def _get_fetch_executor():
+    """
+    Returns the thread pool shared by all requests to fetch remote stylesheets.
+    """
+    global _fetch_executor
+
+    with _fetch_executor_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(
+                max_workers=get_setting("REMOTE_STYLESHEET_WORKERS"),
+                thread_name_prefix="auto_amp_remote_stylesheet",
+            )
+        return _fetch_executor
+
+
+def fetch_remote_stylesheets(hrefs):
+    """
+    Fetches the allowed remote stylesheets of a page concurrently, and returns their
+    content by href, leaving out the ones which weren't fetched within the
+    'AUTO_AMP_REMOTE_STYLESHEET_BUDGET' seconds.
+    """
+    hrefs = {href for href in hrefs if remote_stylesheet_url(href) is not None}
+    if not hrefs:
+        return {}
+
+    executor = _get_fetch_executor()
+    futures = {executor.submit(fetch_remote_stylesheet, href): href for href in hrefs}
+    done, _ = wait(futures, timeout=get_setting("REMOTE_STYLESHEET_BUDGET"))
+
+    return {
+        futures[future]: future.result()
+        for future in done
+        if future.exception() is None and future.result() is not None
+    }
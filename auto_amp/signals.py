@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+
+# Sent once an AMP page is rendered while 'AUTO_AMP_TIMING' is enabled, with the
+# 'request', its 'canonical_path', the 'timings' of every stage in seconds and the
+# 'counters' of the page, such as 'images_probed' and 'css_bytes'.
+amp_page_timed = Signal()
@@ -0,0 +1,349 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import (
+    ManifestStaticFilesStorage,
+    StaticFilesStorage,
+    staticfiles_storage,
+)
+from django.core.files.base import ContentFile
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .css import minify_css
+from .images import read_image_size
+
+
+AMP_CSS_SUFFIX = ".amp.css"
+
+# Manifest of the dimensions of the static images, written at the storage root.
+AMP_IMAGE_SIZES_NAME = "amp-image-sizes.json"
+
+IMAGE_EXTENSIONS = (".png", ".gif", ".jpg", ".jpeg", ".webp", ".svg")
+
+_static_image_sizes = None
+
+_static_image_sizes_lock = threading.Lock()
+
+# Settings the static files index is built from.
+STATIC_FILES_SETTINGS = {
+    "DEBUG",
+    "INSTALLED_APPS",
+    "STATICFILES_DIRS",
+    "STATICFILES_FINDERS",
+    "STATICFILES_STORAGE",
+    "STATIC_ROOT",
+}
+
+# Seconds between the checks of the static directories in DEBUG.
+STATIC_FILES_CHECK_INTERVAL = 1
+
+StaticFilesIndex = namedtuple(
+    "StaticFilesIndex", ["files", "directories", "signature", "checked_at"]
+)
+
+_static_files_index = None
+
+_static_files_index_lock = threading.Lock()
+
+
+def amp_css_name(name):
+    """
+    Returns the name of the precomputed AMP variant of a stylesheet.
+    """
+    return f"{name[: -len('.css')]}{AMP_CSS_SUFFIX}"
+
+
+class AmpCssStorageMixin:
+    """
+    Staticfiles storage mixin writing a minified AMP variant of every stylesheet
+    next to it during 'collectstatic', which is inlined in AMP pages instead of the
+    original stylesheet.
+
+    With a manifest storage, variants are minified from the hashed stylesheets,
+    whose references are hashed too, and written under hashed names kept in the
+    manifest.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        super_post_process = getattr(super(), "post_process", None)
+        if super_post_process is not None:
+            yield from super_post_process(paths, dry_run=dry_run, **options)
+
+        if dry_run:
+            return
+
+        hashed_files = getattr(self, "hashed_files", {})
+        for name in sorted(paths):
+            if not name.endswith(".css") or name.endswith(AMP_CSS_SUFFIX):
+                continue
+
+            hashed_name = hashed_files.get(name, name)
+            with self.open(hashed_name) as stylesheet:
+                css_content = minify_css(stylesheet.read().decode("utf-8"))
+
+            amp_name = amp_css_name(name)
+            self._save_amp_css(amp_name, css_content)
+            if hashed_name != name:
+                hashed_files[amp_name] = amp_css_name(hashed_name)
+                self._save_amp_css(hashed_files[amp_name], css_content)
+            yield name, hashed_files.get(amp_name, amp_name), True
+
+        if hashed_files and hasattr(self, "save_manifest"):
+            self.save_manifest()
+        clear_static_files_index()
+
+    def _save_amp_css(self, amp_name, css_content):
+        if self.exists(amp_name):
+            self.delete(amp_name)
+        self.save(amp_name, ContentFile(css_content.encode("utf-8")))
+
+
+class AmpImageSizesStorageMixin:
+    """
+    Staticfiles storage mixin writing the dimensions of every static image to a
+    manifest during 'collectstatic', so AMP pages don't probe static images.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        super_post_process = getattr(super(), "post_process", None)
+        if super_post_process is not None:
+            yield from super_post_process(paths, dry_run=dry_run, **options)
+
+        if dry_run:
+            return
+
+        hashed_files = getattr(self, "hashed_files", {})
+        image_sizes = {}
+        for name in sorted(paths):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+
+            with self.open(name) as image_file:
+                size = read_image_size(image_file)
+            if size is None:
+                continue
+
+            image_sizes[name] = size
+            if name in hashed_files:
+                image_sizes[hashed_files[name]] = size
+
+        if self.exists(AMP_IMAGE_SIZES_NAME):
+            self.delete(AMP_IMAGE_SIZES_NAME)
+        self.save(
+            AMP_IMAGE_SIZES_NAME,
+            ContentFile(json.dumps(image_sizes, separators=(",", ":")).encode()),
+        )
+        load_static_image_sizes()
+
+
+def load_static_image_sizes():
+    """
+    Loads the static image dimensions manifest written by 'AmpImageSizesStorageMixin'
+    from the staticfiles storage, and returns them by static path.
+    """
+    global _static_image_sizes
+
+    try:
+        with staticfiles_storage.open(AMP_IMAGE_SIZES_NAME) as manifest_file:
+            image_sizes = json.loads(manifest_file.read())
+    except (OSError, ValueError):
+        image_sizes = {}
+
+    _static_image_sizes = {name: tuple(size) for name, size in image_sizes.items()}
+    return _static_image_sizes
+
+
+def get_static_image_sizes():
+    """
+    Returns the static image dimensions by static path, loading them once.
+    """
+    with _static_image_sizes_lock:
+        if _static_image_sizes is None:
+            load_static_image_sizes()
+        return _static_image_sizes
+
+
+def load_static_files_index():
+    """
+    Indexes the filesystem path of every static file by its static path, with the
+    AMP variants of the stylesheets precomputed by 'AmpCssStorageMixin'.
+
+    The index is taken from the staticfiles manifest when it is in use, so hashed
+    names resolve too, or built by walking the staticfiles finders otherwise. In
+    DEBUG, it keeps the modification times of the static directories to be built
+    again whenever files are added or removed.
+    """
+    global _static_files_index
+
+    hashed_files = None if settings.DEBUG else _manifest_hashed_files()
+    if hashed_files:
+        files = {}
+        for name, hashed_name in hashed_files.items():
+            files[name] = files[hashed_name] = staticfiles_storage.path(hashed_name)
+        directories = ()
+    else:
+        hashed_files = {}
+        files, directories = _find_static_files()
+
+    _add_amp_css_variants(files, hashed_files)
+    signature = _directories_signature(directories) if settings.DEBUG else None
+    _static_files_index = StaticFilesIndex(
+        files, directories, signature, time.monotonic()
+    )
+    return _static_files_index
+
+
+def _manifest_hashed_files():
+    """
+    Returns the hashed names of the static files kept by the staticfiles manifest,
+    or None when there is no manifest or its files have no filesystem path.
+    """
+    hashed_files = getattr(staticfiles_storage, "hashed_files", None)
+    if not hashed_files:
+        return None
+
+    try:
+        staticfiles_storage.path("")
+    except NotImplementedError:
+        return None
+    return hashed_files
+
+
+def _find_static_files():
+    """
+    Returns the filesystem path of every file found by the staticfiles finders by
+    its static path, the first finder taking precedence as in 'finders.find', and
+    the directories they were found in.
+    """
+    files = {}
+    directories = []
+    for finder in finders.get_finders():
+        for path, finder_storage in finder.list([]):
+            prefix = getattr(finder_storage, "prefix", None)
+            static_path = os.path.join(prefix, path) if prefix else path
+            files.setdefault(
+                static_path.replace(os.sep, "/"), finder_storage.path(path)
+            )
+
+        if settings.DEBUG:
+            for finder_storage in getattr(finder, "storages", {}).values():
+                directories.extend(
+                    directory for directory, _, _ in os.walk(finder_storage.location)
+                )
+    return files, tuple(directories)
+
+
+def _add_amp_css_variants(files, hashed_files):
+    """
+    Adds the AMP variants of the indexed stylesheets written to the staticfiles
+    storage, which are found under the hashed names of the stylesheets too.
+
+    In DEBUG, stylesheets are edited in place of being collected, so variants are
+    left out. Without a manifest, variants older than their stylesheet are too.
+    """
+    if settings.DEBUG or not isinstance(staticfiles_storage, AmpCssStorageMixin):
+        return
+
+    stylesheets = [
+        name
+        for name in files
+        if name.endswith(".css") and not name.endswith(AMP_CSS_SUFFIX)
+    ]
+    try:
+        for name in stylesheets:
+            amp_name = amp_css_name(name)
+            if amp_name in files or not staticfiles_storage.exists(amp_name):
+                continue
+            amp_path = staticfiles_storage.path(amp_name)
+            if hashed_files or not _is_older(amp_path, files[name]):
+                files[amp_name] = amp_path
+    except NotImplementedError:
+        # Storages without filesystem paths.
+        return
+
+    for name, hashed_name in hashed_files.items():
+        amp_name = amp_css_name(name)
+        if name.endswith(".css") and amp_name in files:
+            files[amp_css_name(hashed_name)] = files[amp_name]
+
+
+def _is_older(path, other_path):
+    try:
+        return os.stat(path).st_mtime_ns < os.stat(other_path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def _directories_signature(directories):
+    signature = []
+    for directory in directories:
+        try:
+            signature.append(os.stat(directory).st_mtime_ns)
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def get_static_files_index():
+    """
+    Returns the static files index, building it once, or again in DEBUG when the
+    static directories changed, checking them every 'STATIC_FILES_CHECK_INTERVAL'
+    seconds at most.
+    """
+    global _static_files_index
+
+    with _static_files_index_lock:
+        index = _static_files_index
+        if index is None:
+            return load_static_files_index()
+
+        now = time.monotonic()
+        if index.signature is not None and (
+            now - index.checked_at >= STATIC_FILES_CHECK_INTERVAL
+        ):
+            if index.signature != _directories_signature(index.directories):
+                return load_static_files_index()
+            index = _static_files_index = index._replace(checked_at=now)
+        return index
+
+
+def find_static_file(static_path):
+    """
+    Returns the filesystem path of a static file from the static files index, or
+    None when it doesn't exist.
+    """
+    return get_static_files_index().files.get(static_path)
+
+
+def clear_static_files_index():
+    """
+    Drops the static files index, to be built again on the next lookup.
+    """
+    global _static_files_index
+
+    with _static_files_index_lock:
+        _static_files_index = None
+
+
+@receiver(setting_changed)
+def reset_static_files_index(setting, **kwargs):
+    if setting in STATIC_FILES_SETTINGS:
+        clear_static_files_index()
+
+
+class AmpStaticFilesStorage(
+    AmpImageSizesStorageMixin, AmpCssStorageMixin, StaticFilesStorage
+):
+    pass
+
+
+class AmpManifestStaticFilesStorage(
+    AmpImageSizesStorageMixin, AmpCssStorageMixin, ManifestStaticFilesStorage
+):
+    pass
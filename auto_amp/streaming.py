@@ -0,0 +1,302 @@
+import codecs
+import time
+from concurrent.futures import wait
+from html import escape
+from html.parser import HTMLParser
+
+from . import utils
+from .conf import get_setting
+from .pipeline import is_default_pipeline
+from .timing import NULL_TIMER
+
+
+# Tags which may be part of the head, any other tag opening the body.
+HEAD_TAGS = {"base", "link", "meta", "noscript", "script", "style", "template", "title"}
+
+# Head tags whose content is text of the head, not of the body.
+HEAD_TEXT_TAGS = {"noscript", "script", "style", "template", "title"}
+
+_BEFORE_HEAD, _IN_HEAD, _AFTER_HEAD = range(3)
+
+
+def stream_amp_tags(chunks, path, charset="utf-8", timer=NULL_TIMER):
+    """
+    Adds basic AMP tags to a HTML document given as an iterable of chunks, yielding
+    the AMP document chunk by chunk without ever building the whole document tree.
+    The transform of every chunk is timed by the given timer as the 'stream' stage.
+
+    The streamed transform only applies the default 'AUTO_AMP_PIPELINE' stages. With
+    other stages, the whole document is gathered and transformed by them instead.
+    """
+    if not is_default_pipeline():
+        content = b"".join(
+            chunk if isinstance(chunk, bytes) else chunk.encode(charset)
+            for chunk in chunks
+        )
+        yield utils.add_amp_tags(content, path, timer=timer, charset=charset)
+        return
+
+    decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    transformer = AmpStreamTransformer(path)
+
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+
+        with timer.stage("stream"):
+            output = transformer.transform(chunk)
+        if output:
+            yield output
+
+    with timer.stage("stream"):
+        output = transformer.transform(decoder.decode(b"", final=True), final=True)
+    timer.count("images_probed", len(transformer.probed_images))
+    if output:
+        yield output
+
+
+def _format_starttag(tag, attrs):
+    """
+    Renders a start tag from its name and a list of (name, value) attribute pairs.
+    """
+    rendered_attrs = "".join(
+        f' {name}="{escape(value or "", quote=True)}"' for name, value in attrs
+    )
+    return f"<{tag}{rendered_attrs}>"
+
+
+class AmpStreamTransformer(HTMLParser):
+    """
+    Rewrites HTML tokens into their AMP equivalents as they are parsed.
+
+    The AMP head tags are spliced in right after '<head>' (charset and viewport
+    metas) and right before '</head>' (canonical link, AMP JS, merged stylesheets and
+    CSS boilerplate). As in browsers, the head is opened by the first head tag when
+    '<head>' is left out, and closed by the first token of the body when '</head>'
+    is. Stylesheets found after the head are inlined where they are.
+
+    Unsized images of a piece of the document are probed concurrently on the shared
+    image probe thread pool, within the 'AUTO_AMP_IMAGE_PROBE_BUDGET' seconds of the
+    whole document, before its output is returned.
+    """
+
+    def __init__(self, path):
+        super().__init__(convert_charrefs=False)
+        self.path = path
+        self._output = []
+        self._probe_deadline = None
+        self.probed_images = []
+        self._stylesheets = []
+        self._head_state = _BEFORE_HEAD
+        self._head_text_tag = None
+        self._skipping_script = False
+
+    def transform(self, data, final=False):
+        """
+        Feeds a piece of the document and returns the AMP output available so far.
+        """
+        self.feed(data)
+        if final:
+            self.close()
+            if self._head_state == _IN_HEAD:
+                self._close_head()
+
+        probes = [
+            piece.probe
+            for piece in self._output
+            if isinstance(piece, _AmpImg) and piece.probe is not None
+        ]
+        if probes:
+            wait(probes, timeout=max(0, self._probe_deadline - time.monotonic()))
+        output = "".join(
+            piece.render() if isinstance(piece, _AmpImg) else piece
+            for piece in self._output
+        )
+        self._output = []
+        return output
+
+    def _emit(self, data):
+        if not self._skipping_script:
+            self._output.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self._handle_starttag(tag, attrs, self_closing=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._handle_starttag(tag, attrs, self_closing=True)
+
+    def _handle_starttag(self, tag, attrs, self_closing):
+        attrs_dict = dict(attrs)
+
+        if tag == "html":
+            self._emit(_format_starttag(tag, attrs + [("amp", "")]))
+            return
+        if tag == "head":
+            # Left out once the head was opened without it.
+            if self._head_state == _BEFORE_HEAD:
+                self._open_head(self.get_starttag_text())
+            return
+
+        if tag not in HEAD_TAGS:
+            self._enter_body()
+        elif self._head_state == _BEFORE_HEAD:
+            self._open_head()
+        if self._head_state == _IN_HEAD and tag in HEAD_TEXT_TAGS and not self_closing:
+            self._head_text_tag = tag
+
+        if tag == "meta" and (
+            "charset" in attrs_dict
+            or (attrs_dict.get("http-equiv") or "").lower() == "content-type"
+            or attrs_dict.get("name") == "viewport"
+        ):
+            # Replaced by the ones emitted right after '<head>'.
+            pass
+        elif tag == "link" and "stylesheet" in (attrs_dict.get("rel") or "").split():
+            css_content = utils._fetch_file_content(attrs_dict.get("href", ""))
+            if self._head_state == _IN_HEAD:
+                self._stylesheets.append(css_content)
+            else:
+                self._emit_inline_css(css_content)
+        elif tag == "script" and not utils.JAVASCRIPT_ALLOWED_TYPES.search(
+            attrs_dict.get("type") or ""
+        ):
+            self._skipping_script = not self_closing
+        elif tag == "img":
+            self._emit_amp_img(attrs)
+        else:
+            self._emit(self.get_starttag_text())
+
+    def _open_head(self, head_starttag="<head>"):
+        self._head_state = _IN_HEAD
+        self._emit(head_starttag)
+        self._emit(_format_starttag("meta", [("charset", utils.AMP_CHARSET)]))
+        self._emit(
+            _format_starttag(
+                "meta", [("name", "viewport"), ("content", utils.AMP_VIEWPORT_CONTENT)]
+            )
+        )
+
+    def _close_head(self):
+        self._emit_head_end()
+        self._head_state = _AFTER_HEAD
+        self._head_text_tag = None
+        self._emit("</head>")
+
+    def _enter_body(self):
+        """
+        Opens and closes the head, if still missing or left open, before a token of
+        the body.
+        """
+        if self._head_state == _BEFORE_HEAD:
+            self._open_head()
+        if self._head_state == _IN_HEAD:
+            self._close_head()
+
+    def _handle_text(self, text):
+        if (
+            self._head_state != _AFTER_HEAD
+            and self._head_text_tag is None
+            and not self._skipping_script
+            and text.strip()
+        ):
+            self._enter_body()
+        self._emit(text)
+
+    def _emit_inline_css(self, css_content):
+        self._emit(_format_starttag("style", [("amp-custom", "")]))
+        self._emit(css_content)
+        self._emit("</style>")
+
+    def _emit_amp_img(self, attrs):
+        attrs_dict = dict(attrs)
+        attrs_dict.setdefault("layout", "responsive")
+
+        probe = None
+        if attrs_dict.get("src") and not utils._has_fixed_size(attrs_dict):
+            size = utils._get_static_image_size(attrs_dict["src"])
+            if size is not None:
+                utils._set_image_size(attrs_dict, size)
+            else:
+                if self._probe_deadline is None:
+                    self._probe_deadline = time.monotonic() + get_setting(
+                        "IMAGE_PROBE_BUDGET"
+                    )
+                probe = utils.submit_image_probe(attrs_dict["src"], self.probed_images)
+
+        self._emit(_AmpImg(attrs_dict, probe))
+
+    def _emit_head_end(self):
+        self._emit(
+            _format_starttag("link", [("rel", "canonical"), ("href", self.path)])
+        )
+        self._emit(
+            _format_starttag("script", [("async", ""), ("src", utils.AMP_JS_URL)])
+        )
+        self._emit("</script>")
+        if self._stylesheets:
+            # The document isn't known yet, so the merged CSS is only limited to the
+            # budget and not pruned.
+            self._emit_inline_css(utils._prune_css("\n".join(self._stylesheets)))
+        self._stylesheets = []
+        self._emit(_format_starttag("style", [("amp-boilerplate", "")]))
+        self._emit(utils.AMP_CSS_BOILERPLATE)
+        self._emit("</style><noscript>")
+        self._emit(_format_starttag("style", [("amp-boilerplate", "")]))
+        self._emit(utils.AMP_NOSCRIPT_CSS_BOILERPLATE)
+        self._emit("</style></noscript>")
+
+    def handle_endtag(self, tag):
+        if tag == self._head_text_tag:
+            self._head_text_tag = None
+
+        if tag == "script" and self._skipping_script:
+            self._skipping_script = False
+        elif tag == "img":
+            # Void element, the 'amp-img' has already been closed.
+            pass
+        elif tag == "head":
+            # Only the first '</head>' is kept, and emitted by '_close_head'.
+            self._enter_body()
+        else:
+            if tag in ("body", "html"):
+                self._enter_body()
+            self._emit(f"</{tag}>")
+
+    def handle_data(self, data):
+        self._handle_text(data)
+
+    def handle_entityref(self, name):
+        self._handle_text(f"&{name};")
+
+    def handle_charref(self, name):
+        self._handle_text(f"&#{name};")
+
+    def handle_comment(self, data):
+        self._emit(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self._emit(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self._emit(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        self._emit(f"<![{data}]>")
+
+
+class _AmpImg:
+    """
+    An 'amp-img' tag emitted while its image may still be probed.
+    """
+
+    def __init__(self, attrs, probe=None):
+        self.attrs = attrs
+        self.probe = probe
+
+    def render(self):
+        if self.probe is not None:
+            size = None
+            if self.probe.done() and self.probe.exception() is None:
+                size = self.probe.result()
+            utils._set_image_size(self.attrs, size)
+        return f'{_format_starttag("amp-img", self.attrs.items())}</amp-img>'
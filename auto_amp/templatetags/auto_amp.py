@@ -0,0 +1,48 @@
+from django import template
+from django.core.cache.utils import make_template_fragment_key
+
+from ..fragments import render_amp_fragment
+
+
+register = template.Library()
+
+
+class AmpCacheNode(template.Node):
+    def __init__(self, nodelist, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        return render_amp_fragment(
+            make_template_fragment_key(self.fragment_name, vary_on),
+            lambda: self.nodelist.render(context),
+        )
+
+
+@register.tag("amp_cache")
+def do_amp_cache(parser, token):
+    """
+    Caches the AMP version of a template fragment, which is transformed once and
+    spliced into the AMP pages it is rendered on. Canonical pages render it as is.
+
+    Usage::
+
+        {% load auto_amp %}
+        {% amp_cache fragment_name [var1] [var2 ...] %}
+            .. some expensive processing ..
+        {% endamp_cache %}
+
+    As with Django's 'cache' tag, each unique set of variables gets its own entry.
+    """
+    nodelist = parser.parse(("endamp_cache",))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 2:
+        raise template.TemplateSyntaxError(
+            f"'{tokens[0]}' tag requires at least 1 argument."
+        )
+    return AmpCacheNode(
+        nodelist, tokens[1], [parser.compile_filter(token) for token in tokens[2:]]
+    )
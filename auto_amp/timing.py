@@ -0,0 +1,115 @@
+import time
+from contextlib import contextmanager
+
+from .conf import get_setting
+from .signals import amp_page_timed
+
+
+class StageTimer:
+    """
+    Accumulates the time spent on every stage of an AMP request, along with
+    counters of the work done.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started_at)
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def server_timing(self):
+        """
+        Returns the timings as a 'Server-Timing' header value, in milliseconds.
+        """
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.timings.items()
+        )
+
+
+class _NullContext:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _NullTimer:
+    """
+    Timer doing nothing, used while timing is disabled.
+    """
+
+    enabled = False
+
+    _context = _NullContext()
+
+    def stage(self, name):
+        return self._context
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def get_timer():
+    """
+    Returns a new timer for a request when 'AUTO_AMP_TIMING' is enabled, or the
+    null timer.
+    """
+    return StageTimer() if get_setting("TIMING") else NULL_TIMER
+
+
+def report_timings(timer, request, canonical_path, response):
+    """
+    Sends the 'amp_page_timed' signal with the timings of a request, and sets them
+    on the 'Server-Timing' header when 'AUTO_AMP_SERVER_TIMING' is enabled.
+
+    Streaming responses are transformed as they are sent, after their headers, so
+    their timings are only sent by the signal once they are streamed.
+    """
+    if not timer.enabled:
+        return
+
+    if response.streaming:
+        response.streaming_content = _report_once_streamed(
+            timer, request, canonical_path, response.streaming_content
+        )
+        return
+
+    _send_timings(timer, request, canonical_path)
+    if get_setting("SERVER_TIMING"):
+        response["Server-Timing"] = timer.server_timing()
+
+
+def _report_once_streamed(timer, request, canonical_path, streaming_content):
+    yield from streaming_content
+    _send_timings(timer, request, canonical_path)
+
+
+def _send_timings(timer, request, canonical_path):
+    amp_page_timed.send(
+        sender=StageTimer,
+        request=request,
+        canonical_path=canonical_path,
+        timings=timer.timings,
+        counters=timer.counters,
+    )
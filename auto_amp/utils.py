@@ -1,37 +1,226 @@
+import asyncio
+import hashlib
+import logging
+import os
 import re
-import urllib
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
 from django.conf import settings
-from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import ImproperlyConfigured
+
+from . import remote
+from .cache import LRUCache, SingleFlightCache
+from .conf import get_setting
+from .css import (
+    document_features,
+    import_urls,
+    parse_stylesheet,
+    resolve_references,
+    serialize_rules,
+)
+from .images import _strip_url_prefix, open_local_image, read_image_size
+from .pipeline import amp_stage, contains, get_pipeline
+from .remote import (
+    fetch_remote_stylesheet,
+    fetch_remote_stylesheets,
+    remote_stylesheet_cache,
+    remote_stylesheet_url,
+)
+from .storage import (
+    STATIC_FILES_CHECK_INTERVAL,
+    amp_css_name,
+    find_static_file,
+    get_static_image_sizes,
+)
+from .timing import NULL_TIMER
+
+
+logger = logging.getLogger(__name__)
+
+# Version of the AMP transform, to be increased whenever the AMP output of a same
+# canonical page changes. It is part of the AMP pages ETags.
+AMP_TRANSFORM_VERSION = 2
+
+# Parser backends from the fastest to the slowest one.
+PARSER_BACKENDS = ("lxml", "html.parser", "html5lib")
+
+JAVASCRIPT_ALLOWED_TYPES = re.compile("^(application/json|application/ld+json)$")
+
+# Encoding of all AMP documents, as declared by their charset meta.
+AMP_CHARSET = "utf-8"
+
+AMP_JS_URL = "https://cdn.ampproject.org/v0.js"
+
+AMP_VIEWPORT_CONTENT = "width=device-width,minimum-scale=1,initial-scale=1"
+
+AMP_CSS_BOILERPLATE = (
+    "body{-webkit-animation:-amp-start 8s steps(1,end) 0s 1 "
+    "normal both;-moz-animation:-amp-start 8s steps(1,end) 0s 1 normal both;"
+    "-ms-animation:-amp-start 8s steps(1,end) 0s 1 normal both;animation:-amp-start"
+    " 8s steps(1,end) 0s 1 normal both}@-webkit-keyframes -amp-start{from{"
+    "visibility:hidden}to{visibility:visible}}@-moz-keyframes -amp-start{from{"
+    "visibility:hidden}to{visibility:visible}}@-ms-keyframes -amp-start{from{"
+    "visibility:hidden}to{visibility:visible}}@-o-keyframes -amp-start{from{"
+    "visibility:hidden}to{visibility:visible}}@keyframes -amp-start{from{visibility"
+    ":hidden}to{visibility:visible}}"
+)
+
+AMP_NOSCRIPT_CSS_BOILERPLATE = (
+    "body{-webkit-animation:none;-moz-animation:none;-ms-animation:none;animation"
+    ":none}"
+)
+
+
+def add_amp_tags(
+    content, path, timer=NULL_TIMER, charset=None, encoding=None, fragments=None
+):
+    """
+    Adds basic AMP tags to a valid HTML document.
 
+    The document tree is walked only once: the tags every stage works on are collected
+    upfront and handed to the stages, which would otherwise search the tree again.
 
-def add_amp_tags(content, path):
+    Documents given as bytes are decoded from 'charset' when given, or from the
+    charset they declare. The AMP document is returned as text, or as bytes encoded
+    to 'encoding' when given, without keeping another copy of it.
+
+    The stylesheets and features of the already transformed 'fragments' whose
+    placeholders the document holds, by token, are merged with the document ones.
     """
-    Adds basic AMP tags to a valid HTML document.
+    with timer.stage("parse"):
+        parsed_amp = parse_html(content, charset)
+        tags = collect_tags(parsed_amp)
+    if fragments:
+        tags["fragments"] = list(fragments.values())
+    return apply_amp_tags(parsed_amp, path, tags, timer, content, encoding)
+
+
+def apply_amp_tags(
+    parsed_amp, path, tags, timer=NULL_TIMER, content=None, encoding=None
+):
+    """
+    Applies the 'AUTO_AMP_PIPELINE' stages to a parsed document, given the tags
+    collected from it, and returns the AMP document, encoded to 'encoding' when
+    given. Every stage is timed by the given timer, and stages whose precondition
+    fails on the raw 'content', when given, are skipped.
     """
-    parsed_amp = parse_html(content)
+    if tags.get("fragments"):
+        # Stylesheets and images of fragments aren't part of the raw content.
+        content = None
+
+    stage_arguments = {"path": path, "tags": tags}
+    with counting_image_probes(timer):
+        for stage in get_pipeline():
+            if (
+                content is not None
+                and stage.precondition is not None
+                and not stage.precondition(content)
+            ):
+                continue
+
+            with timer.stage(stage.name):
+                parsed_amp = stage.func(
+                    parsed_amp,
+                    **{name: stage_arguments[name] for name in stage.arguments},
+                )
+
+    if timer.enabled:
+        timer.count("css_bytes", _amp_css_size(parsed_amp))
+
+    with timer.stage("serialize"):
+        return serialize_html(parsed_amp, encoding)
+
+
+def serialize_html(parsed_amp, encoding=None):
+    """
+    Serializes a document to text, or to bytes encoded to 'encoding', and
+    decomposes its tree right away. Its nodes reference each other, so the tree
+    would otherwise be kept until the garbage collector runs.
+    """
+    output = parsed_amp.decode()
+    # Decomposing the document itself would leave its children untouched.
+    for element in list(parsed_amp.contents):
+        element.decompose()
+    if encoding is None:
+        return output
+    return output.encode(encoding)
 
-    parsed_amp = insert_html_amp(parsed_amp)
-    parsed_amp = insert_canonical_link(parsed_amp, path)
-    parsed_amp = exclude_javascript(parsed_amp)
-    parsed_amp = insert_amp_js(parsed_amp)
-    parsed_amp = insert_charset_meta(parsed_amp)
-    parsed_amp = insert_viewport_meta(parsed_amp)
-    parsed_amp = replace_external_stylesheets(parsed_amp)
-    parsed_amp = insert_amp_css_boilerplate(parsed_amp)
-    parsed_amp = replace_amp_img(parsed_amp)
 
-    return str(parsed_amp)
+def get_parser():
+    """
+    Returns the parser backend set on 'AUTO_AMP_PARSER' or the fastest one installed.
+    """
+    parser = get_setting("PARSER")
+    if parser is None:
+        return next(
+            backend for backend in PARSER_BACKENDS if builder_registry.lookup(backend)
+        )
 
+    if builder_registry.lookup(parser) is None:
+        raise ImproperlyConfigured(
+            f"AUTO_AMP_PARSER is set to '{parser}', which is not an installed "
+            "BeautifulSoup parser."
+        )
+    return parser
 
-def parse_html(content):
+
+def parse_html(content, charset=None):
+    """
+    Parse a HTML document to a Python representation using BeautifulSoup. Documents
+    given as bytes are decoded from 'charset' when given.
+    """
+    if charset and isinstance(content, bytes):
+        return BeautifulSoup(content, get_parser(), from_encoding=charset)
+    return BeautifulSoup(content, get_parser())
+
+
+def collect_tags(parsed_amp):
     """
-    Parse a HTML document to a Python representation using BeautifulSoup.
+    Walks the document tree once and groups the tags each AMP stage works on. The
+    dimensions of the images may be added as 'images_info' when already known.
     """
-    return BeautifulSoup(content, "html.parser")
+    tags = {
+        "charset_meta": None,
+        "viewport_meta": None,
+        "stylesheets": [],
+        "scripts": [],
+        "imgs": [],
+    }
+
+    for tag in parsed_amp.find_all(["meta", "link", "script", "img"]):
+        if tag.name == "meta":
+            if tags["charset_meta"] is None and _is_charset_meta(tag):
+                tags["charset_meta"] = tag
+            if tags["viewport_meta"] is None and tag.get("name") == "viewport":
+                tags["viewport_meta"] = tag
+        elif tag.name == "link":
+            if "stylesheet" in tag.get_attribute_list("rel"):
+                tags["stylesheets"].append(tag)
+        elif tag.name == "script":
+            tags["scripts"].append(tag)
+        elif tag.name == "img":
+            tags["imgs"].append(tag)
+
+    return tags
+
+
+def _is_charset_meta(tag):
+    return tag.has_attr("charset") or (
+        (tag.get("http-equiv") or "").lower() == "content-type"
+    )
 
 
+@amp_stage("html")
 def insert_html_amp(parsed_amp):
     """
     Inserts the 'amp' attribute to the document's 'html' tag.
@@ -40,6 +229,7 @@ def insert_html_amp(parsed_amp):
     return parsed_amp
 
 
+@amp_stage("html")
 def insert_canonical_link(parsed_amp, path):
     """
     Inserts a link to the respetive canonical page.
@@ -49,175 +239,737 @@ def insert_canonical_link(parsed_amp, path):
     return parsed_amp
 
 
+@amp_stage("scripts")
 def insert_amp_js(parsed_amp):
     """
     Inserts a script tag to load the AMP project JS.
     """
-    amp_js = parsed_amp.new_tag(
-        "script", src="https://cdn.ampproject.org/v0.js", **{"async": ""}
-    )
+    amp_js = parsed_amp.new_tag("script", src=AMP_JS_URL, **{"async": ""})
     parsed_amp.head.append(amp_js)
     return parsed_amp
 
 
-def insert_charset_meta(parsed_amp):
+@amp_stage("metas")
+def insert_charset_meta(parsed_amp, tags=None):
     """
-    Inserts a script tag to load the AMP project JS.
+    Inserts a UTF-8 charset meta tag, replacing the charset the document declares,
+    as AMP documents are encoded to UTF-8.
     """
-    if parsed_amp.find("meta", charset="utf-8"):
+    tags = tags or collect_tags(parsed_amp)
+    charset_meta = tags["charset_meta"]
+    if charset_meta is not None and charset_meta.attrs == {"charset": AMP_CHARSET}:
         return parsed_amp
 
-    charset_meta = parsed_amp.new_tag("meta", charset="utf-8")
-    parsed_amp.head.insert(0, charset_meta)
+    new_charset_meta = parsed_amp.new_tag("meta", charset=AMP_CHARSET)
+    if charset_meta is None:
+        parsed_amp.head.insert(0, new_charset_meta)
+    else:
+        charset_meta.replace_with(new_charset_meta)
+        tags["charset_meta"] = new_charset_meta
     return parsed_amp
 
 
-def insert_viewport_meta(parsed_amp):
+@amp_stage("metas")
+def insert_viewport_meta(parsed_amp, tags=None):
     """
     Inserts a new viewport meta tag or update the existing one with the correct
     content.
     """
-    viewport_meta = parsed_amp.find("meta", attrs={"name": "viewport"})
-    amp_viewport_content = "width=device-width,minimum-scale=1,initial-scale=1"
+    tags = tags or collect_tags(parsed_amp)
+    viewport_meta = tags["viewport_meta"]
 
     if viewport_meta:
-        viewport_meta["content"] = amp_viewport_content
+        viewport_meta["content"] = AMP_VIEWPORT_CONTENT
     else:
         new_viewport_meta = parsed_amp.new_tag(
-            "meta", attrs={"name": "viewport", "content": amp_viewport_content}
+            "meta", attrs={"name": "viewport", "content": AMP_VIEWPORT_CONTENT}
         )
         parsed_amp.head.insert(1, new_viewport_meta)
 
     return parsed_amp
 
 
+LINK_TAG = re.compile(rb"""<link\b((?:[^>"']|"[^"]*"|'[^']*')*)>""", re.IGNORECASE)
+
+LINK_ATTRIBUTE = re.compile(
+    rb"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?"""
+)
+
+# '@import' rules resolved in a chain of stylesheets, at most.
+MAX_IMPORT_DEPTH = 8
+
+# File a stylesheet was flattened from: its URL, the filesystem path of static ones
+# and their version, or the digest of remote ones.
+StylesheetDependency = namedtuple(
+    "StylesheetDependency", ["url", "filesystem_path", "version"]
+)
+
+CachedStylesheet = namedtuple(
+    "CachedStylesheet", ["content", "dependencies", "checked_at"]
+)
+
+stylesheet_cache = LRUCache(get_setting("STYLESHEET_CACHE_SIZE"))
+
+
+def _static_file_version(static_path, filesystem_path):
+    """
+    Returns a value that changes whenever the static file content changes: its hashed
+    name when the staticfiles storage keeps a manifest, or its mtime and size.
+    """
+    hashed_files = getattr(staticfiles_storage, "hashed_files", None)
+    if hashed_files and static_path in hashed_files:
+        return hashed_files[static_path]
+
+    stat = os.stat(filesystem_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _is_current_stylesheet(cached_stylesheet):
+    """
+    Checks whether a flattened stylesheet still matches every file it was flattened
+    from.
+    """
+    return all(
+        _is_current_dependency(dependency)
+        for dependency in cached_stylesheet.dependencies
+    )
+
+
+def _is_current_dependency(dependency):
+    """
+    Checks whether a stylesheet dependency is unchanged. Remote ones aren't fetched:
+    they are only current while they are fresh in 'remote_stylesheet_cache'.
+    """
+    static_path = _strip_url_prefix(dependency.url, settings.STATIC_URL)
+    if static_path is None:
+        cached = remote_stylesheet_cache.get(dependency.url)
+        return (
+            cached is not None
+            and cached.expires_at > time.time()
+            and _digest(cached.content) == dependency.version
+        )
+
+    filesystem_path = dependency.filesystem_path or _find_stylesheet(static_path)
+    if filesystem_path is None:
+        return dependency.version is None
+    try:
+        return _static_file_version(static_path, filesystem_path) == dependency.version
+    except OSError:
+        return dependency.version is None
+
+
+def _digest(content):
+    return hashlib.blake2b(content.encode("utf-8")).hexdigest()
+
+
+def _find_stylesheet(static_path):
+    """
+    Returns the filesystem path of the AMP variant of a stylesheet precomputed by
+    'AmpCssStorageMixin' at 'collectstatic', or of the stylesheet itself.
+    """
+    return find_static_file(amp_css_name(static_path)) or find_static_file(static_path)
+
+
 def _fetch_file_content(href):
     """
     Checks whether the href corresponds to a local static file and retrieves its
-    content.
+    content, preferring its precomputed AMP variant. Stylesheets of the
+    'AUTO_AMP_REMOTE_STYLESHEET_HOSTS' are fetched, and others are left out.
+
+    The '@import' rules of stylesheets are replaced by the imported stylesheets and
+    their relative 'url()' references made absolute. Flattened static stylesheets
+    are kept in 'stylesheet_cache' until any file they were flattened from changes,
+    which is checked every 'STATIC_FILES_CHECK_INTERVAL' seconds at most.
+    """
+    static_path = _strip_url_prefix(href, settings.STATIC_URL)
+    if static_path is not None:
+        return _get_static_stylesheet(static_path).content
+
+    url = remote_stylesheet_url(href)
+    content = url and fetch_remote_stylesheet(url)
+    if not content:
+        return ""
+    return _inline_remote_stylesheet(url, content)
+
+
+def _get_static_stylesheet(static_path):
+    """
+    Returns a static stylesheet flattened along with its dependencies, going
+    through 'stylesheet_cache'.
+    """
+    url = f"{settings.STATIC_URL}{quote(static_path)}"
+    now = time.monotonic()
+    # Checked out of the cache lock, as the files are looked up.
+    cached_stylesheet = stylesheet_cache.get(url)
+    if cached_stylesheet is not None:
+        if now - cached_stylesheet.checked_at < STATIC_FILES_CHECK_INTERVAL:
+            return cached_stylesheet
+        if _is_current_stylesheet(cached_stylesheet):
+            cached_stylesheet = cached_stylesheet._replace(checked_at=now)
+            stylesheet_cache.set(
+                url, cached_stylesheet, len(cached_stylesheet.content.encode("utf-8"))
+            )
+            return cached_stylesheet
+
+    content, dependencies = _load_stylesheet(url, ())
+    cached_stylesheet = CachedStylesheet(content, tuple(dependencies), now)
+    stylesheet_cache.set(url, cached_stylesheet, len(content.encode("utf-8")))
+    return cached_stylesheet
+
+
+def _inline_remote_stylesheet(url, content):
+    """
+    Flattens the content of a remote stylesheet, which is cached on its own.
     """
-    if href.startswith(settings.STATIC_URL):
-        static_path = re.sub(f"^{settings.STATIC_URL}", "", href, count=1)
-        filesystem_path = finders.find(static_path)
+    return _resolve_imports(url, content, ())[0]
+
+
+def _load_stylesheet(url, chain, remote_contents=None):
+    """
+    Reads a static stylesheet, or takes a remote one from the 'remote_contents'
+    fetched by URL, and flattens it, returning its content and the files it was
+    flattened from. Missing stylesheets are empty.
+    """
+    static_path = _strip_url_prefix(url, settings.STATIC_URL)
+    if static_path is None:
+        content = (remote_contents or {}).get(url)
+        if content is None:
+            return "", [StylesheetDependency(url, None, None)]
+        dependency = StylesheetDependency(url, None, _digest(content))
+    else:
+        filesystem_path = _find_stylesheet(static_path)
+        if filesystem_path is None:
+            return "", [StylesheetDependency(url, None, None)]
+
+        version = _static_file_version(static_path, filesystem_path)
         with open(filesystem_path, "r") as staticfile:
-            return staticfile.read()
+            content = staticfile.read()
+        dependency = StylesheetDependency(url, filesystem_path, version)
+
+    content, dependencies = _resolve_imports(url, content, chain)
+    return content, [dependency, *dependencies]
+
+
+def _resolve_imports(url, content, chain):
+    """
+    Replaces the '@import' rules of a stylesheet by the stylesheets they import,
+    wrapped in their media queries, and makes its relative references absolute.
+    Returns the content and the files it was flattened from.
+
+    Remote imported stylesheets are fetched concurrently, within the
+    'AUTO_AMP_REMOTE_STYLESHEET_BUDGET'.
+    """
+    dependencies = []
+    remote_contents = fetch_remote_stylesheets(import_urls(content, url))
 
-    # TODO: support third-party stylesheets
+    def resolve_import(import_url, media):
+        if import_url == url or import_url in chain or len(chain) >= MAX_IMPORT_DEPTH:
+            logger.warning("Cyclic or too deep @import of %s left out.", import_url)
+            return ""
 
-    return ""
+        imported, imported_dependencies = _load_stylesheet(
+            import_url, (*chain, url), remote_contents
+        )
+        dependencies.extend(imported_dependencies)
+        return f"@media {media}{{{imported}}}" if media else imported
+
+    return resolve_references(content, url, resolve_import), dependencies
+
+
+def stylesheet_dependencies(href):
+    """
+    Returns the URLs of the static files a stylesheet is flattened from.
+    """
+    static_path = _strip_url_prefix(href, settings.STATIC_URL)
+    if static_path is None:
+        return []
 
+    return [
+        dependency.url
+        for dependency in _get_static_stylesheet(static_path).dependencies
+        if _strip_url_prefix(dependency.url, settings.STATIC_URL) is not None
+    ]
 
-def replace_external_stylesheets(parsed_amp):
+
+def linked_stylesheets(content):
+    """
+    Returns the hrefs of the stylesheets linked by a raw document, given as bytes,
+    without parsing it.
+    """
+    hrefs = []
+    for link in LINK_TAG.finditer(content):
+        # Only the group of the matched quoting holds a value.
+        attrs = {
+            name.lower(): b"".join(values)
+            for name, *values in LINK_ATTRIBUTE.findall(link.group(1))
+        }
+        rel = attrs.get(b"rel", b"").lower().split()
+        if b"stylesheet" in rel and attrs.get(b"href"):
+            hrefs.append(attrs[b"href"].decode(AMP_CHARSET, errors="replace"))
+    return hrefs
+
+
+def page_stylesheets(content, fragments=None):
     """
-    Finds all stylesheets references, fetch their content and replace with inline
-    styles.
+    Returns the hrefs of the stylesheets linked by a raw document, given as bytes,
+    followed by the ones of the AMP 'fragments' it holds by token.
     """
-    external_stylesheets = parsed_amp.find_all("link", attrs={"rel": "stylesheet"})
-    for stylesheet in external_stylesheets:
-        css_content = _fetch_file_content(stylesheet["href"])
+    hrefs = linked_stylesheets(content)
+    for fragment in (fragments or {}).values():
+        hrefs.extend(href for href in fragment.stylesheets if href not in hrefs)
+    return hrefs
 
+
+def stylesheets_version(hrefs):
+    """
+    Returns a digest which changes whenever any of the stylesheets of the given hrefs
+    changes: static ones as they are flattened, and remote ones as long as they are
+    fresh in 'remote_stylesheet_cache'.
+    """
+    version = hashlib.blake2b(digest_size=16)
+    for href in hrefs:
+        static_path = _strip_url_prefix(href, settings.STATIC_URL)
+        if static_path is not None:
+            dependencies = _get_static_stylesheet(static_path).dependencies
+            href_version = [dependency.version for dependency in dependencies]
+        else:
+            url = remote_stylesheet_url(href)
+            cached = url and remote_stylesheet_cache.get(url)
+            href_version = (
+                _digest(cached.content)
+                if cached and cached.expires_at > time.time()
+                else None
+            )
+        version.update(repr((href, href_version)).encode(AMP_CHARSET))
+    return version.hexdigest()
+
+
+@amp_stage("stylesheets", requires=contains("stylesheet"))
+def replace_external_stylesheets(parsed_amp, tags=None):
+    """
+    Finds all stylesheets references, fetch their content and replace them with a
+    single inline style, as AMP allows only one. Stylesheets of the document
+    fragments come after the document ones.
+    """
+    tags = tags or collect_tags(parsed_amp)
+    hrefs = []
+    for stylesheet in tags["stylesheets"]:
+        hrefs.append(stylesheet["href"])
         stylesheet.extract()
+    for fragment in tags.get("fragments", ()):
+        hrefs.extend(href for href in fragment.stylesheets if href not in hrefs)
+    if not hrefs:
+        return parsed_amp
+
+    inline_css = parsed_amp.new_tag("style", attrs={"amp-custom": ""})
+    inline_css.string = merge_stylesheets(hrefs)
+    parsed_amp.head.append(inline_css)
+    return parsed_amp
+
+
+def merge_stylesheets(hrefs):
+    """
+    Returns the content of the stylesheets of the given hrefs merged in order,
+    fetching the remote ones concurrently and leaving out the ones which couldn't
+    be fetched.
+    """
+    remote_contents = fetch_remote_stylesheets(hrefs)
+    css_contents = []
+    for href in hrefs:
+        if href in remote_contents:
+            css_contents.append(
+                _inline_remote_stylesheet(
+                    remote_stylesheet_url(href), remote_contents[href]
+                )
+            )
+        elif remote_stylesheet_url(href) is None:
+            css_contents.append(_fetch_file_content(href))
+    return "\n".join(css_contents)
+
+
+parsed_css_cache = LRUCache(get_setting("CSS_CACHE_SIZE"))
+
+pruned_css_cache = LRUCache(get_setting("CSS_CACHE_SIZE"))
 
-        inline_css = parsed_amp.new_tag("style", attrs={"amp-custom": ""})
-        inline_css.string = css_content
-        parsed_amp.head.append(inline_css)
+
+@amp_stage("css", requires=contains("stylesheet", "amp-custom"))
+def prune_amp_css(parsed_amp, tags=None):
+    """
+    Removes the rules of the AMP custom style whose selectors can't match the
+    document or its fragments, and the rules beyond the 'AUTO_AMP_CSS_MAX_SIZE'
+    budget.
+
+    Pruned styles are kept in 'pruned_css_cache' by the digests of the style and of
+    the tags, ids, classes and attributes of the document, and parsed styles in
+    'parsed_css_cache' by the digest of the style.
+    """
+    inline_css = parsed_amp.head and parsed_amp.head.find(
+        "style", attrs={"amp-custom": True}
+    )
+    if inline_css is None or not inline_css.string:
+        return parsed_amp
+
+    features = document_features(parsed_amp)
+    for fragment in (tags or {}).get("fragments", ()):
+        features |= fragment.features
+    inline_css.string = _prune_css(str(inline_css.string), features)
     return parsed_amp
 
 
-def exclude_javascript(parsed_amp):
+def _prune_css(css_content, features=None):
+    """
+    Removes the rules which need features missing from the document features, if
+    given, and the rules beyond the CSS budget, going through the CSS caches.
+    """
+    css_digest = hashlib.blake2b(css_content.encode("utf-8")).hexdigest()
+    features_digest = (
+        features
+        and hashlib.blake2b("\n".join(sorted(features)).encode("utf-8")).hexdigest()
+    )
+
+    pruned_css = pruned_css_cache.get((css_digest, features_digest))
+    if pruned_css is None:
+        rules = parsed_css_cache.get(css_digest)
+        if rules is None:
+            rules = parse_stylesheet(css_content)
+            parsed_css_cache.set(css_digest, rules, len(css_content))
+
+        pruned_css = limit_css_size(serialize_rules(rules, features))
+        pruned_css_cache.set((css_digest, features_digest), pruned_css, len(pruned_css))
+    return pruned_css
+
+
+def _amp_css_size(parsed_amp):
+    """
+    Returns the size, in bytes, of the AMP custom style of a document.
+    """
+    inline_css = parsed_amp.head and parsed_amp.head.find(
+        "style", attrs={"amp-custom": True}
+    )
+    if inline_css is None or not inline_css.string:
+        return 0
+    return len(inline_css.string.encode("utf-8"))
+
+
+def limit_css_size(serialized_rules):
+    """
+    Joins the CSS rules which fit in the 'AUTO_AMP_CSS_MAX_SIZE' budget, logging a
+    warning when any of them is dropped.
+    """
+    max_size = get_setting("CSS_MAX_SIZE")
+    size = 0
+    for index, rule in enumerate(serialized_rules):
+        size += len(rule.encode("utf-8"))
+        if size > max_size:
+            total_size = sum(len(rule.encode("utf-8")) for rule in serialized_rules)
+            logger.warning(
+                "AMP CSS of %d bytes exceeds the %d bytes budget, %d of %d rules "
+                "were dropped.",
+                total_size,
+                max_size,
+                len(serialized_rules) - index,
+                len(serialized_rules),
+            )
+            return "".join(serialized_rules[:index])
+    return "".join(serialized_rules)
+
+
+@amp_stage("scripts", requires=contains("<script"), fragment=True)
+def exclude_javascript(parsed_amp, tags=None):
     """
     Removes all application and third-party JS references. Only allowed text types are
     'application/json' and 'application/ld+json'.
     """
-    javascript_tags = parsed_amp.find_all("script")
-    javascript_allowed_tags = parsed_amp.find_all(
-        "script", attrs={"type": re.compile("^(application/json|application/ld+json)$")}
-    )
-    for tag in set(javascript_tags) - set(javascript_allowed_tags):
-        tag.extract()
+    tags = tags or collect_tags(parsed_amp)
+    for tag in tags["scripts"]:
+        if not JAVASCRIPT_ALLOWED_TYPES.search(tag.get("type", "")):
+            tag.extract()
     return parsed_amp
 
 
+@amp_stage("stylesheets")
 def insert_amp_css_boilerplate(parsed_amp):
     """
     Inserts AMP CSS boilerplate to the HTML document head.
     """
-    css_boilerplate = (
-        "body{-webkit-animation:-amp-start 8s steps(1,end) 0s 1 "
-        "normal both;-moz-animation:-amp-start 8s steps(1,end) 0s 1 normal both;"
-        "-ms-animation:-amp-start 8s steps(1,end) 0s 1 normal both;animation:-amp-start"
-        " 8s steps(1,end) 0s 1 normal both}@-webkit-keyframes -amp-start{from{"
-        "visibility:hidden}to{visibility:visible}}@-moz-keyframes -amp-start{from{"
-        "visibility:hidden}to{visibility:visible}}@-ms-keyframes -amp-start{from{"
-        "visibility:hidden}to{visibility:visible}}@-o-keyframes -amp-start{from{"
-        "visibility:hidden}to{visibility:visible}}@keyframes -amp-start{from{visibility"
-        ":hidden}to{visibility:visible}}"
-    )
     css_boilerplate_tag = parsed_amp.new_tag("style", attrs={"amp-boilerplate": ""})
-    css_boilerplate_tag.string = css_boilerplate
+    css_boilerplate_tag.string = AMP_CSS_BOILERPLATE
     parsed_amp.head.append(css_boilerplate_tag)
 
-    noscript_boilerplate = (
-        "body{-webkit-animation:none;-moz-animation:none;-ms-animation:none;animation"
-        ":none}"
-    )
     noscript_boilerplate_tag = parsed_amp.new_tag("noscript")
     noscript_css_boilerplate_tag = parsed_amp.new_tag(
         "style", attrs={"amp-boilerplate": ""}
     )
-    noscript_css_boilerplate_tag.string = noscript_boilerplate
+    noscript_css_boilerplate_tag.string = AMP_NOSCRIPT_CSS_BOILERPLATE
     noscript_boilerplate_tag.append(noscript_css_boilerplate_tag)
     parsed_amp.head.append(noscript_boilerplate_tag)
 
     return parsed_amp
 
 
-def _get_image_info(uri):
+image_info_cache = SingleFlightCache(
+    "auto_amp:image_info",
+    max_entries=get_setting("IMAGE_CACHE_SIZE"),
+    timeout=get_setting("IMAGE_CACHE_TIMEOUT"),
+    negative_timeout=get_setting("IMAGE_CACHE_NEGATIVE_TIMEOUT"),
+    cache_alias=get_setting("IMAGE_CACHE_ALIAS"),
+)
+
+_image_probe_executor = None
+
+_image_probe_executor_lock = threading.Lock()
+
+_image_fallbacks = ContextVar("auto_amp_image_fallbacks", default=None)
+
+_image_probes = ContextVar("auto_amp_image_probes", default=None)
+
+
+def _get_image_info(uri, probes=None):
+    """
+    Get image dimensions from a given URI, looking static images up in their
+    dimensions manifest, or probing each URI once and keeping its dimensions in
+    'image_info_cache'. URIs actually probed are appended to 'probes' when given.
+    """
+    size = _get_static_image_size(uri)
+    if size is not None:
+        return size
+
+    def probe(uri):
+        if probes is not None:
+            probes.append(uri)
+        return _probe_image_info(uri)
+
+    return image_info_cache.get_or_set(
+        uri, probe, is_negative=lambda size: size == (0, 0)
+    )
+
+
+def submit_image_probe(uri, probes=None):
     """
-    Get image dimensions from a given URI.
-    Based on this StackOverflow answer: https://stackoverflow.com/a/37709319
+    Gets the dimensions of an image on the shared image probe thread pool, and
+    returns its future. Probes are recorded in 'probes' when given, or by the
+    'counting_image_probes' of the current context.
     """
+    if probes is None:
+        probes = _image_probes.get()
+    return _get_image_probe_executor().submit(_get_image_info, uri, probes)
+
+
+@contextmanager
+def counting_image_probes(timer):
+    """
+    Counts the images actually probed in the current context, leaving out the ones
+    found in the caches or in the static images manifest, as the 'images_probed'
+    counter of the timer.
+    """
+    if not timer.enabled:
+        yield
+        return
+
+    probes = []
+    token = _image_probes.set(probes)
     try:
-        from PIL import ImageFile
-    except ImportError:
-        return 0, 0
+        yield
+    finally:
+        _image_probes.reset(token)
+        timer.count("images_probed", len(probes))
 
-    img_file = urllib.request.urlopen(uri)
-    parser = ImageFile.Parser()
 
-    while True:
-        data = img_file.read(1024)
-        if not data:
-            break
+def _get_static_image_size(uri):
+    """
+    Get the dimensions of a static image from the manifest written at
+    'collectstatic', or None when it isn't in it.
+    """
+    static_path = _strip_url_prefix(uri, settings.STATIC_URL)
+    if static_path is None:
+        return None
+    return get_static_image_sizes().get(static_path)
 
-        parser.feed(data)
 
-        if parser.image:
-            return parser.image.size
+def _get_image_probe_executor():
+    """
+    Returns the thread pool shared by all requests to probe images.
+    """
+    global _image_probe_executor
 
-    img_file.close()
-    return 0, 0
+    with _image_probe_executor_lock:
+        if _image_probe_executor is None:
+            _image_probe_executor = ThreadPoolExecutor(
+                max_workers=get_setting("IMAGE_PROBE_WORKERS"),
+                thread_name_prefix="auto_amp_image_probe",
+            )
+        return _image_probe_executor
 
 
-def replace_amp_img(parsed_amp):
+def _reset_worker_pools():
+    """
+    Gives a forked worker process its own image probe and stylesheet fetch thread
+    pools, and connections, as it inherits the ones of the parent process without
+    their threads.
+    """
+    global _image_probe_executor, _image_probe_executor_lock
+
+    _image_probe_executor = None
+    _image_probe_executor_lock = threading.Lock()
+    remote._fetch_executor = None
+    remote._fetch_executor_lock = threading.Lock()
+    remote.connection_pool = remote.ConnectionPool(
+        get_setting("REMOTE_STYLESHEET_WORKERS")
+    )
+
+
+def _get_images_info(uris):
+    """
+    Get the dimensions of many images concurrently, leaving out the ones which
+    couldn't be measured within the 'AUTO_AMP_IMAGE_PROBE_BUDGET' seconds.
+    """
+    images_info, uris = _split_static_images_info(uris)
+    if not uris:
+        return images_info
+
+    futures = {submit_image_probe(uri): uri for uri in uris}
+    done, _ = wait(futures, timeout=get_setting("IMAGE_PROBE_BUDGET"))
+
+    images_info.update(
+        (futures[future], future.result())
+        for future in done
+        if future.exception() is None
+    )
+    return images_info
+
+
+async def async_get_images_info(uris):
+    """
+    Asynchronous version of '_get_images_info', waiting for the images to be probed
+    without blocking the event loop.
+    """
+    images_info, uris = _split_static_images_info(uris)
+    if not uris:
+        return images_info
+
+    futures = {asyncio.wrap_future(submit_image_probe(uri)): uri for uri in uris}
+    done, _ = await asyncio.wait(futures, timeout=get_setting("IMAGE_PROBE_BUDGET"))
+
+    images_info.update(
+        (futures[future], future.result())
+        for future in done
+        if future.exception() is None
+    )
+    return images_info
+
+
+def _split_static_images_info(uris):
+    """
+    Returns the dimensions of the images found in the static images manifest, and
+    the set of the other images, which have to be probed.
+    """
+    images_info = {}
+    unknown_uris = set()
+    for uri in uris:
+        size = _get_static_image_size(uri)
+        if size is None:
+            unknown_uris.add(uri)
+        else:
+            images_info[uri] = size
+    return images_info, unknown_uris
+
+
+def unsized_image_sources(tags):
+    """
+    Returns the sources of the collected images whose dimensions have to be probed.
+    """
+    return {
+        img["src"]
+        for img in tags["imgs"]
+        if img.get("src") and not _has_fixed_size(img)
+    }
+
+
+def _set_image_size(amp_img, size):
+    """
+    Sets the dimensions of an image, or the 'AUTO_AMP_IMAGE_FALLBACK_ATTRS' when they
+    are unknown, which is recorded by 'recording_image_fallbacks'.
+    """
+    if _is_known_size(size):
+        amp_img["width"], amp_img["height"] = str(size[0]), str(size[1])
+        return
+
+    image_fallbacks = _image_fallbacks.get()
+    if image_fallbacks is not None:
+        image_fallbacks.add(amp_img.get("src"))
+    for name, value in get_setting("IMAGE_FALLBACK_ATTRS").items():
+        amp_img[name] = value
+
+
+def _is_known_size(size):
+    return bool(size) and size != (0, 0)
+
+
+@contextmanager
+def recording_image_fallbacks():
+    """
+    Collects the sources of the images given the fallback attributes in the current
+    context, as their dimensions weren't known in time or couldn't be measured, in
+    the returned set. Output holding them must not be cached, so the images are
+    measured again.
+    """
+    outer_fallbacks = _image_fallbacks.get()
+    image_fallbacks = set()
+    token = _image_fallbacks.set(image_fallbacks)
+    try:
+        yield image_fallbacks
+    finally:
+        _image_fallbacks.reset(token)
+        if outer_fallbacks is not None:
+            outer_fallbacks.update(image_fallbacks)
+
+
+def _probe_image_info(uri):
+    """
+    Get image dimensions from a given URI, reading only the image headers. Static and
+    media files are read from their storage instead of being requested.
+    """
+    try:
+        image_file = open_local_image(uri) or urllib.request.urlopen(
+            uri, timeout=get_setting("IMAGE_PROBE_TIMEOUT")
+        )
+        with image_file:
+            return read_image_size(image_file) or (0, 0)
+    except (OSError, ValueError):
+        return 0, 0
+
+
+def _has_fixed_size(img_attrs):
+    """
+    Checks whether an image has both width and height set to absolute values.
+    """
+    width = img_attrs.get("width")
+    height = img_attrs.get("height")
+    return not (
+        width is None or height is None or width[-1:] == "%" or height[-1:] == "%"
+    )
+
+
+@amp_stage("images", requires=contains("<img"), fragment=True)
+def replace_amp_img(parsed_amp, tags=None):
     """
     Finds all 'img' tags and replace with AMP img version.
     """
-    imgs = parsed_amp.find_all("img")
-    for img in imgs:
+    tags = tags or collect_tags(parsed_amp)
+    unsized_amp_imgs = []
+    for img in tags["imgs"]:
         amp_img = parsed_amp.new_tag("amp-img", attrs=img.attrs)
         amp_img["layout"] = amp_img.get("layout", "responsive")
 
         img.replace_with(amp_img)
 
-        if amp_img.get("src") and (
-            amp_img.get("width") is None
-            or amp_img.get("height") is None
-            or amp_img.get("width")[-1] == "%"
-            or amp_img.get("height")[-1] == "%"
-        ):
-            width, height = _get_image_info(amp_img.get("src"))
-            amp_img["width"] = str(width)
-            amp_img["height"] = str(height)
+        if amp_img.get("src") and not _has_fixed_size(amp_img):
+            unsized_amp_imgs.append(amp_img)
+
+    images_info = tags.get("images_info")
+    if images_info is None:
+        images_info = _get_images_info(amp_img["src"] for amp_img in unsized_amp_imgs)
+    for amp_img in unsized_amp_imgs:
+        _set_image_size(amp_img, images_info.get(amp_img["src"]))
 
     return parsed_amp
@@ -1,17 +1,543 @@
+import asyncio
+import contextvars
+import hashlib
+import inspect
+import threading
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
 from django.urls import resolve
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, quote_etag
+
+from .cache import LRUCache, get_amp_output, set_amp_output
+from .compiler import finish_amp_page, is_compiled_amp_page
+from .conf import get_setting
+from .fragments import (
+    collect_amp_fragments,
+    splice_amp_fragments,
+    stop_collecting_amp_fragments,
+)
+from .pipeline import pipeline_fingerprint
+from .streaming import stream_amp_tags
+from .timing import NULL_TIMER, get_timer, report_timings
+from .utils import (
+    AMP_CHARSET,
+    AMP_TRANSFORM_VERSION,
+    add_amp_tags,
+    apply_amp_tags,
+    async_get_images_info,
+    collect_tags,
+    counting_image_probes,
+    page_stylesheets,
+    parse_html,
+    recording_image_fallbacks,
+    stylesheets_version,
+    unsized_image_sources,
+)
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    # Django versions without ASGI support.
+    sync_to_async = None
+
+
+AMP_ETAG_SUFFIX = f"-amp{AMP_TRANSFORM_VERSION}"
+
+# Total size of the stylesheet hrefs kept by canonical ETag, to check the AMP ETags
+# of the pages answered with '304 Not Modified' by their canonical view.
+PAGE_STYLESHEETS_CACHE_SIZE = 1024 * 1024
+
+_page_stylesheets = LRUCache(PAGE_STYLESHEETS_CACHE_SIZE)
 
-from .utils import add_amp_tags
+_transform_executor = None
 
+_transform_executor_lock = threading.Lock()
 
-def canonical_to_amp(request, *args, canonical_path="", **kwargs):
+
+def canonical_to_amp(
+    request, *args, canonical_path="", last_modified_func=None, **kwargs
+):
     """
     Renders the respective canonical equivalent of the AMP page and add basic AMP tags
     to the content.
+
+    Streaming canonical responses are transformed chunk by chunk and kept streaming.
+    Otherwise, the AMP output is cached as long as the canonical content is the same,
+    and the fragments of the 'amp_cache' template tag are spliced into it.
+
+    AMP responses get an ETag derived from the canonical one, or from the canonical
+    content, along with the versions of the stylesheets and stages of the page, and
+    conditional requests are answered with '304 Not Modified' or '412 Precondition
+    Failed' without running the transform. Canonical views using Django's 'condition'
+    decorators and 'last_modified_func(request, canonical_path)', when given, answer
+    them without rendering the canonical page at all.
+    """
+    last_modified = None
+    if last_modified_func is not None:
+        last_modified = _timestamp(last_modified_func(request, canonical_path))
+
+    not_modified_response = _check_last_modified(request, last_modified)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    timer = get_timer()
+    with timer.stage("canonical"):
+        canonical_response, fragments = _render_canonical_page(request, canonical_path)
+
+    amp_response = _untransformed_amp_response(
+        request, canonical_response, canonical_path, last_modified, fragments, timer
+    )
+    if amp_response is None:
+        canonical_response.content = add_amp_tags_cached(
+            canonical_response.content,
+            canonical_path,
+            timer,
+            canonical_response.charset,
+            fragments,
+        )
+        set_amp_charset(canonical_response)
+        amp_response = canonical_response
+
+    report_timings(timer, request, canonical_path, amp_response)
+    return amp_response
+
+
+async def async_canonical_to_amp(
+    request, *args, canonical_path="", last_modified_func=None, **kwargs
+):
+    """
+    Asynchronous version of 'canonical_to_amp' for ASGI deployments.
+
+    Asynchronous canonical views and 'last_modified_func' are awaited directly, while
+    synchronous ones run in a thread. Parsing and serialization run on a thread pool
+    of 'AUTO_AMP_ASYNC_TRANSFORM_WORKERS' threads and images are probed in between,
+    so neither blocks the event loop.
+    """
+    last_modified = None
+    if last_modified_func is not None:
+        last_modified = _timestamp(
+            await _call_async(last_modified_func, request, canonical_path)
+        )
+
+    not_modified_response = _check_last_modified(request, last_modified)
+    if not_modified_response is not None:
+        return not_modified_response
+
+    timer = get_timer()
+    with timer.stage("canonical"):
+        canonical_response, fragments = await _async_render_canonical_page(
+            request, canonical_path
+        )
+
+    # Stylesheets may be read to version the AMP ETag.
+    amp_response = await _run_in_transform_executor(
+        _untransformed_amp_response,
+        request,
+        canonical_response,
+        canonical_path,
+        last_modified,
+        fragments,
+        timer,
+    )
+    if amp_response is None:
+        canonical_response.content = await async_add_amp_tags_cached(
+            canonical_response.content,
+            canonical_path,
+            timer,
+            canonical_response.charset,
+            fragments,
+        )
+        set_amp_charset(canonical_response)
+        amp_response = canonical_response
+
+    report_timings(timer, request, canonical_path, amp_response)
+    return amp_response
+
+
+def _render_canonical_page(request, canonical_path):
+    """
+    Renders the canonical page of an AMP page, and returns its response and the AMP
+    fragments collected while it was rendered. Pages answered with '304 Not
+    Modified' for AMP ETags of outdated stylesheets or stages are rendered again,
+    without the conditional headers.
+    """
+    canonical_response, fragments, amp_etags = _call_canonical_view(
+        request, canonical_path
+    )
+    if not _is_current_not_modified(canonical_response, canonical_path, amp_etags):
+        canonical_response, fragments, _ = _call_canonical_view(
+            request, canonical_path, conditional=False
+        )
+    return canonical_response, fragments
+
+
+def _call_canonical_view(request, canonical_path, conditional=True):
+    canonical_view, canonical_args, canonical_kwargs = resolve(canonical_path)
+    fragments = collect_amp_fragments()
+    try:
+        with _canonical_conditional_headers(request, conditional) as amp_etags:
+            canonical_response = canonical_view(
+                request, *canonical_args, **canonical_kwargs
+            )
+    finally:
+        stop_collecting_amp_fragments()
+    return canonical_response, fragments, amp_etags
+
+
+async def _async_render_canonical_page(request, canonical_path):
     """
+    Asynchronous version of '_render_canonical_page'.
+    """
+    canonical_response, fragments, amp_etags = await _async_call_canonical_view(
+        request, canonical_path
+    )
+    if not _is_current_not_modified(canonical_response, canonical_path, amp_etags):
+        canonical_response, fragments, _ = await _async_call_canonical_view(
+            request, canonical_path, conditional=False
+        )
+    return canonical_response, fragments
+
+
+async def _async_call_canonical_view(request, canonical_path, conditional=True):
     canonical_view, canonical_args, canonical_kwargs = resolve(canonical_path)
-    canonical_response = canonical_view(request, *canonical_args, **canonical_kwargs)
+    fragments = collect_amp_fragments()
+    try:
+        with _canonical_conditional_headers(request, conditional) as amp_etags:
+            canonical_response = await _call_async(
+                canonical_view, request, *canonical_args, **canonical_kwargs
+            )
+    finally:
+        stop_collecting_amp_fragments()
+    return canonical_response, fragments, amp_etags
+
+
+def _is_current_not_modified(canonical_response, canonical_path, amp_etags):
+    """
+    Checks whether a canonical response is not a '304 Not Modified' one answering
+    AMP ETags of other stylesheets or stages than the current ones of the page,
+    given the versions of the AMP ETags sent by canonical ETag.
+    """
+    if canonical_response.status_code != 304 or not amp_etags or "*" in amp_etags:
+        return True
+
+    canonical_etag = canonical_response.get("ETag")
+    if canonical_etag is None:
+        return False
+    canonical_etag = quote_etag(canonical_etag)
+    hrefs = _page_stylesheets.get((canonical_path, canonical_etag))
+    if hrefs is None:
+        return False
+    return _amp_etag_version(hrefs) in amp_etags.get(canonical_etag, ())
+
+
+def _timestamp(last_modified_datetime):
+    if last_modified_datetime is None:
+        return None
+    return timegm(last_modified_datetime.utctimetuple())
+
+
+def _check_last_modified(request, last_modified):
+    """
+    Returns the conditional response to send when the AMP page last modification
+    time is known and answers the request preconditions, or None.
+    """
+    if last_modified is None:
+        return None
+    return get_conditional_response(request, last_modified=last_modified)
+
+
+def _untransformed_amp_response(
+    request,
+    canonical_response,
+    canonical_path,
+    last_modified,
+    fragments=None,
+    timer=NULL_TIMER,
+):
+    """
+    Sets the AMP conditional headers on the canonical response, and returns the
+    response to send without running the AMP transform, or None when the canonical
+    content has to be transformed.
+    """
+    hrefs = ()
+    canonical_etag = canonical_response.get("ETag")
+    if canonical_etag is not None:
+        canonical_etag = quote_etag(canonical_etag)
+    if canonical_response.status_code == 200 and not canonical_response.streaming:
+        hrefs = tuple(page_stylesheets(canonical_response.content, fragments))
+        if canonical_etag is not None:
+            _page_stylesheets.set(
+                (canonical_path, canonical_etag),
+                hrefs,
+                len(canonical_path) + len(canonical_etag) + sum(map(len, hrefs)),
+            )
+    elif canonical_etag is not None:
+        hrefs = _page_stylesheets.get((canonical_path, canonical_etag), ())
+
+    if canonical_etag is not None:
+        canonical_response["ETag"] = _amp_etag(canonical_etag, hrefs)
+    if last_modified is not None and not canonical_response.has_header("Last-Modified"):
+        canonical_response["Last-Modified"] = http_date(last_modified)
+
+    if canonical_response.status_code in (304, 412):
+        return canonical_response
+
+    if canonical_response.streaming:
+        canonical_response.streaming_content = stream_amp_tags(
+            canonical_response.streaming_content,
+            canonical_path,
+            canonical_response.charset,
+            timer,
+        )
+        set_amp_charset(canonical_response)
+        return canonical_response
+
+    if canonical_response.status_code == 200:
+        if canonical_etag is None:
+            content_digest = hashlib.blake2b(
+                canonical_response.content, digest_size=16
+            ).hexdigest()
+            canonical_response["ETag"] = _amp_etag(quote_etag(content_digest), hrefs)
+
+        conditional_response = get_conditional_response(
+            request,
+            etag=canonical_response["ETag"],
+            last_modified=last_modified,
+            response=canonical_response,
+        )
+        if conditional_response.status_code in (304, 412):
+            return conditional_response
+
+    return None
+
+
+def add_amp_tags_cached(
+    canonical_content, canonical_path, timer=NULL_TIMER, charset=None, fragments=None
+):
+    """
+    Adds basic AMP tags to a canonical page, decoded from 'charset' when given, and
+    returns it encoded to UTF-8. The AMP output is cached while the canonical
+    content is the same, with the placeholders of the AMP 'fragments' it holds, by
+    token, spliced afterwards.
+
+    Pages rendered from the AMP twins of 'auto_amp.loaders.Loader' are only
+    completed by 'finish_amp_page', without being parsed.
+    """
+    if is_compiled_amp_page(canonical_content, fragments):
+        return finish_amp_page(
+            canonical_content,
+            canonical_path,
+            timer,
+            charset,
+            AMP_CHARSET,
+            fragments,
+        )
+
+    with timer.stage("cache"):
+        amp_content = get_amp_output(canonical_path, canonical_content)
+    if amp_content is None:
+        with recording_image_fallbacks() as image_fallbacks:
+            amp_content = add_amp_tags(
+                canonical_content,
+                canonical_path,
+                timer=timer,
+                charset=charset,
+                encoding=AMP_CHARSET,
+                fragments=fragments,
+            )
+        if not image_fallbacks:
+            with timer.stage("cache"):
+                set_amp_output(
+                    canonical_path, canonical_content, amp_content, fragments
+                )
+    return splice_amp_fragments(amp_content, fragments)
+
+
+async def async_add_amp_tags_cached(
+    canonical_content, canonical_path, timer=NULL_TIMER, charset=None, fragments=None
+):
+    """
+    Asynchronous version of 'add_amp_tags_cached', running the blocking work on the
+    transform thread pool and probing images without holding any of its threads.
+    Pages rendered from compiled templates are completed on the thread pool.
+    """
+    if is_compiled_amp_page(canonical_content, fragments):
+        return await _run_in_transform_executor(
+            finish_amp_page,
+            canonical_content,
+            canonical_path,
+            timer,
+            charset,
+            AMP_CHARSET,
+            fragments,
+        )
+
+    with timer.stage("cache"):
+        amp_content = await _run_in_transform_executor(
+            get_amp_output, canonical_path, canonical_content
+        )
+    if amp_content is not None:
+        return splice_amp_fragments(amp_content, fragments)
+
+    with timer.stage("parse"):
+        parsed_amp = await _run_in_transform_executor(
+            parse_html, canonical_content, charset
+        )
+        tags = await _run_in_transform_executor(collect_tags, parsed_amp)
+    if fragments:
+        tags["fragments"] = list(fragments.values())
+    with timer.stage("images"), counting_image_probes(timer):
+        tags["images_info"] = await async_get_images_info(unsized_image_sources(tags))
+    with recording_image_fallbacks() as image_fallbacks:
+        amp_content = await _run_in_transform_executor(
+            apply_amp_tags,
+            parsed_amp,
+            canonical_path,
+            tags,
+            timer,
+            canonical_content,
+            AMP_CHARSET,
+        )
+
+    if not image_fallbacks:
+        with timer.stage("cache"):
+            await _run_in_transform_executor(
+                set_amp_output,
+                canonical_path,
+                canonical_content,
+                amp_content,
+                fragments,
+            )
+    return splice_amp_fragments(amp_content, fragments)
+
+
+def _get_transform_executor():
+    """
+    Returns the thread pool shared by all asynchronous requests to transform pages.
+    """
+    global _transform_executor
+
+    with _transform_executor_lock:
+        if _transform_executor is None:
+            _transform_executor = ThreadPoolExecutor(
+                max_workers=get_setting("ASYNC_TRANSFORM_WORKERS"),
+                thread_name_prefix="auto_amp_transform",
+            )
+        return _transform_executor
+
+
+async def _run_in_transform_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    # The context is copied so image fallbacks are recorded from the thread pool.
+    return await loop.run_in_executor(
+        _get_transform_executor(),
+        partial(contextvars.copy_context().run, func, *args),
+    )
+
+
+async def _call_async(func, *args, **kwargs):
+    """
+    Calls a function from the event loop, awaiting it when asynchronous or running
+    it in a thread otherwise.
+    """
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+
+    if sync_to_async is not None:
+        result = await sync_to_async(func)(*args, **kwargs)
+    else:
+        loop = asyncio.get_running_loop()
+        # The context is copied so the 'amp_cache' tag sees the collected fragments.
+        result = await loop.run_in_executor(
+            None, partial(contextvars.copy_context().run, func, *args, **kwargs)
+        )
+
+    # Synchronous decorators may wrap asynchronous views.
+    if inspect.isawaitable(result):
+        result = await result
+    return result
 
-    canonical_response.content = add_amp_tags(
-        canonical_response.content, canonical_path
+
+def set_amp_charset(response):
+    """
+    Declares the UTF-8 charset of AMP documents on a response, whatever the charset
+    of its canonical page.
+    """
+    media_type = response.get("Content-Type", "text/html").split(";", 1)[0]
+    response["Content-Type"] = f"{media_type}; charset={AMP_CHARSET}"
+    response.charset = AMP_CHARSET
+
+
+def _amp_etag(canonical_etag, hrefs=()):
+    """
+    Derives the ETag of an AMP page from the ETag of its canonical page, the version
+    of the AMP transform, and the version of the stages and of the stylesheets of
+    the given hrefs.
+    """
+    return (
+        f"{quote_etag(canonical_etag)[:-1]}{AMP_ETAG_SUFFIX}."
+        f'{_amp_etag_version(hrefs)}"'
     )
-    return canonical_response
+
+
+def _amp_etag_version(hrefs):
+    version = hashlib.blake2b(digest_size=8)
+    version.update(pipeline_fingerprint().encode())
+    version.update(stylesheets_version(hrefs).encode())
+    return version.hexdigest()
+
+
+def _parse_amp_etag(amp_etag):
+    """
+    Splits an AMP page ETag into the canonical ETag it was derived from and the
+    version of its stages and stylesheets, or returns None when it wasn't derived by
+    the current AMP transform.
+    """
+    if amp_etag == "*":
+        return amp_etag, None
+    canonical_etag, suffix, version = amp_etag[:-1].rpartition(f"{AMP_ETAG_SUFFIX}.")
+    if not suffix or not amp_etag.endswith('"'):
+        return None
+    return f'{canonical_etag}"', version
+
+
+@contextmanager
+def _canonical_conditional_headers(request, conditional=True):
+    """
+    Translates the AMP ETags sent on 'If-None-Match' and 'If-Match' to their
+    canonical ETags while the canonical view runs, so views using Django's
+    'condition' decorators answer conditional requests by themselves, or leaves the
+    headers out unless 'conditional'. Yields the versions of the AMP ETags sent on
+    'If-None-Match' by canonical ETag.
+    """
+    conditional_headers = {
+        header: request.META[header]
+        for header in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MATCH")
+        if header in request.META
+    }
+
+    amp_etags = {}
+    for header, etags in conditional_headers.items():
+        if not conditional:
+            del request.META[header]
+            continue
+
+        canonical_etags = []
+        for etag in parse_etags(etags):
+            parsed_etag = _parse_amp_etag(etag)
+            if parsed_etag is None:
+                continue
+            canonical_etag, version = parsed_etag
+            canonical_etags.append(canonical_etag)
+            if header == "HTTP_IF_NONE_MATCH":
+                amp_etags.setdefault(canonical_etag, set()).add(version)
+        request.META[header] = ", ".join(canonical_etags)
+
+    try:
+        yield amp_etags
+    finally:
+        request.META.update(conditional_headers)
@@ -0,0 +1,337 @@
+"""
+Benchmarks the AMP pipeline on a generated corpus of pages, from 10 KB to 5 MB.
+
+Every page is transformed by 'add_amp_tags' end to end, from bytes to bytes, timing
+each of its stages, and once more under tracemalloc to measure its peak memory.
+Images are served by a local stub server and stylesheets by a temporary static
+directory, so the benchmark runs offline. Results are saved to JSON to be compared across commits:
+
+    python benchmarks/benchmark.py --output before.json
+    python benchmarks/benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Pages of the corpus: name, size in bytes, and number of images, scripts and
+# stylesheets.
+CORPUS = [
+    ("10kb", 10 * 1000, 2, 2, 1),
+    ("100kb", 100 * 1000, 10, 5, 2),
+    ("1mb", 1000 * 1000, 50, 10, 4),
+    ("5mb", 5 * 1000 * 1000, 200, 20, 8),
+]
+
+# Runs of every page by default, fewer for the largest ones.
+DEFAULT_RUNS_BUDGET = 4 * 1000 * 1000
+
+WORDS = (
+    "amp page django template canonical render stylesheet image script layout "
+    "content article header footer section responsive viewport"
+).split()
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    """
+    Serves a PNG header of the size in the path, such as '/320x240.png'.
+    """
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        width, height = map(int, self.path.strip("/").split(".")[0].split("x"))
+        body = (
+            b"\x89PNG\r\n\x1a\n"
+            + struct.pack(">I", 13)
+            + b"IHDR"
+            + struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_server(delay):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubImageHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate_stylesheet(rng, index):
+    """
+    Generates a stylesheet of about 20 KB, half of whose rules match the pages.
+    """
+    rules = []
+    for rule_index in range(400):
+        if rule_index % 2:
+            selector = f".unused-{index}-{rule_index} > a:hover"
+        else:
+            selector = f".block-{rule_index % 40} .{rng.choice(WORDS)}"
+        color = rng.randrange(16**6)
+        rules.append(
+            f"/* Rule {rule_index} */\n{selector} {{\n"
+            f"  margin: {rule_index % 16}px auto;\n  color: #{color:06x};\n}}\n"
+        )
+    return "".join(rules)
+
+
+def generate_page(rng, size, images, scripts, stylesheets, image_url):
+    """
+    Generates a HTML page of about 'size' bytes, with its images, scripts and
+    stylesheets spread along the page.
+    """
+    head = [
+        "<!DOCTYPE html>",
+        '<html lang="en"><head><meta charset="utf-8">',
+        '<meta name="viewport" content="width=device-width, initial-scale=1">',
+        "<title>Benchmark page</title>",
+    ]
+    head.extend(
+        f'<link rel="stylesheet" href="/static/benchmark-{index}.css">'
+        for index in range(stylesheets)
+    )
+    head.append('<script type="application/ld+json">{"@type": "Article"}</script>')
+    head.append("</head><body>")
+
+    elements = []
+    for index in range(images):
+        width, height = rng.randrange(100, 1200), rng.randrange(100, 900)
+        if index % 4:
+            elements.append(f'<img src="{image_url}/{width}x{height}.png" alt="">')
+        else:
+            elements.append(
+                f'<img src="/static/fixed.png" width="{width}" height="{height}">'
+            )
+    elements.extend(
+        f'<script src="/static/app-{index}.js"></script>' for index in range(scripts)
+    )
+    rng.shuffle(elements)
+
+    body = []
+    length = sum(map(len, head))
+    block = 0
+    while length < size or elements:
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(20, 80)))
+        paragraph = (
+            f'<section class="block-{block % 40}"><h2 class="{rng.choice(WORDS)}">'
+            f"Section {block}</h2><p>{words}</p>"
+        )
+        if elements and (length >= size or rng.random() < 0.3):
+            paragraph += elements.pop()
+        paragraph += "</section>"
+        body.append(paragraph)
+        length += len(paragraph)
+        block += 1
+
+    return "".join(head + body + ["</body></html>"])
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return {
+        f"p{percentile}": ordered[
+            min(len(ordered) - 1, len(ordered) * percentile // 100)
+        ]
+        for percentile in (50, 90, 99)
+    }
+
+
+def clear_caches():
+    from django.core.cache import caches
+
+    from auto_amp import utils
+
+    utils.stylesheet_cache.clear()
+    utils.parsed_css_cache.clear()
+    utils.pruned_css_cache.clear()
+    utils.image_info_cache.clear()
+    caches[utils.get_setting("IMAGE_CACHE_ALIAS")].clear()
+
+
+def benchmark_page(content, runs, cold):
+    """
+    Transforms a page 'runs' times, and once more to trace its peak memory.
+    """
+    from auto_amp.timing import StageTimer
+    from auto_amp.utils import add_amp_tags
+
+    clear_caches()
+    latencies = []
+    stage_timings = {}
+    for _ in range(runs):
+        if cold:
+            clear_caches()
+
+        timer = StageTimer()
+        started_at = time.perf_counter()
+        add_amp_tags(
+            content, "/benchmark/", timer=timer, charset="utf-8", encoding="utf-8"
+        )
+        latencies.append(time.perf_counter() - started_at)
+
+        for stage, seconds in timer.timings.items():
+            stage_timings.setdefault(stage, []).append(seconds)
+
+    tracemalloc.start()
+    add_amp_tags(content, "/benchmark/", charset="utf-8", encoding="utf-8")
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total_time = sum(latencies)
+    return {
+        "size": len(content),
+        "runs": runs,
+        "latency": {
+            "mean": statistics.mean(latencies),
+            "min": min(latencies),
+            **percentiles(latencies),
+        },
+        "throughput": {
+            "pages_per_second": runs / total_time,
+            "bytes_per_second": runs * len(content) / total_time,
+        },
+        "stages": {
+            stage: {"mean": statistics.mean(timings), **percentiles(timings)}
+            for stage, timings in stage_timings.items()
+        },
+        "peak_memory": peak_memory,
+        "counters": timer.counters,
+    }
+
+
+def run_benchmarks(options):
+    from django.conf import settings
+    from django.test.utils import override_settings
+
+    from auto_amp.utils import get_parser
+
+    image_server = start_image_server(options.image_delay)
+    image_url = f"http://127.0.0.1:{image_server.server_port}"
+    rng = random.Random(options.seed)
+
+    with tempfile.TemporaryDirectory() as static_dir:
+        for index in range(max(pages[4] for pages in CORPUS)):
+            with open(os.path.join(static_dir, f"benchmark-{index}.css"), "w") as css:
+                css.write(generate_stylesheet(rng, index))
+
+        with override_settings(
+            STATICFILES_DIRS=[static_dir, *settings.STATICFILES_DIRS],
+            AUTO_AMP_PARSER=options.parser or settings.AUTO_AMP_PARSER,
+        ):
+            results = {}
+            for name, size, images, scripts, stylesheets in CORPUS:
+                if options.pages and name not in options.pages:
+                    continue
+
+                content = generate_page(
+                    rng, size, images, scripts, stylesheets, image_url
+                ).encode("utf-8")
+                runs = options.runs or max(3, min(50, DEFAULT_RUNS_BUDGET // size))
+                results[name] = benchmark_page(content, runs, options.cold)
+                print(
+                    f"{name}: p50 {results[name]['latency']['p50'] * 1000:.1f} ms, "
+                    f"peak memory {results[name]['peak_memory'] / 1e6:.1f} MB",
+                    file=sys.stderr,
+                )
+            parser = get_parser()
+
+    image_server.shutdown()
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "parser": parser,
+        "seed": options.seed,
+        "cold": options.cold,
+        "results": results,
+    }
+
+
+def compare(results, baseline):
+    """
+    Prints the relative change of every page latency and stage against a baseline.
+    """
+    for name, result in results["results"].items():
+        base_result = baseline["results"].get(name)
+        if base_result is None:
+            continue
+
+        print(f"{name}: p50 {_change(result['latency'], base_result['latency'])}")
+        for stage, timings in result["stages"].items():
+            if stage in base_result["stages"]:
+                change = _change(timings, base_result["stages"][stage])
+                print(f"  {stage}: p50 {change}")
+
+
+def _change(timings, base_timings):
+    return f"{(timings['p50'] / base_timings['p50'] - 1) * 100:+.1f}%"
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=BASE_DIR,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="JSON file to save the results to.")
+    parser.add_argument("--compare", help="JSON results to compare with.")
+    parser.add_argument(
+        "--pages", nargs="+", choices=[page[0] for page in CORPUS], help="Pages to run."
+    )
+    parser.add_argument("--runs", type=int, help="Runs of every page.")
+    parser.add_argument("--parser", help="BeautifulSoup parser backend.")
+    parser.add_argument(
+        "--cold", action="store_true", help="Clear the caches before every run."
+    )
+    parser.add_argument(
+        "--image-delay", type=float, default=0, help="Seconds to serve every image."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Corpus random seed.")
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(BASE_DIR, "tests"))
+    sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "app.settings")
+    import django
+
+    django.setup()
+
+    results = run_benchmarks(options)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
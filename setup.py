@@ -14,5 +14,6 @@ setup(
     author_email="be.smaniotto@gmail.com",
     url="https://github.com/smaniotto/django-auto-amp/",
     license="MIT",
-    install_requires=["Django>=1.11,<=2.2", "beautifulsoup>=4,<=5"],
+    install_requires=["Django>=1.11,<4.0", "beautifulsoup>=4,<=5"],
+    extras_require={"lxml": ["lxml"]},
 )
@@ -118,3 +118,9 @@ STATIC_URL = "/static/"
 STATICFILES_DIRS = [os.path.join(BASE_DIR, "static")]
 
 STATIC_ROOT = "staticfiles"
+
+
+# Auto AMP
+
+# The test fixtures are parsed as html.parser does, backends are compared separately.
+AUTO_AMP_PARSER = "html.parser"
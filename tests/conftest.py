@@ -0,0 +1,129 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import mock_open
+
+import pytest
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from auto_amp import remote, storage, utils
+from test_utils import reload_module, reload_urlconf
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """
+    Fixture to start every test with empty in-process caches.
+    """
+    utils.stylesheet_cache.clear()
+    utils.parsed_css_cache.clear()
+    utils.pruned_css_cache.clear()
+    utils.image_info_cache.clear()
+    remote.remote_stylesheet_cache.clear()
+    remote.connection_pool.clear()
+    caches["default"].clear()
+    storage._static_image_sizes = None
+    storage._static_files_index = None
+
+
+@pytest.fixture
+def canonical_index(mocker):
+    """
+    Fixture to serve a canonical page at the website index. The mocked index body is
+    returned: its response is built from its 'content', which can be changed, and it
+    can be wrapped by decorators through 'decorate'.
+    """
+    index_body = mocker.Mock(
+        side_effect=lambda request: HttpResponse(index_body.content)
+    )
+    index_body.content = "<html><head></head><body>Index</body></html>"
+
+    def decorate(decorator):
+        mocker.patch("website.views.index", decorator(index_body))
+        reload_module("website.urls")
+        reload_urlconf()
+
+    index_body.decorate = decorate
+    decorate(lambda view: view)
+    return index_body
+
+
+@pytest.fixture
+def mocked_add_amp_tags(mocker):
+    """
+    Fixture to mock the AMP transform done by the AMP view and middleware.
+    """
+    return mocker.patch(
+        "auto_amp.views.add_amp_tags",
+        side_effect=lambda content, path, **kwargs: content.decode().replace(
+            "<html>", "<amp>"
+        ),
+    )
+
+
+@pytest.fixture
+def mocked_resources(mocker):
+    """
+    Fixture to mock the stylesheet and image fetching done by the AMP transform. The
+    mocked image info getter is returned.
+    """
+    mocker.patch("builtins.open", mock_open(read_data="body { color: red; }"))
+    mocked_get_img_size = mocker.patch("auto_amp.utils._get_image_info")
+    mocked_get_img_size.return_value = 800, 600
+    return mocked_get_img_size
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the responses registered on the server routes, after their delay, over
+    persistent connections.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.request_headers.append(self.headers)
+        route = self.server.routes.get(self.path)
+        if route is None:
+            self.send_error(404)
+            return
+
+        time.sleep(route.get("delay", 0))
+        self.send_response(route.get("status", 200))
+        for name, value in route.get("headers", {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(route["body"])))
+        self.end_headers()
+        self.wfile.write(route["body"])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """
+    Fixture to run a local HTTP server. Responses are registered on its 'routes' by
+    path, as dicts with a 'body' and optional 'status', 'headers' and 'delay' in
+    seconds. Requested paths are recorded on its 'requests', their headers on its
+    'request_headers', and the number of connections on its 'connections'.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRequestHandler)
+    server.daemon_threads = True
+    server.routes = {}
+    server.requests = []
+    server.request_headers = []
+    server.connections = 0
+    server.url = f"http://127.0.0.1:{server.server_port}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -57,6 +57,37 @@ def parsed_html_lean():
     )
 
 
+@pytest.fixture
+def parsed_html_mixed():
+    """
+    Fixture to return a HTML document with tags in unusual places and multiple
+    stylesheets and scripts.
+    """
+    return utils.parse_html(
+        """
+        <!doctype html>
+        <html lang="en">
+            <head>
+                <meta charset="iso-8859-1">
+                <title>Page title</title>
+                <script src="/static/head.js"></script>
+                <link rel="stylesheet" href="/static/styles.css">
+                <link rel="icon" href="/static/favicon.ico">
+                <meta name="viewport" content="width=device-width">
+            </head>
+            <body>
+                <link rel="alternate stylesheet" href="/static/print.css">
+                <img src="/static/img.png" width="50%" height="100">
+                <script type="application/ld+json">{"@type": "Article"}</script>
+                <div><img src="/static/nested.png" width="10" height="10"></div>
+                <script type="application/json">{}</script>
+                <script>console.log("inline")</script>
+            </body>
+        </html>
+        """
+    )
+
+
 def test_canonical_to_amp_path_discovery(client, mocker):
     """
     Asserts that the AMP path directs the user to the correct respective canonical
@@ -208,3 +239,105 @@ def test_replace_amp_img(parsed_html, mocker):
         )
         is not None
     )
+
+
+def _add_amp_tags_stage_by_stage(content, path):
+    """
+    Applies every AMP stage on its own, letting each of them search the whole tree.
+    """
+    parsed_amp = utils.parse_html(content)
+    parsed_amp = utils.insert_html_amp(parsed_amp)
+    parsed_amp = utils.insert_canonical_link(parsed_amp, path)
+    parsed_amp = utils.exclude_javascript(parsed_amp)
+    parsed_amp = utils.insert_amp_js(parsed_amp)
+    parsed_amp = utils.insert_charset_meta(parsed_amp)
+    parsed_amp = utils.insert_viewport_meta(parsed_amp)
+    parsed_amp = utils.replace_external_stylesheets(parsed_amp)
+    parsed_amp = utils.insert_amp_css_boilerplate(parsed_amp)
+    parsed_amp = utils.replace_amp_img(parsed_amp)
+    parsed_amp = utils.prune_amp_css(parsed_amp)
+    return str(parsed_amp)
+
+
+@pytest.mark.parametrize(
+    "fixture_name", ["parsed_html", "parsed_html_lean", "parsed_html_mixed"]
+)
+def test_add_amp_tags_single_pass_equivalence(fixture_name, request, mocker):
+    """
+    Asserts that the single pass transform produces the same document as applying
+    every stage on its own.
+    """
+    mocker.patch("builtins.open", mock_open(read_data="body { color: red; }"))
+    mocked_get_img_size = mocker.patch("auto_amp.utils._get_image_info")
+    mocked_get_img_size.return_value = 800, 600
+    content = str(request.getfixturevalue(fixture_name))
+
+    assert utils.add_amp_tags(content, "/index") == _add_amp_tags_stage_by_stage(
+        content, "/index"
+    )
+
+
+def test_collect_tags(parsed_html_mixed):
+    """
+    Asserts that the tags each stage works on are collected in a single walk.
+    """
+    tags = utils.collect_tags(parsed_html_mixed)
+
+    assert tags["charset_meta"]["charset"] == "iso-8859-1"
+    assert tags["viewport_meta"]["content"] == "width=device-width"
+    assert [link["href"] for link in tags["stylesheets"]] == [
+        "/static/styles.css",
+        "/static/print.css",
+    ]
+    assert len(tags["scripts"]) == 4
+    assert len(tags["imgs"]) == 2
+
+
+def test_add_amp_tags_encoding(mocker):
+    """
+    Asserts that bytes are decoded from the given charset and the AMP document is
+    encoded to UTF-8, declaring it in its charset meta.
+    """
+    mocker.patch("auto_amp.utils._get_image_info", return_value=None)
+    content = "<html><head></head><body>Café</body></html>".encode("latin-1")
+
+    amp_content = utils.add_amp_tags(
+        content, "/index", charset="latin-1", encoding="utf-8"
+    )
+    assert isinstance(amp_content, bytes)
+    assert "Café".encode("utf-8") in amp_content
+    assert b'<meta charset="utf-8"/>' in amp_content
+
+
+@pytest.mark.parametrize(
+    "charset_meta",
+    [
+        '<meta charset="iso-8859-1">',
+        '<meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">',
+    ],
+)
+def test_add_amp_tags_declared_charset(charset_meta, mocker):
+    """
+    Asserts that the charset declared by documents is replaced with UTF-8, which
+    is declared once.
+    """
+    mocker.patch("auto_amp.utils._get_image_info", return_value=None)
+    content = f"<html><head>{charset_meta}</head><body>Café</body></html>".encode(
+        "latin-1"
+    )
+
+    amp_content = utils.add_amp_tags(content, "/index", encoding="utf-8")
+    assert "Café".encode("utf-8") in amp_content
+    assert amp_content.count(b"<meta") == 2
+    assert amp_content.count(b'<meta charset="utf-8"/>') == 1
+    assert b"iso-8859-1" not in amp_content
+
+
+def test_serialize_html_decomposes_tree(parsed_html):
+    """
+    Asserts that serializing a document frees its tree.
+    """
+    body = parsed_html.body
+
+    assert b"<!DOCTYPE hmtl>" in utils.serialize_html(parsed_html, "utf-8")
+    assert body.decomposed
@@ -0,0 +1,118 @@
+import struct
+
+from auto_amp import batch, utils
+
+
+def _documents(count):
+    return [
+        (
+            "<html><head>"
+            '<link rel="stylesheet" href="/static/styles.css">'
+            "</head><body>"
+            f'<img src="/static/img-{index}.png" width="40" height="30">'
+            "</body></html>",
+            f"/page-{index}/",
+        )
+        for index in range(count)
+    ]
+
+
+def test_add_amp_tags_many_ordered():
+    """
+    Asserts that documents are transformed on worker processes as they would be one
+    by one, and yielded in order.
+    """
+    documents = _documents(10)
+
+    results = list(batch.add_amp_tags_many(documents, workers=2, chunk_size=3))
+    assert [result.index for result in results] == list(range(10))
+    assert [result.path for result in results] == [path for _, path in documents]
+    assert [result.content for result in results] == [
+        utils.add_amp_tags(content, path) for content, path in documents
+    ]
+
+
+def test_add_amp_tags_many_as_completed():
+    """
+    Asserts that documents can be yielded as completed, with their errors.
+    """
+    documents = [*_documents(5), (None, "/invalid/")]
+
+    results = list(
+        batch.add_amp_tags_many(
+            documents, workers=2, chunk_size=2, ordered=False, encoding="utf-8"
+        )
+    )
+    assert sorted(result.index for result in results) == list(range(6))
+
+    results = {result.path: result for result in results}
+    assert results["/page-0/"].content.startswith(b"<html amp")
+    assert isinstance(results["/invalid/"].error, TypeError)
+    assert results["/invalid/"].content is None
+
+
+def test_add_amp_tags_many_backpressure():
+    """
+    Asserts that documents are only read as the chunks being transformed are
+    yielded.
+    """
+    read_count = 0
+
+    def documents():
+        nonlocal read_count
+        for document in _documents(100):
+            read_count += 1
+            yield document
+
+    results = batch.add_amp_tags_many(
+        documents(), workers=2, chunk_size=4, max_pending=2
+    )
+    next(results)
+    assert read_count == 12
+    results.close()
+
+
+def test_add_amp_tags_many_warm_caches():
+    """
+    Asserts that the stylesheets fetched by the parent process are shipped to the
+    worker processes.
+    """
+    batch._warm_caches(list(enumerate(_documents(1))), None)
+    cache_snapshot = batch._cache_snapshot()
+    assert [key for key, _, _ in cache_snapshot["stylesheets"]] == [
+        "/static/styles.css"
+    ]
+
+    utils.stylesheet_cache.clear()
+    batch._init_worker("app.settings", cache_snapshot)
+    assert utils.stylesheet_cache.get("/static/styles.css") is not None
+
+
+def test_add_amp_tags_many_probe_images(http_server, settings):
+    """
+    Asserts that worker processes probe unsized images with their own threads,
+    including the images already probed by the parent process.
+    """
+    settings.AUTO_AMP_IMAGE_PROBE_BUDGET = 2
+    for index in range(4):
+        http_server.routes[f"/{index}.png"] = {
+            "body": b"\x89PNG\r\n\x1a\n"
+            + struct.pack(">I", 13)
+            + b"IHDR"
+            + struct.pack(">IIBBBBB", 100 + index, 50, 8, 6, 0, 0, 0)
+        }
+    documents = [
+        (
+            f'<html><head></head><body><img src="{http_server.url}/{index}.png"></body></html>',
+            "/",
+        )
+        for index in range(4)
+    ]
+
+    results = list(batch.add_amp_tags_many(documents, workers=2, chunk_size=1))
+    for index, result in enumerate(results):
+        assert result.error is None, result.error
+        assert f'height="50" layout="responsive" src="{http_server.url}' in (
+            result.content
+        )
+        assert f'width="{100 + index}"' in result.content
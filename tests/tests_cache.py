@@ -0,0 +1,405 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.core.cache import caches
+
+from auto_amp import storage, utils
+from auto_amp.cache import LRUCache, SingleFlightCache, invalidate_amp_output
+from auto_amp.conf import DEFAULTS
+
+
+@pytest.fixture
+def stylesheet(tmp_path, settings):
+    """
+    Fixture to return a stylesheet file which the staticfiles finders resolve to.
+    """
+    stylesheet_path = tmp_path / "styles.css"
+    stylesheet_path.write_text("body { color: red; }")
+    settings.STATICFILES_DIRS = [str(tmp_path)]
+    return stylesheet_path
+
+
+def test_lru_cache_eviction():
+    """
+    Asserts that the least recently used entries are evicted to keep the cache
+    within its size limit.
+    """
+    cache = LRUCache(max_size=10)
+    cache.set("a", "aaaa", 4)
+    cache.set("b", "bbbb", 4)
+    assert cache.get("a") == "aaaa"
+
+    cache.set("c", "cccc", 4)
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+
+    cache.set("d", "d" * 11, 11)
+    assert cache.get("d") is None
+    assert cache.stats() == {"hits": 3, "misses": 2, "entries": 2, "size": 8}
+
+
+def test_lru_cache_is_valid():
+    """
+    Asserts that invalid entries are dropped and counted as misses.
+    """
+    cache = LRUCache(max_size=10)
+    cache.set("a", "aaaa", 4)
+
+    assert cache.get("a", is_valid=lambda value: False) is None
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 0, "misses": 2, "entries": 0, "size": 0}
+
+
+def test_fetch_file_content_cache(stylesheet, mocker):
+    """
+    Asserts that stylesheets are read once and served from the cache afterwards.
+    """
+    spied_find_stylesheet = mocker.spy(utils, "_find_stylesheet")
+    spied_open = mocker.patch("builtins.open", side_effect=open)
+
+    assert utils._fetch_file_content("/static/styles.css") == "body { color: red; }"
+    assert utils._fetch_file_content("/static/styles.css") == "body { color: red; }"
+
+    assert spied_open.call_count == 1
+    assert spied_find_stylesheet.call_count == 1
+    assert utils.stylesheet_cache.stats()["hits"] == 1
+    assert utils.stylesheet_cache.stats()["misses"] == 1
+
+
+def test_fetch_file_content_cache_mtime(stylesheet, mocker):
+    """
+    Asserts that cached stylesheets are read again once the file changes.
+    """
+    mocker.patch("auto_amp.utils.STATIC_FILES_CHECK_INTERVAL", 0)
+    spied_load_stylesheet = mocker.spy(utils, "_load_stylesheet")
+    assert utils._fetch_file_content("/static/styles.css") == "body { color: red; }"
+
+    stylesheet.write_text("body { color: blue; }")
+    stat = os.stat(stylesheet)
+    os.utime(stylesheet, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+    assert utils._fetch_file_content("/static/styles.css") == "body { color: blue; }"
+    assert spied_load_stylesheet.call_count == 2
+
+
+def test_fetch_file_content_cache_manifest(stylesheet, mocker):
+    """
+    Asserts that the staticfiles manifest hash is used to invalidate stylesheets
+    when available.
+    """
+    mocked_storage = mocker.patch("auto_amp.utils.staticfiles_storage")
+    mocked_storage.hashed_files = {"styles.css": "styles.abc123.css"}
+    mocker.patch("auto_amp.utils.STATIC_FILES_CHECK_INTERVAL", 0)
+    # Static files are indexed once, and not looked up again.
+    storage.get_static_files_index()
+    spied_stat = mocker.spy(utils.os, "stat")
+    spied_load_stylesheet = mocker.spy(utils, "_load_stylesheet")
+
+    utils._fetch_file_content("/static/styles.css")
+    utils._fetch_file_content("/static/styles.css")
+    assert spied_stat.call_count == 0
+    assert utils.stylesheet_cache.stats()["hits"] == 1
+
+    mocked_storage.hashed_files = {"styles.css": "styles.def456.css"}
+    utils._fetch_file_content("/static/styles.css")
+    assert spied_load_stylesheet.call_count == 2
+
+
+def test_fetch_file_content_imports(tmp_path, settings, caplog, mocker):
+    """
+    Asserts that imports are flattened recursively, and the flattened stylesheet is
+    read again once any file it imports changes.
+    """
+    mocker.patch("auto_amp.utils.STATIC_FILES_CHECK_INTERVAL", 0)
+    (tmp_path / "css").mkdir()
+    (tmp_path / "site.css").write_text(
+        '@import "css/base.css" screen;\n.site { color: red; }'
+    )
+    base_css = tmp_path / "css" / "base.css"
+    base_css.write_text("@import url(fonts.css);\n.base { color: red; }")
+    fonts_css = tmp_path / "css" / "fonts.css"
+    fonts_css.write_text("@font-face { src: url(../fonts/a.woff2); }")
+    (tmp_path / "cycle.css").write_text('@import "cycle.css";\n.cycle { color: red; }')
+    settings.STATICFILES_DIRS = [str(tmp_path)]
+
+    assert utils._fetch_file_content("/static/site.css") == (
+        "@media screen{@font-face { src: url(/static/fonts/a.woff2); }\n"
+        ".base { color: red; }}\n.site { color: red; }"
+    )
+    assert utils.stylesheet_dependencies("/static/site.css") == [
+        "/static/site.css",
+        "/static/css/base.css",
+        "/static/css/fonts.css",
+    ]
+
+    fonts_css.write_text("@font-face { src: url(b.woff2); }")
+    stat = os.stat(fonts_css)
+    os.utime(fonts_css, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert "url(/static/css/b.woff2)" in utils._fetch_file_content("/static/site.css")
+
+    assert utils._fetch_file_content("/static/cycle.css") == "\n.cycle { color: red; }"
+    assert "Cyclic or too deep @import" in caplog.text
+
+
+def test_fetch_file_content_cache_check_interval(stylesheet, mocker):
+    """
+    Asserts that cached stylesheets are checked against their files once per
+    interval, out of the cache lock.
+    """
+    mocked_monotonic = mocker.patch("auto_amp.utils.time.monotonic", return_value=0)
+    utils._fetch_file_content("/static/styles.css")
+    original_stat = os.stat
+
+    def stat(*args, **kwargs):
+        assert not utils.stylesheet_cache._lock.locked()
+        return original_stat(*args, **kwargs)
+
+    spied_stat = mocker.patch("auto_amp.utils.os.stat", side_effect=stat)
+
+    utils._fetch_file_content("/static/styles.css")
+    assert spied_stat.call_count == 0
+
+    mocked_monotonic.return_value = storage.STATIC_FILES_CHECK_INTERVAL
+    utils._fetch_file_content("/static/styles.css")
+    utils._fetch_file_content("/static/styles.css")
+    assert spied_stat.call_count == 1
+    assert utils.stylesheet_cache.stats()["misses"] == 1
+
+
+@pytest.fixture
+def single_flight_cache():
+    """
+    Fixture to return an empty two-tier cache.
+    """
+    return SingleFlightCache(
+        "tests", max_entries=10, timeout=60, negative_timeout=1, poll_interval=0.01
+    )
+
+
+def test_single_flight_cache_tiers(single_flight_cache, mocker):
+    """
+    Asserts that values are computed once and then served from the process memory
+    or, for other processes, from the Django cache.
+    """
+    compute = mocker.Mock(return_value=(800, 600))
+
+    assert single_flight_cache.get_or_set("/img.png", compute) == (800, 600)
+    assert single_flight_cache.get_or_set("/img.png", compute) == (800, 600)
+    assert single_flight_cache.local.stats()["hits"] == 1
+
+    single_flight_cache.clear()
+    assert single_flight_cache.get_or_set("/img.png", compute) == (800, 600)
+    assert compute.call_count == 1
+
+
+def test_single_flight_cache_negative_timeout(single_flight_cache, mocker):
+    """
+    Asserts that negative values are kept for a shorter time.
+    """
+    compute = mocker.Mock(side_effect=[(0, 0), (800, 600), (400, 300)])
+    mocked_monotonic = mocker.patch("auto_amp.cache.time.monotonic", return_value=0)
+    is_negative = lambda size: size == (0, 0)
+
+    assert single_flight_cache.get_or_set("/a.png", compute, is_negative) == (0, 0)
+    mocked_monotonic.return_value = 2
+    caches["default"].clear()
+    assert single_flight_cache.get_or_set("/a.png", compute, is_negative) == (800, 600)
+    mocked_monotonic.return_value = 4
+    assert single_flight_cache.get_or_set("/a.png", compute, is_negative) == (800, 600)
+    assert compute.call_count == 2
+
+
+def test_single_flight_cache_threads(single_flight_cache):
+    """
+    Asserts that concurrent lookups of the same key compute its value only once.
+    """
+    calls = []
+
+    def compute(key):
+        calls.append(key)
+        time.sleep(0.05)
+        return 800, 600
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda _: single_flight_cache.get_or_set("/img.png", compute), range(8)
+            )
+        )
+
+    assert results == [(800, 600)] * 8
+    assert calls == ["/img.png"]
+
+
+def test_single_flight_cache_independent_keys(single_flight_cache):
+    """
+    Asserts that a key being computed doesn't hold the lookups of other keys, and
+    that its waiters get the error computing it.
+    """
+    computing = threading.Event()
+    release = threading.Event()
+
+    def compute_slowly(key):
+        computing.set()
+        release.wait(5)
+        raise OSError("Unreachable")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        slow_lookups = [
+            executor.submit(single_flight_cache.get_or_set, "/slow.png", compute_slowly)
+            for _ in range(2)
+        ]
+        computing.wait(5)
+        start = time.monotonic()
+        for key in range(640):
+            assert single_flight_cache.get_or_set(f"/{key}.png", lambda key: (1, 1))
+        assert time.monotonic() - start < 1
+        release.set()
+
+        for lookup in slow_lookups:
+            with pytest.raises(OSError):
+                lookup.result()
+
+
+def test_single_flight_cache_shared_lock(single_flight_cache, mocker):
+    """
+    Asserts that a lookup waits for the value being computed by another process
+    instead of computing it again.
+    """
+    compute = mocker.Mock(return_value=(1, 1))
+    cache_key = f"tests:{hashlib.sha1(b'/img.png').hexdigest()}"
+    caches["default"].add(f"{cache_key}:lock", 1)
+
+    timer = threading.Timer(0.05, caches["default"].set, [cache_key, (800, 600)])
+    timer.start()
+    assert single_flight_cache.get_or_set("/img.png", compute) == (800, 600)
+    timer.join()
+    assert compute.call_count == 0
+
+
+def test_get_image_info_cache(mocker):
+    """
+    Asserts that each image URI is probed once.
+    """
+    mocked_probe = mocker.patch("auto_amp.utils._probe_image_info")
+    mocked_probe.return_value = 800, 600
+
+    assert utils._get_image_info("https://example.com/img.png") == (800, 600)
+    assert utils._get_image_info("https://example.com/img.png") == (800, 600)
+    assert mocked_probe.call_count == 1
+
+
+def test_canonical_to_amp_output_cache(
+    client, settings, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that the AMP output is reused while the canonical content is the same.
+    """
+    settings.AUTO_AMP_OUTPUT_CACHE_ALIAS = "default"
+
+    assert client.get("/amp/").content.startswith(b"<amp>")
+    assert client.get("/amp/").content.startswith(b"<amp>")
+    assert mocked_add_amp_tags.call_count == 1
+
+    canonical_index.content = "<html><head></head><body>Changed</body></html>"
+    assert b"Changed" in client.get("/amp/").content
+    assert mocked_add_amp_tags.call_count == 2
+
+    invalidate_amp_output("/")
+    client.get("/amp/")
+    assert mocked_add_amp_tags.call_count == 3
+
+
+def test_canonical_to_amp_output_cache_versions(
+    client, settings, mocker, stylesheet, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that the AMP output isn't reused once the pipeline or any of the
+    stylesheets it inlines changes.
+    """
+    settings.AUTO_AMP_OUTPUT_CACHE_ALIAS = "default"
+    mocker.patch("auto_amp.utils.STATIC_FILES_CHECK_INTERVAL", 0)
+    canonical_index.content = (
+        '<html><head><link href="/static/styles.css" rel="stylesheet"></head>'
+        "<body>Index</body></html>"
+    )
+
+    client.get("/amp/")
+    client.get("/amp/")
+    assert mocked_add_amp_tags.call_count == 1
+
+    stylesheet.write_text("body { color: blue; }")
+    stat = os.stat(stylesheet)
+    os.utime(stylesheet, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    client.get("/amp/")
+    client.get("/amp/")
+    assert mocked_add_amp_tags.call_count == 2
+
+    settings.AUTO_AMP_PIPELINE = DEFAULTS["PIPELINE"][:-1]
+    client.get("/amp/")
+    assert mocked_add_amp_tags.call_count == 3
+
+
+def test_canonical_to_amp_output_cache_image_fallbacks(
+    client, settings, mocker, canonical_index
+):
+    """
+    Asserts that the AMP output isn't cached while any of its images got the
+    fallback attributes, so they are measured again.
+    """
+    settings.AUTO_AMP_OUTPUT_CACHE_ALIAS = "default"
+    canonical_index.content = (
+        '<html><head></head><body><img src="https://example.com/img.png"></body>'
+        "</html>"
+    )
+    mocked_images_info = mocker.patch(
+        "auto_amp.utils._get_images_info",
+        side_effect=[{}, {"https://example.com/img.png": (640, 480)}],
+    )
+
+    assert b'height="0"' in client.get("/amp/").content
+    assert b'height="480"' in client.get("/amp/").content
+    assert b'height="480"' in client.get("/amp/").content
+    assert mocked_images_info.call_count == 2
+
+
+def test_linked_stylesheets():
+    """
+    Asserts that the stylesheets linked by raw documents are found without parsing
+    them.
+    """
+    assert utils.linked_stylesheets(
+        b'<link rel="icon" href="/favicon.ico"><LINK REL=\'Stylesheet\' '
+        b"href=/static/a.css><link rel=stylesheet><link href='/static/b.css' "
+        b'rel="alternate stylesheet" media=print>'
+    ) == ["/static/a.css", "/static/b.css"]
+
+
+@pytest.mark.parametrize(
+    "output_cache_settings",
+    [
+        {"AUTO_AMP_OUTPUT_CACHE_ALIAS": None},
+        {"AUTO_AMP_OUTPUT_CACHE_MAX_SIZE": 10},
+        {"AUTO_AMP_OUTPUT_CACHE_INCLUDE": ["/articles/"]},
+        {"AUTO_AMP_OUTPUT_CACHE_EXCLUDE": ["/"]},
+    ],
+)
+def test_canonical_to_amp_output_cache_disabled(
+    output_cache_settings, client, settings, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that the AMP output isn't cached when disabled, too big or for paths
+    that are excluded or not included.
+    """
+    settings.AUTO_AMP_OUTPUT_CACHE_ALIAS = "default"
+    for name, value in output_cache_settings.items():
+        setattr(settings, name, value)
+
+    client.get("/amp/")
+    client.get("/amp/")
+    assert mocked_add_amp_tags.call_count == 2
@@ -0,0 +1,188 @@
+import logging
+
+import pytest
+
+from auto_amp import utils
+from auto_amp.css import (
+    document_features,
+    markup_features,
+    minify_css,
+    parse_stylesheet,
+    resolve_references,
+    selector_features,
+    serialize_rules,
+)
+
+
+@pytest.mark.parametrize(
+    "selector,features",
+    [
+        ("div", {"div"}),
+        ("ul > li.item + li#last", {"ul", "li", ".item", "#last"}),
+        ('a[href^="https://"]:hover::after', {"a", "[href"}),
+        ("p:not(.hidden):nth-child(2n+1)", {"p"}),
+        (".md\\:flex", {".md:flex"}),
+        (".\\31 0", set()),
+        ("*", set()),
+        ("svg|a", set()),
+    ],
+)
+def test_selector_features(selector, features):
+    """
+    Asserts that selectors require the type names, ids, classes and attributes they
+    reference, but not the ones in pseudo-classes.
+    """
+    assert selector_features(selector) == features
+
+
+def test_parse_stylesheet():
+    """
+    Asserts that stylesheets are split in rules, whatever the comments and strings
+    they hold.
+    """
+    rules = parse_stylesheet(
+        """
+        @charset "utf-8";
+        /* header { color: red; } */
+        h1, .title { content: "}"; }
+        @media (min-width: 600px) { .wide { display: block; } }
+        @font-face { font-family: Sans; src: url(sans.woff); }
+        """
+    )
+
+    assert serialize_rules(rules) == [
+        '@charset "utf-8";',
+        'h1,.title{content: "}";}',
+        "@media (min-width: 600px){.wide{display: block;}}",
+        "@font-face{ font-family: Sans; src: url(sans.woff); }",
+    ]
+
+
+def test_minify_css():
+    """
+    Asserts that comments and needless whitespace are removed, but not from strings
+    nor where it is meaningful.
+    """
+    assert (
+        minify_css(
+            """
+        /* Header */
+        h1 ,  .title > a :hover {
+            content : "a ;  }" ;
+            margin : 0 auto ;
+        }
+        @media (min-width : 600px) { .wide { width : calc(100% - 2px); } }
+        """
+        )
+        == (
+            'h1,.title>a :hover{content:"a ;  }";margin:0 auto}'
+            "@media (min-width:600px){.wide{width:calc(100% - 2px)}}"
+        )
+    )
+
+
+def test_resolve_references():
+    """
+    Asserts that relative references are made absolute and imports replaced, leaving
+    comments, strings and other references untouched.
+    """
+    css = (
+        '@charset "utf-8";\n'
+        '@import url("base.css") screen;\n'
+        "@import 'print.css';\n"
+        "/* url(comment.png) */\n"
+        'a { background: url(../img/a.png); content: "url(b.png)"; }\n'
+        "b { background: url('b.png'), url(data:image/png;base64,AA), url(#f), "
+        "url(https://cdn.example.com/c.png), url(/d.png); }"
+    )
+
+    assert resolve_references(
+        css, "/static/css/site.css", lambda url, media: f"[{url} {media}]"
+    ) == (
+        "\n[/static/css/base.css screen]\n"
+        "[/static/css/print.css ]\n"
+        "/* url(comment.png) */\n"
+        'a { background: url(/static/img/a.png); content: "url(b.png)"; }\n'
+        "b { background: url('/static/css/b.png'), url(data:image/png;base64,AA), "
+        "url(#f), url(https://cdn.example.com/c.png), url(/d.png); }"
+    )
+
+
+def test_serialize_rules_pruned():
+    """
+    Asserts that selectors and rules which can't match the document are left out.
+    """
+    parsed_html = utils.parse_html(
+        '<html><body><h1 class="title">T</h1><amp-img src="a.png"></amp-img></body>'
+        "</html>"
+    )
+    rules = parse_stylesheet(
+        "h1, h2 { margin: 0 } .title { color: red } .missing { color: blue } "
+        "img { width: 100% } @media print { h2 { display: none } }"
+    )
+
+    assert serialize_rules(rules, document_features(parsed_html)) == [
+        "h1{margin: 0}",
+        ".title{color: red}",
+        "img{width: 100%}",
+    ]
+
+
+def test_markup_features():
+    """
+    Asserts that the features scanned from markup are the ones of the parsed
+    document, leaving out comments and the contents of scripts and styles.
+    """
+    markup = (
+        '<html><body><h1 class="title main" id=top>T</h1><input disabled>'
+        '<amp-img alt="a > b" src="a.png"></amp-img><!-- <p class="comment"> -->'
+        "<script>if (a<b) { c = 'd'; }</script><style>p > .e { }</style></body></html>"
+    )
+
+    assert markup_features(markup) == document_features(utils.parse_html(markup))
+    assert ".comment" not in markup_features(markup)
+
+
+def test_prune_amp_css(mocker):
+    """
+    Asserts that stylesheets are merged in a single AMP custom style and pruned,
+    parsing each stylesheet only once.
+    """
+    mocker.patch(
+        "auto_amp.utils._fetch_file_content",
+        side_effect=lambda href: {
+            "/static/base.css": "body { margin: 0 } .unused { color: red }",
+            "/static/page.css": "p { color: blue }",
+        }[href],
+    )
+    spied_parse_stylesheet = mocker.spy(utils, "parse_stylesheet")
+    content = (
+        '<html><head><link rel="stylesheet" href="/static/base.css">'
+        '<link rel="stylesheet" href="/static/page.css"></head>'
+        "<body><p>Text</p></body></html>"
+    )
+
+    for _ in range(2):
+        parsed_amp = utils.parse_html(utils.add_amp_tags(content, "/"))
+        inline_styles = parsed_amp.find_all("style", attrs={"amp-custom": True})
+        assert [style.string for style in inline_styles] == [
+            "body{margin: 0}p{color: blue}"
+        ]
+    assert spied_parse_stylesheet.call_count == 1
+
+
+def test_prune_amp_css_budget(settings, caplog):
+    """
+    Asserts that rules beyond the CSS budget are dropped and reported.
+    """
+    settings.AUTO_AMP_CSS_MAX_SIZE = 30
+    parsed_html = utils.parse_html(
+        "<html><head><style amp-custom>h1 { margin: 0 } p { margin: 0 } "
+        "p { padding: 0 }</style></head><body><h1>T</h1><p>P</p></body></html>"
+    )
+
+    with caplog.at_level(logging.WARNING, logger="auto_amp.utils"):
+        parsed_amp = utils.prune_amp_css(parsed_html)
+
+    assert parsed_amp.head.style.string == "h1{margin: 0}p{margin: 0}"
+    assert "1 of 3 rules were dropped" in caplog.text
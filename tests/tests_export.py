@@ -0,0 +1,92 @@
+import json
+
+import pytest
+from django.core.management import call_command
+
+from auto_amp.conf import DEFAULTS
+from auto_amp.export import MANIFEST_NAME, urlpattern_paths
+from test_utils import reload_module, reload_urlconf
+
+
+@pytest.fixture(autouse=True)
+def website_urls():
+    """
+    Fixture to route the website index to its view, as other tests mock it.
+    """
+    reload_module("website.urls")
+    reload_urlconf()
+
+
+def test_urlpattern_paths():
+    """
+    Asserts that URL patterns without parameters are found, leaving out the AMP and
+    namespaced ones.
+    """
+    assert urlpattern_paths() == ["/"]
+
+
+def test_amp_export(tmp_path, settings, capsys):
+    """
+    Asserts that AMP pages are written with a manifest of their dependencies, and
+    only transformed again when their canonical content, dependencies or transform
+    change.
+    """
+    call_command("amp_export", str(tmp_path), "--workers", "2")
+    assert "Exported 1 pages, 0 unchanged" in capsys.readouterr().out
+
+    amp_content = (tmp_path / "index.html").read_text()
+    assert '<html amp="">' in amp_content
+    assert '<link href="/" rel="canonical"/>' in amp_content
+
+    manifest = json.loads((tmp_path / MANIFEST_NAME).read_text())
+    assert list(manifest["/"]["dependencies"]) == ["/static/styles.css"]
+
+    call_command("amp_export", str(tmp_path), "--workers", "2")
+    assert "Exported 0 pages, 1 unchanged" in capsys.readouterr().out
+
+    manifest["/"]["dependencies"]["/static/styles.css"] = "outdated"
+    (tmp_path / MANIFEST_NAME).write_text(json.dumps(manifest))
+    call_command("amp_export", str(tmp_path), "--workers", "2")
+    assert "Exported 1 pages, 0 unchanged" in capsys.readouterr().out
+
+    settings.AUTO_AMP_PIPELINE = DEFAULTS["PIPELINE"][:-1]
+    call_command("amp_export", str(tmp_path), "--workers", "2")
+    assert "Exported 1 pages, 0 unchanged" in capsys.readouterr().out
+
+    settings.AUTO_AMP_IMAGE_FALLBACK_ATTRS = {"layout": "fill"}
+    call_command("amp_export", str(tmp_path), "--workers", "2")
+    assert "Exported 1 pages, 0 unchanged" in capsys.readouterr().out
+    call_command("amp_export", str(tmp_path), "--workers", "2")
+    assert "Exported 0 pages, 1 unchanged" in capsys.readouterr().out
+
+
+def test_amp_export_skipped_pages(tmp_path, capsys):
+    """
+    Asserts that unsuccessful pages aren't exported.
+    """
+    call_command("amp_export", str(tmp_path), "--path", "/missing/")
+    assert "1 skipped" in capsys.readouterr().out
+    assert not (tmp_path / "missing").exists()
+
+
+def test_amp_export_removed_pages(tmp_path, capsys):
+    """
+    Asserts that the pages of the previous export which aren't exported anymore are
+    deleted and left out of the manifest.
+    """
+    call_command("amp_export", str(tmp_path))
+    manifest = json.loads((tmp_path / MANIFEST_NAME).read_text())
+    for path in ("/old/page/", "/missing/"):
+        manifest[path] = manifest["/"]
+        page_path = tmp_path / path.strip("/") / "index.html"
+        page_path.parent.mkdir(parents=True)
+        page_path.write_text("<html amp></html>")
+    (tmp_path / MANIFEST_NAME).write_text(json.dumps(manifest))
+    capsys.readouterr()
+
+    call_command("amp_export", str(tmp_path), "--path", "/", "--path", "/missing/")
+    assert "1 skipped, 1 removed" in capsys.readouterr().out
+    assert not (tmp_path / "old").exists()
+    assert not (tmp_path / "missing").exists()
+    assert (tmp_path / "index.html").exists()
+    assert list(json.loads((tmp_path / MANIFEST_NAME).read_text())) == ["/"]
@@ -0,0 +1,170 @@
+import pytest
+from django.http import HttpResponse
+from django.template import Context, Template
+
+from auto_amp import fragments
+from auto_amp.conf import DEFAULTS
+from test_utils import reload_module, reload_urlconf
+
+
+PAGE_TEMPLATE = """{% load auto_amp static %}<html><head>
+<link rel="stylesheet" href="{% static 'styles.css' %}">
+</head><body>
+{% amp_cache header %}<header class="header">
+<link rel="stylesheet" href="/static/header.css">
+<img class="image" src="/static/logo.png" width="40" height="40">
+<script src="/static/menu.js"></script>
+</header>{% endamp_cache %}
+<p>{{ message }}</p><img src="/static/photo.png" width="80" height="60">
+</body></html>"""
+
+
+@pytest.fixture
+def canonical_page(mocker):
+    """
+    Fixture to serve a page rendering its header through the 'amp_cache' tag at the
+    website index.
+    """
+    template = Template(PAGE_TEMPLATE)
+    mocker.patch(
+        "website.views.index",
+        lambda request: HttpResponse(
+            template.render(Context({"message": request.GET.get("message", "")}))
+        ),
+    )
+    reload_module("website.urls")
+    reload_urlconf()
+
+
+def test_amp_cache_canonical():
+    """
+    Asserts that fragments are rendered as they are outside of AMP requests.
+    """
+    template = Template(
+        "{% load auto_amp %}{% amp_cache header %}<img>{% endamp_cache %}"
+    )
+    assert template.render(Context()) == "<img>"
+
+
+def test_amp_cache_collected(mocker):
+    """
+    Asserts that collected fragments are transformed once by key and replaced with
+    placeholders, which are spliced back.
+    """
+    spied_transform = mocker.spy(fragments, "transform_amp_fragment")
+    template = Template(
+        "{% load auto_amp %}"
+        "{% amp_cache header lang %}"
+        '<link rel="stylesheet" href="/static/header.css">'
+        '<img src="/static/logo.png" width="40" height="40">'
+        "<script>menu()</script>"
+        "{% endamp_cache %}"
+    )
+
+    collected = fragments.collect_amp_fragments()
+    try:
+        placeholder = template.render(Context({"lang": "en"}))
+        assert template.render(Context({"lang": "en"})) == placeholder
+        template.render(Context({"lang": "pt"}))
+    finally:
+        fragments.stop_collecting_amp_fragments()
+
+    assert spied_transform.call_count == 2
+    fragment = collected[placeholder[len("<!--amp-fragment:") : -len("-->")]]
+    assert fragment.content == (
+        '<amp-img height="40" layout="responsive" src="/static/logo.png" width="40">'
+        "</amp-img>"
+    )
+    assert fragment.stylesheets == ("/static/header.css",)
+    assert ".header" not in fragment.features and "amp-img" in fragment.features
+
+    assert (
+        fragments.splice_amp_fragments(
+            f"<body>{placeholder}</body>".encode(), collected
+        )
+        == f"<body>{fragment.content}</body>".encode()
+    )
+
+
+def test_amp_cache_image_fallbacks(mocker):
+    """
+    Asserts that fragments whose images got the fallback attributes aren't cached.
+    """
+    mocker.patch(
+        "auto_amp.utils._get_images_info",
+        side_effect=[{}, {"/static/logo.png": (40, 40)}, {}],
+    )
+    template = Template(
+        '{% load auto_amp %}{% amp_cache header %}<img src="/static/logo.png">'
+        "{% endamp_cache %}"
+    )
+
+    collected = fragments.collect_amp_fragments()
+    try:
+        for _ in range(3):
+            template.render(Context())
+    finally:
+        fragments.stop_collecting_amp_fragments()
+
+    assert [fragment.content for fragment in collected.values()] == [
+        '<amp-img height="0" layout="responsive" src="/static/logo.png" width="0">'
+        "</amp-img>",
+        '<amp-img height="40" layout="responsive" src="/static/logo.png" width="40">'
+        "</amp-img>",
+    ]
+
+
+def test_canonical_to_amp_fragments(client, mocker, canonical_page):
+    """
+    Asserts that AMP pages get the cached fragments spliced in, keeping the styles
+    they need, and that only the rest of the page is transformed again.
+    """
+    spied_transform = mocker.spy(fragments, "transform_amp_fragment")
+
+    amp_content = client.get("/amp/?message=Hello").content.decode()
+    assert '<header class="header">' in amp_content
+    assert '<amp-img class="image" height="40" layout="responsive"' in amp_content
+    assert '<amp-img height="60" layout="responsive" src="/static/photo.png"' in (
+        amp_content
+    )
+    assert "<script" not in amp_content.split("</head>")[1]
+    assert "<!--amp-fragment" not in amp_content
+    # The rules of the fragment classes are kept.
+    assert ".image{max-width: 800px;}" in amp_content
+
+    amp_content = client.get("/amp/?message=World").content.decode()
+    assert "<p>World</p>" in amp_content
+    assert '<header class="header">' in amp_content
+    assert spied_transform.call_count == 1
+
+
+def test_canonical_to_amp_fragments_pipeline(client, settings, mocker, canonical_page):
+    """
+    Asserts that fragments are transformed again once the stages change.
+    """
+    spied_transform = mocker.spy(fragments, "transform_amp_fragment")
+    client.get("/amp/")
+
+    settings.AUTO_AMP_PIPELINE = [
+        stage
+        for stage in DEFAULTS["PIPELINE"]
+        if not stage.endswith(".replace_amp_img")
+    ]
+    amp_content = client.get("/amp/").content.decode()
+    assert '<img class="image" height="40"' in amp_content
+    assert spied_transform.call_count == 2
+
+
+def test_amp_middleware_fragments(client, settings, canonical_page):
+    """
+    Asserts that the AMP middleware splices the cached fragments too.
+    """
+    settings.MIDDLEWARE = [
+        *settings.MIDDLEWARE,
+        "auto_amp.middleware.AutoAmpMiddleware",
+    ]
+
+    amp_content = client.get("/amp/").content.decode()
+    assert '<amp-img class="image" height="40" layout="responsive"' in amp_content
+    assert "<!--amp-fragment" not in amp_content
+    assert client.get("/").content.decode().count("<img") == 2
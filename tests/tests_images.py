@@ -0,0 +1,218 @@
+import io
+import struct
+import time
+
+import pytest
+
+from auto_amp import utils
+from auto_amp.images import open_local_image, read_image_size
+
+
+def _png(width, height):
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + struct.pack(">I", 13)
+        + b"IHDR"
+        + struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+        + b"\x00" * 64
+    )
+
+
+def _gif(width, height):
+    return b"GIF89a" + struct.pack("<HH", width, height) + b"\x00" * 64
+
+
+def _jpeg(width, height):
+    app0 = b"JFIF\x00" + b"\x00" * 200
+    exif = b"Exif\x00\x00" + b"\xff" * 1000
+    return (
+        b"\xff\xd8"
+        + b"\xff\xe0"
+        + struct.pack(">H", len(app0) + 2)
+        + app0
+        + b"\xff\xe1"
+        + struct.pack(">H", len(exif) + 2)
+        + exif
+        + b"\xff\xff\xc2"
+        + struct.pack(">HBHHB", 11, 8, height, width, 1)
+        + b"\x01\x11\x00"
+        + b"\x00" * 64
+    )
+
+
+def _webp(chunk, payload):
+    return b"RIFF" + struct.pack("<I", 100) + b"WEBP" + chunk + payload + b"\x00" * 64
+
+
+@pytest.mark.parametrize(
+    "content,size",
+    [
+        (_png(800, 600), (800, 600)),
+        (_gif(320, 240), (320, 240)),
+        (_jpeg(1024, 768), (1024, 768)),
+        (
+            _webp(
+                b"VP8 ",
+                struct.pack("<I", 50)
+                + b"\x00\x00\x00\x9d\x01\x2a"
+                + struct.pack("<HH", 400, 300),
+            ),
+            (400, 300),
+        ),
+        (
+            _webp(
+                b"VP8L",
+                struct.pack("<I", 50) + b"\x2f" + struct.pack("<I", 399 | 299 << 14),
+            ),
+            (400, 300),
+        ),
+        (
+            _webp(
+                b"VP8X",
+                struct.pack("<I", 10)
+                + b"\x00" * 4
+                + (1999).to_bytes(3, "little")
+                + (999).to_bytes(3, "little"),
+            ),
+            (2000, 1000),
+        ),
+        (
+            b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" '
+            b'stroke-width="2" width="120px" height="80.4"><path/></svg>',
+            (120, 80),
+        ),
+        (b'<svg viewBox="0 0 24 16" width="100%"></svg>', (24, 16)),
+        (b"<svg></svg>", None),
+        (b"BM" + b"\x00" * 64, None),
+        (b"\x89PNG\r\n\x1a\n", None),
+        (b"\xff\xd8\xff\xe0\x00\x10JFIF", None),
+    ],
+)
+def test_read_image_size(content, size):
+    """
+    Asserts that image dimensions are read from the image headers.
+    """
+    assert read_image_size(io.BytesIO(content)) == size
+
+
+def test_read_image_size_reads_headers_only():
+    """
+    Asserts that only the beginning of the image content is read.
+    """
+    image_file = io.BytesIO(_png(800, 600) + b"\x00" * 100000)
+    read_image_size(image_file)
+    assert image_file.tell() <= 32
+
+
+def test_open_local_image(tmp_path, settings):
+    """
+    Asserts that static and media URLs are resolved to their files.
+    """
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "img.png").write_bytes(_png(800, 600))
+    (tmp_path / "media").mkdir()
+    (tmp_path / "media" / "photo.gif").write_bytes(_gif(320, 240))
+    settings.STATICFILES_DIRS = [str(tmp_path / "static")]
+    settings.MEDIA_ROOT = str(tmp_path / "media")
+    settings.MEDIA_URL = "/media/"
+
+    with open_local_image("/static/img.png?v=1") as image_file:
+        assert read_image_size(image_file) == (800, 600)
+    with open_local_image("/media/photo.gif") as image_file:
+        assert read_image_size(image_file) == (320, 240)
+
+    assert open_local_image("/static/missing.png") is None
+    assert open_local_image("/media/missing.png") is None
+    assert open_local_image("https://example.com/img.png") is None
+    assert open_local_image("/static/../../etc/passwd") is None
+    assert open_local_image("/media/../../etc/passwd") is None
+    assert utils._probe_image_info("/media/%2E%2E/%2E%2E/etc/passwd") == (0, 0)
+
+
+def test_probe_image_info_local(tmp_path, settings, mocker):
+    """
+    Asserts that static images are measured without any network request.
+    """
+    (tmp_path / "img.png").write_bytes(_png(800, 600))
+    settings.STATICFILES_DIRS = [str(tmp_path)]
+    mocked_urlopen = mocker.patch("auto_amp.utils.urllib.request.urlopen")
+
+    assert utils._probe_image_info("/static/img.png") == (800, 600)
+    assert mocked_urlopen.call_count == 0
+
+
+def test_probe_image_info_remote(mocker):
+    """
+    Asserts that remote images are measured from their headers and unknown images
+    have empty dimensions.
+    """
+    mocked_urlopen = mocker.patch("auto_amp.utils.urllib.request.urlopen")
+
+    mocked_urlopen.return_value = io.BytesIO(_jpeg(1024, 768))
+    assert utils._probe_image_info("https://example.com/img.jpg") == (1024, 768)
+
+    mocked_urlopen.return_value = io.BytesIO(b"not an image")
+    assert utils._probe_image_info("https://example.com/img.bmp") == (0, 0)
+
+    mocked_urlopen.side_effect = OSError
+    assert utils._probe_image_info("https://example.com/img.png") == (0, 0)
+
+
+def test_replace_amp_img_concurrent_probes(http_server, settings):
+    """
+    Asserts that the images of a page are probed concurrently.
+    """
+    settings.AUTO_AMP_IMAGE_PROBE_BUDGET = 5
+    for i in range(8):
+        http_server.routes[f"/{i}.png"] = {"body": _png(10 * i + 10, 20), "delay": 0.3}
+    parsed_html = utils.parse_html(
+        "".join(f'<img src="{http_server.url}/{i}.png">' for i in range(8))
+    )
+
+    started_at = time.monotonic()
+    parsed_amp = utils.replace_amp_img(parsed_html)
+    assert time.monotonic() - started_at < 1.5
+
+    assert [
+        (img["width"], img["height"]) for img in parsed_amp.find_all("amp-img")
+    ] == [(str(10 * i + 10), "20") for i in range(8)]
+
+
+def test_replace_amp_img_probe_budget(http_server, settings):
+    """
+    Asserts that images not measured within the page budget get the fallback
+    attributes, and are measured in the background for the following pages.
+    """
+    settings.AUTO_AMP_IMAGE_PROBE_BUDGET = 0.2
+    settings.AUTO_AMP_IMAGE_FALLBACK_ATTRS = {"layout": "fill"}
+    http_server.routes["/fast.png"] = {"body": _png(800, 600)}
+    http_server.routes["/slow.png"] = {"body": _png(400, 300), "delay": 0.5}
+    content = (
+        f'<img src="{http_server.url}/fast.png">'
+        f'<img src="{http_server.url}/slow.png">'
+    )
+
+    started_at = time.monotonic()
+    fast_img, slow_img = utils.replace_amp_img(utils.parse_html(content)).find_all(
+        "amp-img"
+    )
+    assert time.monotonic() - started_at < 0.5
+    assert fast_img.attrs["width"] == "800"
+    assert fast_img.attrs["layout"] == "responsive"
+    assert slow_img.attrs["layout"] == "fill"
+    assert "width" not in slow_img.attrs
+
+    time.sleep(0.5)
+    slow_img = utils.replace_amp_img(utils.parse_html(content)).find_all("amp-img")[1]
+    assert (slow_img["width"], slow_img["height"]) == ("400", "300")
+    assert http_server.requests.count("/slow.png") == 1
+
+
+def test_probe_image_info_timeout(http_server, settings):
+    """
+    Asserts that images taking longer than the per image timeout are given up.
+    """
+    settings.AUTO_AMP_IMAGE_PROBE_TIMEOUT = 0.1
+    http_server.routes["/slow.png"] = {"body": _png(400, 300), "delay": 0.5}
+
+    assert utils._probe_image_info(f"{http_server.url}/slow.png") == (0, 0)
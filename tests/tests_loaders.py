@@ -0,0 +1,240 @@
+import pytest
+from django.http import HttpResponse
+from django.shortcuts import render
+
+from auto_amp import compiler, loaders, views
+from auto_amp.conf import DEFAULTS
+from auto_amp.compiler import compile_amp_template
+from test_utils import reload_module, reload_urlconf
+
+
+BASE_TEMPLATE = """{% load static %}<!DOCTYPE html>
+<html lang="{{ lang }}">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width">
+<title>{% block title %}{% endblock %}</title>
+<link rel="stylesheet" href="{% static 'styles.css' %}">
+</head>
+<body>
+<img src="/static/logo.png">
+{% block content %}{% endblock %}
+<script src="{% static 'scripts.js' %}"></script>
+<script>track();</script>
+</body>
+</html>"""
+
+PAGE_TEMPLATE = """{% extends "base.html" %}
+{% block content %}<p>{{ message }}</p>{{ widget|safe }}{% endblock %}"""
+
+
+@pytest.fixture
+def mocked_images_info(mocker):
+    """
+    Fixture to give the dimensions of all probed images.
+    """
+    return mocker.patch(
+        "auto_amp.utils._get_images_info",
+        side_effect=lambda uris: {uri: (320, 240) for uri in uris},
+    )
+
+
+@pytest.fixture
+def amp_loader(settings):
+    """
+    Fixture to load the templates through the AMP loader.
+    """
+    settings.TEMPLATES = [
+        {
+            "BACKEND": "django.template.backends.django.DjangoTemplates",
+            "OPTIONS": {
+                "loaders": [
+                    (
+                        "auto_amp.loaders.Loader",
+                        [
+                            (
+                                "django.template.loaders.locmem.Loader",
+                                {
+                                    "base.html": BASE_TEMPLATE,
+                                    "page.html": PAGE_TEMPLATE,
+                                },
+                            )
+                        ],
+                    )
+                ]
+            },
+        }
+    ]
+
+
+@pytest.fixture
+def canonical_page(mocker, amp_loader):
+    """
+    Fixture to render the page template at the website index.
+    """
+    mocker.patch(
+        "website.views.index",
+        lambda request: render(
+            request,
+            "page.html",
+            {
+                "lang": "en",
+                "message": "Hello",
+                "widget": (
+                    '<img class="image" src="/static/chart.png"><script>x()</script>'
+                ),
+            },
+        ),
+    )
+    reload_module("website.urls")
+    reload_urlconf()
+
+
+def test_compile_amp_template(mocked_images_info):
+    """
+    Asserts that the markup known before rendering is compiled, and the one made up
+    by template tokens is left as it is.
+    """
+    compiled = compile_amp_template(BASE_TEMPLATE)
+    assert compiled.startswith(
+        '{% load static %}<!DOCTYPE html>\n<html amp lang="{{ lang }}">'
+    )
+    assert (
+        '<head><meta charset="utf-8"><meta name="viewport" content="width=device-width,'
+        'minimum-scale=1,initial-scale=1">\n\n\n<title>{% block title %}{% endblock %}'
+        '</title>\n<link rel="stylesheet" href="{% static \'styles.css\' %}">\n'
+        f"{compiler.AMP_HEAD_END}</head>"
+    ) in compiled
+    assert (
+        '<amp-img src="/static/logo.png" layout="responsive" width="320" height="240">'
+        "</amp-img>"
+    ) in compiled
+    assert "<script src=\"{% static 'scripts.js' %}\"></script>" in compiled
+    assert "track()" not in compiled
+
+    assert (
+        compile_amp_template(
+            '<html><head><meta http-equiv="Content-Type" content="text/html; '
+            'charset=iso-8859-1"></head></html>'
+        )
+        == f"<html amp><head>{compiler.AMP_HEAD_START}{compiler.AMP_HEAD_END}</head></html>"
+    )
+
+    assert compile_amp_template(
+        '<img {% if lazy %}loading="lazy"{% endif %} src="/static/a.png">'
+        '<img src="{{ src }}"><img src="{{ src }}" width="10" height="{{ height }}">'
+    ) == (
+        '<img {% if lazy %}loading="lazy"{% endif %} src="/static/a.png">'
+        '<img src="{{ src }}"><amp-img src="{{ src }}" width="10" '
+        'height="{{ height }}" layout="responsive"></amp-img>'
+    )
+    mocked_images_info.assert_called_once_with(["/static/logo.png"])
+
+
+def test_compile_amp_template_unknown_images(mocker):
+    """
+    Asserts that images whose dimensions are unknown are left to be replaced once
+    rendered.
+    """
+    mocker.patch(
+        "auto_amp.utils._get_images_info",
+        return_value={"/static/a.png": (0, 0), "/static/b.png": (10, 20)},
+    )
+    assert compile_amp_template(
+        '<img src="/static/a.png"><img src="/static/b.png"><img src="/static/c.png">'
+    ) == (
+        '<img src="/static/a.png"><amp-img src="/static/b.png" layout="responsive" '
+        'width="10" height="20"></amp-img><img src="/static/c.png">'
+    )
+
+
+def test_amp_loader(client, mocker, mocked_images_info, canonical_page):
+    """
+    Asserts that AMP pages are rendered from compiled templates and completed
+    without being parsed, while canonical pages are rendered from the templates.
+    """
+    spied_add_amp_tags = mocker.spy(views, "add_amp_tags")
+    spied_compile = mocker.spy(loaders, "compile_amp_template")
+
+    amp_content = client.get("/amp/").content.decode()
+    assert amp_content.startswith('<!DOCTYPE html>\n<html amp lang="en">')
+    assert '<link rel="canonical" href="/"><style amp-custom="">' in amp_content
+    assert ".image{max-width: 800px;}" in amp_content
+    assert (
+        '<amp-img class="image" src="/static/chart.png" layout="responsive" '
+        'width="320" height="240"></amp-img>'
+    ) in amp_content
+    assert "<script" not in amp_content.split("</head>")[1]
+    assert amp_content.count("<meta") == 2
+    assert compiler.AMP_HEAD_MARKER not in amp_content
+    assert not spied_add_amp_tags.called
+
+    client.get("/amp/")
+    assert spied_compile.call_count == 2
+
+    canonical_content = client.get("/").content.decode()
+    assert '<img src="/static/logo.png">' in canonical_content
+    assert "<script>track();</script>" in canonical_content
+
+
+def test_finish_amp_page_prune(mocked_images_info):
+    """
+    Asserts that the merged stylesheets are pruned to the features of the page.
+    """
+    page = (
+        f"<html amp><head>{compiler.AMP_HEAD_END}"
+        '<link rel="stylesheet" href="/static/styles.css"></head>'
+        "<body><p>Text</p></body></html>"
+    )
+
+    amp_content = compiler.finish_amp_page(page, "/page", encoding="utf-8")
+    assert b'<link rel="canonical" href="/page">' in amp_content
+    assert b"body{font-family: sans-serif;}" in amp_content
+    assert b".image" not in amp_content
+
+
+def mark_body(parsed_amp):
+    """
+    Custom stage marking the body of AMP pages.
+    """
+    parsed_amp.body["class"] = "amp"
+    return parsed_amp
+
+
+def test_amp_loader_custom_pipeline(
+    client, settings, mocker, mocked_images_info, canonical_page
+):
+    """
+    Asserts that templates aren't compiled for custom stages, and AMP pages are
+    fully transformed by them instead.
+    """
+    settings.AUTO_AMP_PIPELINE = [*DEFAULTS["PIPELINE"], mark_body]
+    spied_add_amp_tags = mocker.spy(views, "add_amp_tags")
+    spied_compile = mocker.spy(loaders, "compile_amp_template")
+
+    amp_content = client.get("/amp/").content.decode()
+    assert '<body class="amp">' in amp_content
+    assert spied_add_amp_tags.call_count == 1
+    assert not spied_compile.called
+
+
+def test_amp_head_marker_without_loader(client, mocker, mocked_images_info):
+    """
+    Asserts that pages which happen to hold the AMP head marker are fully
+    transformed when they weren't rendered from compiled templates.
+    """
+    mocker.patch(
+        "website.views.index",
+        lambda request: HttpResponse(
+            f"<html><head>{compiler.AMP_HEAD_MARKER}</head>"
+            '<body><img src="/static/logo.png"></body></html>'
+        ),
+    )
+    reload_module("website.urls")
+    reload_urlconf()
+    spied_add_amp_tags = mocker.spy(views, "add_amp_tags")
+
+    amp_content = client.get("/amp/").content.decode()
+    assert "<amp-img" in amp_content
+    assert 'rel="canonical"' in amp_content
+    assert spied_add_amp_tags.call_count == 1
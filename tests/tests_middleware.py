@@ -0,0 +1,131 @@
+import pytest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+
+from auto_amp import views
+
+
+HTML_DOCUMENT = "<html><head></head><body>Index</body></html>"
+
+
+@pytest.fixture(autouse=True)
+def amp_middleware(settings):
+    """
+    Fixture to enable the AMP middleware.
+    """
+    settings.MIDDLEWARE = [
+        *settings.MIDDLEWARE,
+        "auto_amp.middleware.AutoAmpMiddleware",
+    ]
+
+
+def test_amp_middleware_path_prefix(
+    client, mocker, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that AMP requests are routed to the canonical view once and its response
+    is transformed.
+    """
+    spied_resolve = mocker.spy(views, "resolve")
+
+    amp_response = client.get("/amp/")
+    assert amp_response.status_code == 200
+    assert amp_response.content.startswith(b"<amp>")
+    assert canonical_index.call_count == 1
+    assert mocked_add_amp_tags.call_args[0][1] == "/"
+    assert spied_resolve.call_count == 0
+
+    canonical_response = client.get("/")
+    assert canonical_response.content == HTML_DOCUMENT.encode()
+    assert mocked_add_amp_tags.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "canonical_response",
+    [
+        JsonResponse({"key": "value"}),
+        HttpResponse(HTML_DOCUMENT, status=404),
+        StreamingHttpResponse([HTML_DOCUMENT]),
+    ],
+)
+def test_amp_middleware_skipped_responses(
+    canonical_response, client, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that non-HTML, unsuccessful and streaming responses aren't transformed.
+    """
+    canonical_index.side_effect = lambda request: canonical_response
+
+    client.get("/amp/")
+    assert mocked_add_amp_tags.call_count == 0
+
+
+def test_amp_middleware_query_param(
+    client, settings, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that AMP requests are recognized by a query parameter.
+    """
+    settings.AUTO_AMP_PATH_PREFIX = None
+    settings.AUTO_AMP_QUERY_PARAM = "amp"
+
+    assert client.get("/?amp=1").content.startswith(b"<amp>")
+    assert client.get("/").content == HTML_DOCUMENT.encode()
+
+
+def test_amp_middleware_accept_type(
+    client, settings, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that AMP requests are recognized by the 'Accept' header and responses
+    vary on it.
+    """
+    settings.AUTO_AMP_ACCEPT_TYPE = "application/amp+html"
+
+    amp_response = client.get("/", HTTP_ACCEPT="application/amp+html, text/html")
+    assert amp_response.content.startswith(b"<amp>")
+    assert amp_response["Vary"] == "Accept"
+
+    canonical_response = client.get("/", HTTP_ACCEPT="text/html")
+    assert canonical_response.content == HTML_DOCUMENT.encode()
+    assert canonical_response["Vary"] == "Accept"
+
+
+@pytest.mark.parametrize(
+    "accept, is_amp",
+    [
+        ("text/html;q=0.9, Application/AMP+HTML ; q=1.0", True),
+        ("application/amp+html;level=1", True),
+        ("application/amp+html;q=0, text/html", False),
+        ("application/amp+html;q=0.000", False),
+        ("application/amp+html-draft, text/html", False),
+        ("*/*", False),
+    ],
+)
+def test_amp_middleware_accept_quality(
+    accept, is_amp, client, settings, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that the 'Accept' header media ranges are matched as a whole, and that
+    a zero quality refuses AMP pages.
+    """
+    settings.AUTO_AMP_ACCEPT_TYPE = "application/amp+html"
+
+    amp_response = client.get("/", HTTP_ACCEPT=accept)
+    assert amp_response.content.startswith(b"<amp>") is is_amp
+
+
+def test_amp_middleware_content_length(client, canonical_index, mocked_add_amp_tags):
+    """
+    Asserts that the 'Content-Length' header set by the view matches the AMP
+    content.
+    """
+
+    def index(request):
+        response = HttpResponse(HTML_DOCUMENT)
+        response["Content-Length"] = len(response.content)
+        return response
+
+    canonical_index.side_effect = index
+    mocked_add_amp_tags.side_effect = lambda content, path, **kwargs: "<amp></amp>"
+
+    assert client.get("/amp/")["Content-Length"] == "11"
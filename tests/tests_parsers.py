@@ -0,0 +1,126 @@
+import pytest
+from bs4.builder import builder_registry
+from django.core.exceptions import ImproperlyConfigured
+
+from auto_amp import utils
+
+
+INSTALLED_BACKENDS = [
+    backend for backend in utils.PARSER_BACKENDS if builder_registry.lookup(backend)
+]
+
+HTML_DOCUMENT = """
+<!doctype html>
+<html lang="en">
+    <head>
+        <meta charset="utf-8">
+        <title>Page title</title>
+        <link rel="stylesheet" href="/static/styles.css">
+        <script src="/static/head.js"></script>
+    </head>
+    <body>
+        <h1>Django Auto AMP</h1>
+        <p>Generate automatic <em>AMP</em> from your Django templates</p>
+        <img src="/static/img.jpg" width="500" height="300">
+        <img src="/static/img.gif" layout="nodisplay">
+        <script type="text/javascript">console.log("dropped");</script>
+        <script type="application/json">{"key": "value"}</script>
+    </body>
+</html>
+"""
+
+MALFORMED_HTML_DOCUMENT = """
+<!doctype hmtl>
+<html>
+    <head><title>Page title</title></head>
+    <body>
+        <script type="text/javascript" src="/static/scripts.js" />
+        <script type="application/json" src="/static/data.json" />
+    </body>
+</html>
+"""
+
+
+def _document_signature(content):
+    """
+    Summarizes a document as its tags, attributes and non-blank strings, in document
+    order, ignoring the formatting differences between backends.
+    """
+    parsed = utils.parse_html(content)
+    return [
+        (tag.name, sorted(tag.attrs.items()), tag.string and tag.string.strip())
+        for tag in parsed.find_all(True)
+    ]
+
+
+@pytest.mark.parametrize("backend", INSTALLED_BACKENDS)
+def test_add_amp_tags_backend_matrix(backend, settings, mocked_resources):
+    """
+    Asserts that every installed parser backend produces the same AMP document.
+    """
+    expected = _document_signature(utils.add_amp_tags(HTML_DOCUMENT, "/"))
+
+    settings.AUTO_AMP_PARSER = backend
+    amp_content = utils.add_amp_tags(HTML_DOCUMENT, "/")
+
+    settings.AUTO_AMP_PARSER = "html.parser"
+    assert _document_signature(amp_content) == expected
+
+
+@pytest.mark.parametrize(
+    "backend,leading_content,scripts",
+    [
+        # html.parser keeps what precedes the doctype and closes '<script />'.
+        ("html.parser", "\n", ["application/json"]),
+        # lxml drops what precedes the doctype and closes '<script />'.
+        ("lxml", "", ["application/json"]),
+        # html5lib follows browsers: '<script />' is left open and swallows the rest
+        # of the document as its text, which is then removed with it.
+        ("html5lib", "", []),
+    ],
+)
+def test_add_amp_tags_malformed_markup(
+    backend, leading_content, scripts, settings, mocked_resources
+):
+    """
+    Documents how each backend handles malformed markup, such as a misspelled doctype
+    and self-closing script tags.
+    """
+    if backend not in INSTALLED_BACKENDS:
+        pytest.skip(f"{backend} is not installed")
+
+    settings.AUTO_AMP_PARSER = backend
+    amp_content = utils.add_amp_tags(MALFORMED_HTML_DOCUMENT, "/")
+
+    assert amp_content.startswith(f"{leading_content}<!DOCTYPE hmtl>")
+
+    settings.AUTO_AMP_PARSER = "html.parser"
+    parsed_amp = utils.parse_html(amp_content)
+    assert [
+        script.get("type") for script in parsed_amp.body.find_all("script")
+    ] == scripts
+
+
+def test_get_parser_fastest_installed(settings, mocker):
+    """
+    Asserts that the fastest installed backend is used when no parser is set.
+    """
+    del settings.AUTO_AMP_PARSER
+    mocked_lookup = mocker.patch("auto_amp.utils.builder_registry.lookup")
+
+    mocked_lookup.side_effect = lambda backend: backend != "lxml"
+    assert utils.get_parser() == "html.parser"
+
+    mocked_lookup.side_effect = lambda backend: True
+    assert utils.get_parser() == "lxml"
+
+
+def test_get_parser_not_installed(settings):
+    """
+    Asserts that setting a parser which isn't installed is reported as a
+    configuration error.
+    """
+    settings.AUTO_AMP_PARSER = "not-a-parser"
+
+    with pytest.raises(ImproperlyConfigured):
+        utils.get_parser()
@@ -0,0 +1,83 @@
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+
+from auto_amp import utils
+from auto_amp.pipeline import amp_stage, contains, load_pipeline
+
+
+HTML_DOCUMENT = "<html><head></head><body><amp-widget></amp-widget></body></html>"
+
+stage_calls = []
+
+
+@amp_stage("widgets", requires=contains("<AMP-WIDGET"))
+def insert_widget_script(parsed_amp, path, tags):
+    """
+    Custom stage adding the script of the 'amp-widget' component.
+    """
+    stage_calls.append((path, sorted(tags)))
+    script = parsed_amp.new_tag("script", attrs={"custom-element": "amp-widget"})
+    parsed_amp.head.append(script)
+    return parsed_amp
+
+
+def mark_body(parsed_amp):
+    """
+    Custom stage without declaration nor optional arguments.
+    """
+    parsed_amp.body["class"] = "amp"
+    return parsed_amp
+
+
+@pytest.fixture(autouse=True)
+def clear_stage_calls():
+    stage_calls.clear()
+
+
+def test_custom_pipeline(settings):
+    """
+    Asserts that the listed stages are applied in order, given the arguments they
+    accept.
+    """
+    settings.AUTO_AMP_PIPELINE = [
+        "auto_amp.utils.insert_html_amp",
+        "tests_pipeline.insert_widget_script",
+        mark_body,
+    ]
+
+    amp_content = utils.add_amp_tags(HTML_DOCUMENT, "/widget")
+    assert amp_content == (
+        '<html amp=""><head><script custom-element="amp-widget"></script></head>'
+        '<body class="amp"><amp-widget></amp-widget></body></html>'
+    )
+    assert stage_calls == [
+        ("/widget", ["charset_meta", "imgs", "scripts", "stylesheets", "viewport_meta"])
+    ]
+
+
+def test_pipeline_preconditions(settings, mocker):
+    """
+    Asserts that stages whose precondition fails on the raw document are skipped.
+    """
+    settings.AUTO_AMP_PIPELINE = [insert_widget_script]
+    spied_unsized_image_sources = mocker.spy(utils, "unsized_image_sources")
+
+    utils.add_amp_tags(b"<html><head></head><body></body></html>", "/")
+    assert stage_calls == []
+
+    utils.add_amp_tags(HTML_DOCUMENT.encode(), "/")
+    assert len(stage_calls) == 1
+    assert spied_unsized_image_sources.call_count == 0
+
+
+@pytest.mark.parametrize(
+    "stage", ["auto_amp.utils.missing_stage", "auto_amp.utils.AMP_JS_URL"]
+)
+def test_pipeline_validation(settings, stage):
+    """
+    Asserts that stages which can't be imported or called are reported.
+    """
+    settings.AUTO_AMP_PIPELINE = [stage]
+
+    with pytest.raises(ImproperlyConfigured):
+        load_pipeline()
@@ -0,0 +1,203 @@
+import http.client
+import time
+
+import pytest
+
+from auto_amp import remote, utils
+
+
+CSS_CONTENT = b"body { font-family: Roboto; }"
+
+
+@pytest.fixture
+def remote_hosts(settings):
+    """
+    Fixture to allow the stylesheets of the local HTTP server.
+    """
+    settings.AUTO_AMP_REMOTE_STYLESHEET_HOSTS = ["127.0.0.1"]
+
+
+def test_fetch_remote_stylesheet_allowed_hosts(http_server, settings):
+    """
+    Asserts that only stylesheets of the allowed hosts are fetched.
+    """
+    http_server.routes["/styles.css"] = {"body": CSS_CONTENT}
+
+    assert remote.fetch_remote_stylesheet(f"{http_server.url}/styles.css") is None
+    assert http_server.requests == []
+
+    settings.AUTO_AMP_REMOTE_STYLESHEET_HOSTS = [".example.com", "127.0.0.1"]
+    assert remote.fetch_remote_stylesheet(f"{http_server.url}/styles.css") == (
+        CSS_CONTENT.decode()
+    )
+    assert remote.remote_stylesheet_url("//cdn.example.com/styles.css") == (
+        "https://cdn.example.com/styles.css"
+    )
+    assert remote.remote_stylesheet_url("/static/styles.css") is None
+
+
+def test_fetch_remote_stylesheet_cache(http_server, remote_hosts):
+    """
+    Asserts that fresh stylesheets are served from the in-process cache, and from
+    the shared cache by other processes, over a single persistent connection.
+    """
+    http_server.routes["/styles.css"] = {
+        "body": CSS_CONTENT,
+        "headers": {"Cache-Control": "public, max-age=60"},
+    }
+    http_server.routes["/other.css"] = {"body": CSS_CONTENT}
+
+    url = f"{http_server.url}/styles.css"
+    assert remote.fetch_remote_stylesheet(url) == CSS_CONTENT.decode()
+    assert remote.fetch_remote_stylesheet(url) == CSS_CONTENT.decode()
+    remote.remote_stylesheet_cache.clear()
+    assert remote.fetch_remote_stylesheet(url) == CSS_CONTENT.decode()
+    assert http_server.requests == ["/styles.css"]
+
+    remote.fetch_remote_stylesheet(f"{http_server.url}/other.css")
+    assert http_server.connections == 1
+
+
+def test_fetch_remote_stylesheet_revalidation(http_server, remote_hosts):
+    """
+    Asserts that stale stylesheets are revalidated with their ETag, and kept when
+    the revalidation fails.
+    """
+    http_server.routes["/styles.css"] = {
+        "body": CSS_CONTENT,
+        "headers": {"Cache-Control": "no-cache", "ETag": '"v1"'},
+    }
+    url = f"{http_server.url}/styles.css"
+    assert remote.fetch_remote_stylesheet(url) == CSS_CONTENT.decode()
+
+    http_server.routes["/styles.css"] = {"body": b"", "status": 304}
+    assert remote.fetch_remote_stylesheet(url) == CSS_CONTENT.decode()
+    assert http_server.request_headers[1]["If-None-Match"] == '"v1"'
+
+    http_server.routes["/styles.css"] = {"body": b"", "status": 500}
+    assert remote.fetch_remote_stylesheet(url) == CSS_CONTENT.decode()
+    assert len(http_server.requests) == 3
+
+
+def test_fetch_remote_stylesheet_no_store(http_server, remote_hosts):
+    """
+    Asserts that stylesheets which must not be stored are fetched every time.
+    """
+    http_server.routes["/styles.css"] = {
+        "body": CSS_CONTENT,
+        "headers": {"Cache-Control": "no-store"},
+    }
+    url = f"{http_server.url}/styles.css"
+
+    remote.fetch_remote_stylesheet(url)
+    remote.fetch_remote_stylesheet(url)
+    assert len(http_server.requests) == 2
+
+
+def test_replace_external_stylesheets_remote(http_server, remote_hosts):
+    """
+    Asserts that the remote stylesheets of a page are fetched concurrently and
+    inlined in order, leaving out the ones which couldn't be fetched.
+    """
+    for i in range(4):
+        http_server.routes[f"/{i}.css"] = {
+            "body": f".remote-{i} {{ color: red; }}".encode(),
+            "delay": 0.3,
+        }
+    parsed_html = utils.parse_html(
+        "<html><head>"
+        + "".join(
+            f'<link rel="stylesheet" href="{http_server.url}/{i}.css">'
+            for i in range(5)
+        )
+        + "</head><body></body></html>"
+    )
+
+    started_at = time.monotonic()
+    parsed_amp = utils.replace_external_stylesheets(parsed_html)
+    assert time.monotonic() - started_at < 0.9
+
+    inline_css = parsed_amp.head.find("style", attrs={"amp-custom": ""})
+    assert inline_css.string == "\n".join(
+        f".remote-{i} {{ color: red; }}" for i in range(4)
+    )
+    assert not parsed_amp.find("link")
+
+
+def test_fetch_file_content_remote_imports(http_server, remote_hosts):
+    """
+    Asserts that remote stylesheets are flattened with their imports, and their
+    relative references made absolute against their URL.
+    """
+    http_server.routes["/css/fonts.css"] = {
+        "body": b'@import "icons.css";\n@font-face { src: url(../fonts/a.woff2); }'
+    }
+    http_server.routes["/css/icons.css"] = {"body": b".icon { color: red; }"}
+
+    assert utils._fetch_file_content(f"{http_server.url}/css/fonts.css") == (
+        ".icon { color: red; }\n"
+        f"@font-face {{ src: url({http_server.url}/fonts/a.woff2); }}"
+    )
+
+
+def test_fetch_file_content_static_remote_imports(
+    http_server, remote_hosts, settings, tmp_path, mocker
+):
+    """
+    Asserts that the remote imports of static stylesheets are fetched concurrently
+    within the budget, and that flattened stylesheets are checked against the
+    expiry of their remote imports without fetching them.
+    """
+    mocker.patch("auto_amp.utils.STATIC_FILES_CHECK_INTERVAL", 0)
+    settings.AUTO_AMP_REMOTE_STYLESHEET_BUDGET = 0.5
+    for name in ("a", "b"):
+        http_server.routes[f"/{name}.css"] = {
+            "body": f".{name} {{ color: red; }}".encode(),
+            "headers": {"Cache-Control": "max-age=60"},
+            "delay": 0.3,
+        }
+    http_server.routes["/slow.css"] = {"body": b".slow { color: red; }", "delay": 2}
+    (tmp_path / "site.css").write_text(
+        "".join(
+            f'@import "{http_server.url}/{name}.css";\n' for name in ("a", "b", "slow")
+        )
+    )
+    settings.STATICFILES_DIRS = [str(tmp_path)]
+
+    start = time.monotonic()
+    assert utils._fetch_file_content("/static/site.css") == (
+        ".a { color: red; }\n.b { color: red; }\n\n"
+    )
+    assert time.monotonic() - start < 1
+
+    utils._fetch_file_content("/static/site.css")
+    assert http_server.requests.count("/a.css") == 1
+    assert http_server.requests.count("/b.css") == 1
+
+
+def test_fetch_remote_stylesheet_unknown_charset(http_server, remote_hosts):
+    """
+    Asserts that stylesheets declaring an unknown charset are decoded as UTF-8.
+    """
+    http_server.routes["/styles.css"] = {
+        "body": CSS_CONTENT,
+        "headers": {"Content-Type": "text/css; charset=x-unknown"},
+    }
+
+    assert remote.fetch_remote_stylesheet(f"{http_server.url}/styles.css") == (
+        CSS_CONTENT.decode()
+    )
+
+
+def test_fetch_remote_stylesheet_https_downgrade(remote_hosts, mocker):
+    """
+    Asserts that redirects from HTTPS to HTTP aren't followed.
+    """
+    headers = http.client.HTTPMessage()
+    headers["Location"] = "http://127.0.0.1/styles.css"
+    mocked_request = mocker.patch.object(
+        remote.connection_pool, "request", return_value=(301, headers, b"")
+    )
+
+    assert remote.fetch_remote_stylesheet("https://127.0.0.1/styles.css") is None
+    assert mocked_request.call_count == 1
@@ -0,0 +1,171 @@
+import os
+import struct
+
+from django.apps import apps
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+
+from auto_amp import storage, utils
+
+
+def test_amp_css_storage(tmp_path, settings):
+    """
+    Asserts that minified AMP variants of the stylesheets are written at
+    'collectstatic' and inlined instead of the original stylesheets.
+    """
+    settings.STATIC_ROOT = str(tmp_path)
+    settings.STATICFILES_STORAGE = "auto_amp.storage.AmpStaticFilesStorage"
+    call_command("collectstatic", interactive=False, verbosity=0)
+
+    assert (tmp_path / "styles.amp.css").read_text() == (
+        "body{font-family:sans-serif}.image{max-width:800px}"
+    )
+    assert not (tmp_path / "scripts.amp.css").exists()
+    assert utils._fetch_file_content("/static/styles.css") == (
+        "body{font-family:sans-serif}.image{max-width:800px}"
+    )
+
+
+def test_amp_css_storage_edited_stylesheets(tmp_path, settings, mocker):
+    """
+    Asserts that AMP variants are left out once their stylesheet is edited after
+    'collectstatic', and in DEBUG.
+    """
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    stylesheet = source_dir / "edited.css"
+    stylesheet.write_text(".a { color: red; }")
+    settings.STATICFILES_DIRS = [str(source_dir)]
+    settings.STATIC_ROOT = str(tmp_path / "root")
+    settings.STATICFILES_STORAGE = "auto_amp.storage.AmpStaticFilesStorage"
+    call_command("collectstatic", interactive=False, verbosity=0)
+    assert storage.find_static_file("edited.amp.css") is not None
+
+    settings.DEBUG = True
+    assert storage.find_static_file("edited.amp.css") is None
+
+    settings.DEBUG = False
+    stylesheet.write_text(".a { color: blue; }")
+    stat = os.stat(stylesheet)
+    os.utime(stylesheet, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    storage.clear_static_files_index()
+    assert "blue" in utils._fetch_file_content("/static/edited.css")
+
+
+def test_amp_css_manifest_storage(tmp_path, settings):
+    """
+    Asserts that AMP variants are minified from the stylesheets hashed by the
+    manifest storage, and kept in the manifest under hashed names.
+    """
+    source_path = tmp_path / "source"
+    source_path.mkdir()
+    (source_path / "page.css").write_text(".page { background: url(img.png); }")
+    (source_path / "img.png").write_bytes(b"image")
+    settings.STATICFILES_DIRS = [str(source_path)]
+    settings.STATIC_ROOT = str(tmp_path / "root")
+    settings.STATICFILES_STORAGE = "auto_amp.storage.AmpManifestStaticFilesStorage"
+    call_command("collectstatic", interactive=False, verbosity=0)
+
+    hashed_image = staticfiles_storage.stored_name("img.png")
+    hashed_amp_name = staticfiles_storage.stored_name("page.amp.css")
+    assert hashed_amp_name == (
+        f"{staticfiles_storage.stored_name('page.css')[: -len('.css')]}.amp.css"
+    )
+    assert (tmp_path / "root" / hashed_amp_name).read_text() == (
+        f'.page{{background:url("{hashed_image}")}}'
+    )
+    assert (tmp_path / "root" / "page.amp.css").exists()
+    assert utils._fetch_file_content("/static/page.css") == (
+        f'.page{{background:url("/static/{hashed_image}")}}'
+    )
+
+
+def test_static_files_index_manifest(tmp_path, settings, mocker):
+    """
+    Asserts that static files are looked up in the staticfiles manifest, hashed
+    names included, without running the staticfiles finders.
+    """
+    settings.STATIC_ROOT = str(tmp_path)
+    settings.STATICFILES_STORAGE = "auto_amp.storage.AmpManifestStaticFilesStorage"
+    call_command("collectstatic", interactive=False, verbosity=0)
+    spied_find = mocker.spy(storage.finders, "find")
+    spied_get_finders = mocker.spy(storage.finders, "get_finders")
+
+    hashed_name = staticfiles_storage.stored_name("styles.css")
+    assert storage.find_static_file(hashed_name) == str(tmp_path / hashed_name)
+    assert utils._fetch_file_content(f"/static/{hashed_name}") == (
+        "body{font-family:sans-serif}.image{max-width:800px}"
+    )
+    assert spied_find.call_count == 0
+    assert spied_get_finders.call_count == 0
+
+
+def test_static_files_index_debug(tmp_path, settings, mocker):
+    """
+    Asserts that the static files index is built again in DEBUG when static files
+    are added or removed.
+    """
+    settings.DEBUG = True
+    settings.STATICFILES_DIRS = [str(tmp_path)]
+    mocker.patch("auto_amp.storage.STATIC_FILES_CHECK_INTERVAL", 0)
+    assert storage.find_static_file("added.css") is None
+
+    # Directory modification times may not change within the same clock tick.
+    os.utime(tmp_path, ns=(0, 0))
+    (tmp_path / "added.css").write_text("body { color: red; }")
+    assert storage.find_static_file("added.css") == str(tmp_path / "added.css")
+
+    os.utime(tmp_path, ns=(0, 0))
+    (tmp_path / "added.css").unlink()
+    assert storage.find_static_file("added.css") is None
+
+
+def test_static_files_index_lazy(mocker):
+    """
+    Asserts that the static files index isn't built when Django starts, but on the
+    first lookup.
+    """
+    spied_load = mocker.spy(storage, "load_static_files_index")
+
+    apps.get_app_config("auto_amp").ready()
+    assert spied_load.call_count == 0
+
+    assert storage.find_static_file("styles.css") is not None
+    assert storage.find_static_file("styles.css") is not None
+    assert spied_load.call_count == 1
+
+
+def test_amp_image_sizes_storage(tmp_path, settings, mocker):
+    """
+    Asserts that the dimensions of static images are written to a manifest at
+    'collectstatic', and looked up instead of probing the images.
+    """
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "logo.png").write_bytes(
+        b"\x89PNG\r\n\x1a\n"
+        + struct.pack(">I", 13)
+        + b"IHDR"
+        + struct.pack(">IIBBBBB", 120, 60, 8, 6, 0, 0, 0)
+    )
+    settings.STATICFILES_DIRS = [str(tmp_path / "static")]
+    settings.STATIC_ROOT = str(tmp_path / "root")
+    settings.STATICFILES_STORAGE = "auto_amp.storage.AmpManifestStaticFilesStorage"
+    call_command("collectstatic", interactive=False, verbosity=0)
+
+    assert (
+        '"logo.png":[120,60]'
+        in (tmp_path / "root" / "amp-image-sizes.json").read_text()
+    )
+
+    spied_probe_image_info = mocker.spy(utils, "_probe_image_info")
+    hashed_name = staticfiles_storage.stored_name("logo.png")
+    parsed_amp = utils.replace_amp_img(
+        utils.parse_html(
+            f'<img src="/static/logo.png"><img src="/static/{hashed_name}">'
+        )
+    )
+    assert [(img["width"], img["height"]) for img in parsed_amp("amp-img")] == [
+        ("120", "60"),
+        ("120", "60"),
+    ]
+    assert spied_probe_image_info.call_count == 0
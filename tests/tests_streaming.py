@@ -0,0 +1,192 @@
+import time
+
+import pytest
+from django.http import StreamingHttpResponse
+
+from auto_amp import utils
+from auto_amp.conf import DEFAULTS
+from auto_amp.streaming import stream_amp_tags
+from test_utils import reload_module, reload_urlconf
+
+
+HTML_DOCUMENT = """
+<!doctype html>
+<html lang="en">
+    <head>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width">
+        <title>Page title &amp; more</title>
+        <link rel="stylesheet" href="/static/styles.css" />
+        <script src="/static/head.js"></script>
+    </head>
+    <body>
+        <!-- Page content -->
+        <h1>Django Auto AMP</h1>
+        <img src="/static/img.jpg" width="500" height="300" />
+        <img src="/static/img.gif" layout="nodisplay" />
+        <script type="text/javascript">if (1 < 2) { document.write("<p>"); }</script>
+        <script type="application/json">{"key": "value"}</script>
+    </body>
+</html>
+"""
+
+
+def test_stream_amp_tags(mocked_resources):
+    """
+    Asserts that the streamed document gets the same AMP updates as the tree based
+    transform.
+    """
+    streamed_amp = utils.parse_html("".join(stream_amp_tags([HTML_DOCUMENT], "/")))
+    parsed_amp = utils.parse_html(utils.add_amp_tags(HTML_DOCUMENT, "/"))
+
+    for amp in (streamed_amp, parsed_amp):
+        assert amp.find("html", amp="") is not None
+        assert amp.head.find("meta", charset="utf-8") is not None
+        assert amp.head.find("link", rel="canonical", href="/") is not None
+        assert amp.head.find("script", src=utils.AMP_JS_URL) is not None
+        assert amp.head.find("style", attrs={"amp-boilerplate": ""}) is not None
+        assert amp.find("img") is None
+        assert amp.title.string == "Page title & more"
+
+    assert len(streamed_amp.find_all("meta", charset="utf-8")) == 1
+    assert streamed_amp.head.find("meta", attrs={"name": "viewport"})["content"] == (
+        utils.AMP_VIEWPORT_CONTENT
+    )
+    assert streamed_amp.head.find("style", attrs={"amp-custom": ""}).string == (
+        parsed_amp.head.find("style", attrs={"amp-custom": ""}).string
+    )
+    assert [script.get("type") for script in streamed_amp.find_all("script")] == [
+        script.get("type") for script in parsed_amp.find_all("script")
+    ]
+    assert [img.attrs for img in streamed_amp.find_all("amp-img")] == [
+        img.attrs for img in parsed_amp.find_all("amp-img")
+    ]
+    assert mocked_resources.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        '<html><meta charset="iso-8859-1"><title>Page</title>'
+        '<link rel="stylesheet" href="/static/styles.css"><p>Text</p></html>',
+        "<!doctype html><p>Text</p>",
+        '<html><head><meta http-equiv="Content-Type" content="text/html; '
+        'charset=iso-8859-1"><title>Page</title><p>Text</p></head><body></body></html>',
+    ],
+)
+def test_stream_amp_tags_implicit_head(content, mocked_resources):
+    """
+    Asserts that the AMP head is added to documents leaving out their head tags, as
+    the only declaration of their charset.
+    """
+    amp_content = "".join(stream_amp_tags([content], "/"))
+    head, body = amp_content.split("</head>")
+
+    assert head.count("<head>") == 1
+    assert '<meta charset="utf-8">' in head
+    assert "<meta" not in head.replace('<meta charset="utf-8">', "").replace(
+        f'<meta name="viewport" content="{utils.AMP_VIEWPORT_CONTENT}">', ""
+    )
+    assert '<link rel="canonical" href="/">' in head
+    assert "amp-boilerplate" in head
+    assert "<p>Text</p>" in body and "<p>" not in head
+
+
+def test_stream_amp_tags_chunk_boundaries(mocked_resources):
+    """
+    Asserts that the output doesn't depend on where the document is split in chunks,
+    including multi-byte characters split across chunks.
+    """
+    content = HTML_DOCUMENT.replace("Page title", "Título").encode("utf-8")
+    whole = "".join(stream_amp_tags([content], "/"))
+
+    byte_chunks = (content[i : i + 1] for i in range(len(content)))
+    assert "".join(stream_amp_tags(byte_chunks, "/")) == whole
+    assert "Título" in whole
+
+
+def test_stream_amp_tags_is_incremental(mocked_resources):
+    """
+    Asserts that output is yielded before the whole document has been consumed.
+    """
+    consumed = []
+
+    def chunks():
+        for line in HTML_DOCUMENT.splitlines(keepends=True):
+            consumed.append(line)
+            yield line
+
+    first_chunk = next(stream_amp_tags(chunks(), "/"))
+    assert first_chunk
+    assert len(consumed) < len(HTML_DOCUMENT.splitlines())
+
+
+def test_stream_amp_tags_probe_budget(settings, mocked_resources):
+    """
+    Asserts that the images of a document are probed concurrently, and the ones not
+    measured within the page budget get the fallback attributes.
+    """
+    settings.AUTO_AMP_IMAGE_PROBE_BUDGET = 0.5
+
+    def get_image_info(uri, probes=None):
+        time.sleep(1 if "slow" in uri else 0.2)
+        return 800, 600
+
+    mocked_resources.side_effect = get_image_info
+    content = (
+        "<html><head></head><body>"
+        + "".join(f'<img src="/media/{index}.png">' for index in range(4))
+        + '<img src="/media/slow.png"></body></html>'
+    )
+
+    start = time.monotonic()
+    amp_content = "".join(stream_amp_tags([content], "/"))
+    assert time.monotonic() - start < 0.9
+    assert amp_content.count('width="800" height="600"') == 4
+    assert (
+        '<amp-img src="/media/slow.png" layout="responsive" width="0" height="0">'
+        in amp_content
+    )
+
+
+def mark_body(parsed_amp):
+    """
+    Custom stage marking the body of AMP pages.
+    """
+    parsed_amp.body["class"] = "amp"
+    return parsed_amp
+
+
+def test_stream_amp_tags_custom_pipeline(settings, mocked_resources):
+    """
+    Asserts that documents are gathered and transformed by custom stages.
+    """
+    settings.AUTO_AMP_PIPELINE = [*DEFAULTS["PIPELINE"], mark_body]
+    chunks = [line.encode("utf-8") for line in HTML_DOCUMENT.splitlines()]
+
+    amp_chunks = list(stream_amp_tags(chunks, "/"))
+    assert len(amp_chunks) == 1
+    assert '<body class="amp">' in amp_chunks[0]
+    assert "<amp-img" in amp_chunks[0]
+
+
+def test_canonical_to_amp_streaming(client, mocker, mocked_resources):
+    """
+    Asserts that streaming canonical responses are transformed into streaming AMP
+    responses.
+    """
+    mocked_website_index = mocker.patch("website.views.index")
+    mocked_website_index.return_value = StreamingHttpResponse(
+        line.encode("utf-8") for line in HTML_DOCUMENT.splitlines(keepends=True)
+    )
+    mocked_add_amp_tags = mocker.patch("auto_amp.views.add_amp_tags")
+    reload_module("website.urls")
+    reload_urlconf()
+
+    amp_response = client.get("/amp/")
+    assert amp_response.status_code == 200
+    assert amp_response.streaming
+    assert mocked_add_amp_tags.call_count == 0
+
+    amp_content = b"".join(amp_response.streaming_content).decode("utf-8")
+    assert utils.parse_html(amp_content).find("html", amp="") is not None
@@ -0,0 +1,131 @@
+import pytest
+from django.http import StreamingHttpResponse
+
+from auto_amp.signals import amp_page_timed
+from test_utils import reload_module, reload_urlconf
+
+
+HTML_DOCUMENT = (
+    '<html><head><link rel="stylesheet" href="/static/styles.css"></head>'
+    '<body><img src="/static/missing.png"><img src="/static/sized.png" width="1" '
+    'height="1"></body></html>'
+)
+
+
+@pytest.fixture
+def canonical_index(canonical_index):
+    """
+    Fixture to serve a page linking a stylesheet and images at the website index.
+    """
+    canonical_index.content = HTML_DOCUMENT
+    return canonical_index
+
+
+@pytest.fixture
+def timed_pages():
+    """
+    Fixture to collect the arguments of every 'amp_page_timed' signal sent.
+    """
+    timed_pages = []
+
+    def receiver(sender, **kwargs):
+        timed_pages.append(kwargs)
+
+    amp_page_timed.connect(receiver)
+    yield timed_pages
+    amp_page_timed.disconnect(receiver)
+
+
+def test_amp_timing(client, settings, canonical_index, timed_pages):
+    """
+    Asserts that the canonical render and every stage are timed, and the images
+    probed and CSS inlined are counted.
+    """
+    settings.AUTO_AMP_TIMING = True
+
+    amp_response = client.get("/amp/")
+    assert not amp_response.has_header("Server-Timing")
+
+    (timed_page,) = timed_pages
+    assert timed_page["canonical_path"] == "/"
+    assert {"canonical", "parse", "scripts", "images", "css", "serialize"} <= set(
+        timed_page["timings"]
+    )
+    assert all(seconds >= 0 for seconds in timed_page["timings"].values())
+    assert timed_page["counters"] == {"images_probed": 1, "css_bytes": 30}
+
+
+def test_amp_server_timing(client, settings, canonical_index, timed_pages):
+    """
+    Asserts that timings are set on the 'Server-Timing' header when enabled.
+    """
+    settings.AUTO_AMP_TIMING = True
+    settings.AUTO_AMP_SERVER_TIMING = True
+
+    server_timing = client.get("/amp/")["Server-Timing"]
+    assert server_timing.startswith("canonical;dur=")
+    assert "serialize;dur=" in server_timing
+
+
+def test_amp_timing_disabled(client, settings, canonical_index, timed_pages):
+    """
+    Asserts that nothing is timed nor reported by default.
+    """
+    settings.AUTO_AMP_SERVER_TIMING = True
+
+    assert not client.get("/amp/").has_header("Server-Timing")
+    assert timed_pages == []
+
+
+def test_amp_middleware_timing(client, settings, canonical_index, timed_pages):
+    """
+    Asserts that pages transformed by the middleware are timed as well.
+    """
+    settings.MIDDLEWARE = [
+        *settings.MIDDLEWARE,
+        "auto_amp.middleware.AutoAmpMiddleware",
+    ]
+    settings.AUTO_AMP_TIMING = True
+    settings.AUTO_AMP_SERVER_TIMING = True
+
+    assert client.get("/amp/")["Server-Timing"].startswith("canonical;dur=")
+    assert timed_pages[0]["counters"]["images_probed"] == 1
+
+
+def test_amp_timing_cached_images(client, settings, canonical_index, timed_pages):
+    """
+    Asserts that only the images actually probed are counted, not the cached ones.
+    """
+    settings.AUTO_AMP_TIMING = True
+
+    client.get("/amp/")
+    client.get("/amp/")
+
+    assert [timed_page["counters"]["images_probed"] for timed_page in timed_pages] == [
+        1,
+        0,
+    ]
+
+
+def test_amp_streaming_timing(client, mocker, settings, timed_pages):
+    """
+    Asserts that streaming responses are timed once their content is streamed, and
+    do not set the 'Server-Timing' header sent before their transform.
+    """
+    mocked_website_index = mocker.patch("website.views.index")
+    mocked_website_index.return_value = StreamingHttpResponse(
+        iter([HTML_DOCUMENT.encode("utf-8")])
+    )
+    reload_module("website.urls")
+    reload_urlconf()
+    settings.AUTO_AMP_TIMING = True
+    settings.AUTO_AMP_SERVER_TIMING = True
+
+    amp_response = client.get("/amp/")
+    assert not amp_response.has_header("Server-Timing")
+    assert timed_pages == []
+
+    b"".join(amp_response.streaming_content)
+    (timed_page,) = timed_pages
+    assert {"canonical", "stream"} <= set(timed_page["timings"])
+    assert timed_page["counters"] == {"images_probed": 1}
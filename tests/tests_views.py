@@ -0,0 +1,179 @@
+import asyncio
+import re
+import threading
+from datetime import datetime, timezone
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils.http import http_date
+from django.views.decorators.http import etag
+
+from auto_amp.conf import DEFAULTS
+from auto_amp.views import async_canonical_to_amp, canonical_to_amp
+
+
+HTML_DOCUMENT = "<html><head></head><body>Index</body></html>"
+
+
+def test_canonical_to_amp_etag(client, canonical_index, mocked_add_amp_tags):
+    """
+    Asserts that AMP responses get an ETag and matching conditional requests are
+    answered without running the AMP transform.
+    """
+    amp_response = client.get("/amp/")
+    amp_etag = amp_response["ETag"]
+    assert re.fullmatch(r'"[0-9a-f]{32}-amp2\.[0-9a-f]{16}"', amp_etag)
+
+    not_modified_response = client.get("/amp/", HTTP_IF_NONE_MATCH=amp_etag)
+    assert not_modified_response.status_code == 304
+    assert not_modified_response["ETag"] == amp_etag
+    assert mocked_add_amp_tags.call_count == 1
+
+    assert client.get("/amp/", HTTP_IF_NONE_MATCH='"other"').status_code == 200
+    assert mocked_add_amp_tags.call_count == 2
+
+    assert client.get("/amp/", HTTP_IF_MATCH='"other"').status_code == 412
+    assert mocked_add_amp_tags.call_count == 2
+
+
+def test_canonical_to_amp_canonical_etag(client, canonical_index, mocked_add_amp_tags):
+    """
+    Asserts that the AMP ETag is derived from the canonical view ETag, so the
+    canonical view decorators answer conditional requests without rendering.
+    """
+    canonical_index.decorate(etag(lambda request: "v1"))
+
+    amp_etag = client.get("/amp/")["ETag"]
+    assert re.fullmatch(r'"v1-amp2\.[0-9a-f]{16}"', amp_etag)
+    assert canonical_index.call_count == 1
+
+    not_modified_response = client.get("/amp/", HTTP_IF_NONE_MATCH=amp_etag)
+    assert not_modified_response.status_code == 304
+    assert not_modified_response["ETag"] == amp_etag
+    assert canonical_index.call_count == 1
+    assert mocked_add_amp_tags.call_count == 1
+
+    assert client.get("/amp/", HTTP_IF_NONE_MATCH='"v1"').status_code == 200
+    assert client.get("/amp/", HTTP_IF_MATCH='"v2-amp2.0"').status_code == 412
+    assert mocked_add_amp_tags.call_count == 2
+
+
+def test_canonical_to_amp_etag_versions(
+    client, settings, mocker, canonical_index, mocked_add_amp_tags
+):
+    """
+    Asserts that the AMP ETag changes with the stylesheets and the stages of the
+    page, so outdated AMP pages aren't answered with '304 Not Modified'.
+    """
+    canonical_index.decorate(etag(lambda request: "v1"))
+    canonical_index.content = (
+        '<html><head><link href="/static/styles.css" rel="stylesheet"></head>'
+        "<body>Index</body></html>"
+    )
+    mocked_version = mocker.patch(
+        "auto_amp.views.stylesheets_version", return_value="1"
+    )
+
+    amp_etag = client.get("/amp/")["ETag"]
+    mocked_version.assert_called_with(("/static/styles.css",))
+    assert client.get("/amp/", HTTP_IF_NONE_MATCH=amp_etag).status_code == 304
+
+    mocked_version.return_value = "2"
+    amp_response = client.get("/amp/", HTTP_IF_NONE_MATCH=amp_etag)
+    assert amp_response.status_code == 200
+    assert amp_response["ETag"] != amp_etag
+    assert canonical_index.call_count == 2
+
+    amp_etag = amp_response["ETag"]
+    settings.AUTO_AMP_PIPELINE = DEFAULTS["PIPELINE"][:-1]
+    amp_response = client.get("/amp/", HTTP_IF_NONE_MATCH=amp_etag)
+    assert amp_response.status_code == 200
+    assert amp_response["ETag"] != amp_etag
+    assert client.get("/amp/", HTTP_IF_MATCH=amp_etag).status_code == 412
+
+
+def test_canonical_to_amp_last_modified_func(canonical_index, mocked_add_amp_tags):
+    """
+    Asserts that the last modified callback answers conditional requests without
+    rendering the canonical page.
+    """
+    last_modified = datetime(2019, 5, 1, 12, 0, tzinfo=timezone.utc)
+    last_modified_func = lambda request, canonical_path: last_modified
+
+    request = RequestFactory().get(
+        "/amp/", HTTP_IF_MODIFIED_SINCE=http_date(last_modified.timestamp() + 60)
+    )
+    amp_response = canonical_to_amp(
+        request, canonical_path="/", last_modified_func=last_modified_func
+    )
+    assert amp_response.status_code == 304
+    assert canonical_index.call_count == 0
+
+    request = RequestFactory().get(
+        "/amp/", HTTP_IF_MODIFIED_SINCE=http_date(last_modified.timestamp() - 60)
+    )
+    amp_response = canonical_to_amp(
+        request, canonical_path="/", last_modified_func=last_modified_func
+    )
+    assert amp_response.status_code == 200
+    assert amp_response["Last-Modified"] == "Wed, 01 May 2019 12:00:00 GMT"
+    assert mocked_add_amp_tags.call_count == 1
+
+
+def test_async_canonical_to_amp(mocker, canonical_index):
+    """
+    Asserts that the async view renders synchronous and asynchronous canonical views
+    and transforms their content off the event loop thread.
+    """
+    event_loop_thread = threading.get_ident()
+    transform_threads = []
+
+    def apply_amp_tags(parsed_amp, path, tags, *args):
+        transform_threads.append(threading.get_ident())
+        return str(parsed_amp).replace("<html>", "<amp>")
+
+    mocker.patch("auto_amp.views.apply_amp_tags", side_effect=apply_amp_tags)
+
+    request = RequestFactory().get("/amp/")
+    amp_response = asyncio.run(async_canonical_to_amp(request, canonical_path="/"))
+    assert amp_response.status_code == 200
+    assert amp_response.content.startswith(b"<amp>")
+    assert canonical_index.call_count == 1
+
+    async def async_index(request):
+        return HttpResponse(HTML_DOCUMENT.replace("Index", "Async"))
+
+    canonical_index.decorate(lambda view: async_index)
+    amp_response = asyncio.run(async_canonical_to_amp(request, canonical_path="/"))
+    assert amp_response.content.startswith(b"<amp>")
+    assert b"Async" in amp_response.content
+
+    assert len(transform_threads) == 2
+    assert event_loop_thread not in transform_threads
+
+
+def test_async_canonical_to_amp_etag(canonical_index, mocked_add_amp_tags):
+    """
+    Asserts that the async view answers conditional requests like the sync one.
+    """
+    request = RequestFactory().get("/amp/")
+    amp_etag = canonical_to_amp(request, canonical_path="/")["ETag"]
+
+    request = RequestFactory().get("/amp/", HTTP_IF_NONE_MATCH=amp_etag)
+    amp_response = asyncio.run(async_canonical_to_amp(request, canonical_path="/"))
+    assert amp_response.status_code == 304
+    assert amp_response["ETag"] == amp_etag
+
+
+def test_canonical_to_amp_charset(client, canonical_index):
+    """
+    Asserts that canonical pages in other charsets are served as UTF-8 AMP pages.
+    """
+    canonical_index.side_effect = lambda request: HttpResponse(
+        "<html><head></head><body>Café</body></html>",
+        content_type="text/html; charset=latin-1",
+    )
+
+    amp_response = client.get("/amp/")
+    assert amp_response["Content-Type"] == "text/html; charset=utf-8"
+    assert "Café".encode("utf-8") in amp_response.content